@@ -0,0 +1,100 @@
+import argparse
+import os
+import sys
+
+"""
+The `irohui` command.
+
+    irohui send PATH [options]      share a file or folder (options: irohui send --help)
+    irohui receive TICKET [options] join a doc and write its files
+    irohui ui [--data-dir DIR]      open the window
+    irohui daemon run               run the daemon in the foreground
+    irohui daemon start|stop|status|list|metrics|reprioritize|send|receive ...
+                                    talk to it (see daemon_client.py)
+
+Nothing heavy is imported up here: iroh is only loaded by send, receive and
+daemon run, Qt only by ui. `irohui --help` or `irohui daemon status` never
+load the native libraries, cli_test.py keeps it that way.
+"""
+
+PROG = "irohui"
+
+
+def run_send(args):
+    import asyncio
+    from py_app import main as node_main
+    target = ["--dir" if os.path.isdir(args.path) else "--file", args.path]
+    return asyncio.run(node_main.main(target + args.options, prog="{} send PATH".format(PROG)))
+
+
+def run_receive(args):
+    import asyncio
+    from py_app import main as node_main
+    return asyncio.run(node_main.main(["--ticket", args.ticket] + args.options, prog="{} receive TICKET".format(PROG)))
+
+
+def run_ui(args):
+    from py_app.ui import app
+    return app.main(args.data_dir)
+
+
+def run_daemon(args):
+    if args.action == "run":
+        import asyncio
+        from py_app.daemon import run_daemon, add_schedule_arguments
+        daemon_args = argparse.ArgumentParser(prog="{} daemon run".format(PROG))
+        daemon_args.add_argument('--data-dir', type=str, default=None, help='node data folder (default: ~/.fileflow)')
+        daemon_args.add_argument('--socket', type=str, default=None, help='socket path (default: <data dir>/daemon.sock)')
+        add_schedule_arguments(daemon_args)
+        options = daemon_args.parse_args(args.options)
+        return asyncio.run(run_daemon(options.data_dir, options.socket, options.max_active, options.rate_limit,
+                                      options.peer_rate_limit))
+    from py_app import daemon_client
+    # daemon_client wants its global options before the command
+    globals_, rest = [], []
+    options = iter(args.options)
+    for option in options:
+        if option in ("--data-dir", "--socket"):
+            globals_ += [option, next(options, "")]
+        else:
+            rest.append(option)
+    return daemon_client.main(globals_ + [args.action] + rest)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog=PROG, description='Send and receive files and folders over iroh')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    send = commands.add_parser('send', help='share a file or folder and print the ticket', add_help=False)
+    send.add_argument('path')
+    send.add_argument('options', nargs=argparse.REMAINDER)
+    send.set_defaults(run=run_send)
+
+    receive = commands.add_parser('receive', help='join a doc with a ticket and write its files', add_help=False)
+    receive.add_argument('ticket')
+    receive.add_argument('options', nargs=argparse.REMAINDER)
+    receive.set_defaults(run=run_receive)
+
+    ui = commands.add_parser('ui', help='open the window')
+    ui.add_argument('--data-dir', type=str, default=None, help='keep the node and its docs here between runs')
+    ui.set_defaults(run=run_ui)
+
+    daemon = commands.add_parser('daemon', help='run or talk to the background node')
+    daemon.add_argument('action', choices=('run', 'start', 'stop', 'status', 'list', 'metrics', 'reprioritize', 'send', 'receive'))
+    daemon.add_argument('options', nargs=argparse.REMAINDER)
+    daemon.set_defaults(run=run_daemon)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # `irohui send --help` shows the options of the command itself, which needs iroh to build
+    if len(argv) >= 2 and argv[0] in ("send", "receive") and argv[1] in ("-h", "--help"):
+        argv = [argv[0], "-"] + argv[1:]
+    args = build_parser().parse_args(argv)
+    result = args.run(args)
+    return result if isinstance(result, int) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
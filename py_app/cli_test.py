@@ -0,0 +1,40 @@
+# tests for the irohui command in cli.py: the cheap commands must stay cheap
+import subprocess
+import tempfile
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("iroh", "PyQt6", "PySide6", "asyncio")
+MAX_IMPORT_US = 100 * 1000  # py_app.cli and everything it pulls in, in microseconds
+
+
+def importtime(*args):
+    # runs python -X importtime, returns ({module: cumulative us}, returncode)
+    proc = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=ROOT, capture_output=True, text=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = [part.strip() for part in line[len("import time:"):].split("|")]
+        if parts[1].isdigit():
+            modules[parts[2]] = int(parts[1])
+    return modules, proc.returncode
+
+
+def test_importing_the_cli_is_light():
+    modules, returncode = importtime("-c", "import py_app.cli")
+    assert returncode == 0
+    assert not [name for name in modules if name.split(".")[0] in HEAVY]
+    assert modules["py_app.cli"] < MAX_IMPORT_US
+
+
+def test_help_and_daemon_client_do_not_load_iroh():
+    modules, returncode = importtime("-m", "py_app.cli", "--help")
+    assert returncode == 0
+    assert not [name for name in modules if name.split(".")[0] in HEAVY]
+    # no daemon running: a clean error, still without iroh
+    dir = tempfile.TemporaryDirectory()
+    modules, returncode = importtime("-m", "py_app.cli", "daemon", "status", "--socket", os.path.join(dir.name, "none.sock"))
+    assert returncode == 1
+    assert not [name for name in modules if name.split(".")[0] in HEAVY]
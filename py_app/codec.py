@@ -0,0 +1,292 @@
+import iroh
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import zlib
+
+from py_app.send import file_key, send_file, DEFAULT_IN_PLACE_THRESHOLD
+from py_app.receive import receive_entry, target_path, DEFAULT_CHUNK_SIZE
+from py_app.listing import iter_entries
+from py_app.writer import use_writer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Compressing entries on the way through.
+
+Logs, csv and json dumps shrink a lot, media and archives don't. Before a
+file is sent, a few samples from across it are compressed with every codec
+we have (zstd if the zstandard package is installed, zlib always). The codec
+with the best ratio is used if it
+    - saves at least 1 - max_ratio of the bytes, and
+    - compresses at min_speed bytes/second or faster (the cpu budget, a codec
+      slower than the link only makes things slower)
+otherwise the file goes as it is, with the ingest mode it was asked for.
+Sampling and compressing run in a process pool, never on the event loop.
+The pool spawns its processes: forking once iroh's runtime threads are
+running can leave a child stuck on a lock one of them held.
+
+A compressed file is written to a temporary file, imported under the file's
+own key, and described by a small json entry next to it:
+
+    .fileflow/codec/<key>    {"codec": "zstd", "size": <original size>}
+
+Receivers look the codec up and decompress while they stream the blob to
+disk, so the compressed file never lands on disk on their side. Each chunk
+is decompressed on a thread (zlib and zstd let go of the GIL meanwhile), at
+most chunk_size bytes of output at a time, and the entry fails as soon as
+it decompresses to more than its size: a small blob can't blow up into
+gigabytes first.
+"""
+
+CODEC_PREFIX = b".fileflow/codec/"
+DEFAULT_SAMPLE_SIZE = 64 * 1024  # bytes per sample
+DEFAULT_SAMPLES = 4
+DEFAULT_MAX_RATIO = 0.9  # compressed/original, above this it isn't worth it
+DEFAULT_MIN_SPEED = 50 * 1024 * 1024  # bytes/second
+DEFAULT_LEVELS = {"zstd": 3, "zlib": 6}
+MIN_SIZE = 4096  # smaller files always go as they are
+ZSTD_SLICE = 1024  # input bytes per zstd call, see ZstdInflater
+
+
+def available_codecs():
+    return ("zstd", "zlib") if zstandard is not None else ("zlib",)
+
+
+def compressor(codec, level=None):
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    elif codec == "zlib":
+        return zlib.compressobj(level)
+    raise ValueError("unknown codec {!r}".format(codec))
+
+
+class ZstdInflater:
+    # zlib's decompress(data, max_length) and unconsumed_tail for zstandard, whose decompressobj has no
+    # output limit. input goes in ZSTD_SLICE bytes at a time, so a call can overshoot max_length by what
+    # one slice expands to, not by what the whole chunk does
+    def __init__(self):
+        self.d = zstandard.ZstdDecompressor().decompressobj()
+        self.unconsumed_tail = b""
+
+    def decompress(self, data, max_length):
+        out = bytearray()
+        offset = 0
+        while offset < len(data) and len(out) < max_length:
+            out += self.d.decompress(data[offset:offset + ZSTD_SLICE])
+            offset += ZSTD_SLICE
+        self.unconsumed_tail = data[offset:]
+        return bytes(out)
+
+    def flush(self):
+        return self.d.flush()
+
+
+def decompressor(codec):
+    # decompress(data, max_length), unconsumed_tail and flush(), as zlib's
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("entry is zstd compressed, install the zstandard package to receive it")
+        return ZstdInflater()
+    elif codec == "zlib":
+        return zlib.decompressobj()
+    raise ValueError("unknown codec {!r}".format(codec))
+
+
+def read_samples(path, samples=DEFAULT_SAMPLES, sample_size=DEFAULT_SAMPLE_SIZE):
+    # evenly spread pieces of the file, the start alone is often a header that says little
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if size <= samples * sample_size:
+            return [f.read()]
+        pieces = []
+        step = (size - sample_size) // (samples - 1) if samples > 1 else 0
+        for i in range(samples):
+            f.seek(i * step)
+            pieces.append(f.read(sample_size))
+        return pieces
+
+
+def choose_codec(path, max_ratio=DEFAULT_MAX_RATIO, min_speed=DEFAULT_MIN_SPEED, codecs=None):
+    # returns the codec to send path with, or None. runs in the process pool
+    if os.path.getsize(path) < MIN_SIZE:
+        return None
+    pieces = read_samples(path)
+    original = sum(len(piece) for piece in pieces)
+    best, best_ratio = None, max_ratio
+    for codec in codecs or available_codecs():
+        start = time.perf_counter()
+        compressed = 0
+        for piece in pieces:
+            c = compressor(codec)
+            compressed += len(c.compress(piece)) + len(c.flush())
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        ratio = compressed / original
+        if ratio < best_ratio and original / elapsed >= min_speed:
+            best, best_ratio = codec, ratio
+    return best
+
+
+def compress_file(path, out_path, codec, chunk_size=DEFAULT_CHUNK_SIZE):
+    # streams path into out_path. runs in the process pool
+    c = compressor(codec)
+    with open(path, "rb") as src, open(out_path, "wb") as dst:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            dst.write(c.compress(chunk))
+        dst.write(c.flush())
+    return os.path.getsize(out_path)
+
+
+class Compressor:
+    # sends files through the codec stage. one process pool for all of them
+    def __init__(self, max_ratio=DEFAULT_MAX_RATIO, min_speed=DEFAULT_MIN_SPEED, codecs=None, workers=None):
+        self.max_ratio = max_ratio
+        self.min_speed = min_speed
+        self.codecs = tuple(codecs) if codecs else available_codecs()
+        for codec in self.codecs:
+            if codec not in available_codecs():
+                raise ValueError("codec {!r} is not available".format(codec))
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        self.tempdir = tempfile.TemporaryDirectory(prefix="fileflow-codec-")
+        self.chosen = {}  # codec -> files sent with it, None for the ones sent as they are
+
+    def close(self):
+        self.pool.shutdown()
+        self.tempdir.cleanup()
+
+    async def send_file(self, doc, author, path, root=None, on_progress=None, mode="import",
+                        in_place_threshold=DEFAULT_IN_PLACE_THRESHOLD):
+        # returns the key. the file may or may not have been compressed, mode and
+        # in_place_threshold are for files sent as they are (see send.send_file)
+        loop = asyncio.get_running_loop()
+        key = file_key(path, root)
+        codec = await loop.run_in_executor(self.pool, choose_codec, path, self.max_ratio, self.min_speed, self.codecs)
+        self.chosen[codec] = self.chosen.get(codec, 0) + 1
+        if codec is None:
+            if await doc.get_exact(author, CODEC_PREFIX + key, False) is not None:
+                # it was compressed last time, it isn't now
+                await doc.delete(author, CODEC_PREFIX + key)
+            await send_file(doc, author, path, mode, root, in_place_threshold, on_progress)
+            return key
+        size = os.path.getsize(path)
+        fd, out_path = tempfile.mkstemp(dir=self.tempdir.name)
+        os.close(fd)
+        try:
+            await loop.run_in_executor(self.pool, compress_file, path, out_path, codec)
+            # metadata first, so a receiver never sees compressed bytes without knowing they are
+            meta = json.dumps({"codec": codec, "size": size}).encode("utf8")
+            await doc.set_bytes(author, CODEC_PREFIX + key, meta)
+            # copied into the store, the temporary file goes away right after
+            await doc.import_file(author, key, out_path, False, None)
+        finally:
+            os.remove(out_path)
+        if on_progress:
+            on_progress(key, size, size)
+        return key
+
+    def summary(self):
+        parts = ["{} {}".format(count, codec or "as is") for codec, count in sorted(self.chosen.items(), key=lambda item: str(item[0]))]
+        return "sent " + ", ".join(parts) if parts else "nothing sent"
+
+
+class DecodedEntry:
+    # an entry as it is on disk after decompressing, for store.is_received / mark_received
+    def __init__(self, entry, size):
+        self.entry = entry
+        self.size = size
+
+    def key(self):
+        return self.entry.key()
+
+    def content_hash(self):
+        return self.entry.content_hash()
+
+    def content_len(self):
+        return self.size
+
+
+class CodecMap:
+    # receiver side. which entries are compressed, and how
+    def __init__(self):
+        self.codecs = {}  # key -> (codec, original size)
+
+    async def load(self, node, doc):
+        async for entry in iter_entries(doc, CODEC_PREFIX):
+            await self.add(node, entry)
+        return self
+
+    async def add(self, node, entry):
+        # entry is a .fileflow/codec/ entry, an empty one means the file is no longer compressed
+        key = entry.key()[len(CODEC_PREFIX):]
+        if entry.content_len() == 0:
+            self.codecs.pop(key, None)
+            return
+        meta = json.loads(await node.blobs().read_to_bytes(entry.content_hash()))
+        self.codecs[key] = (meta["codec"], meta["size"])
+
+    def is_compressed(self, entry):
+        return entry.key() in self.codecs
+
+    def as_written(self, entry):
+        found = self.codecs.get(entry.key())
+        return DecodedEntry(entry, found[1]) if found else entry
+
+    async def receive(self, node, doc, entry, out_dir=".", mode="export", chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None,
+                      writer=None):
+        # receive_entry that decompresses compressed entries on the way to disk
+        found = self.codecs.get(entry.key())
+        if found is None:
+            return await receive_entry(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer)
+        codec, size = found
+        path = target_path(entry.key(), out_dir)
+        await decompress_entry(node, entry, path, codec, size, chunk_size, on_progress, writer)
+        return path
+
+
+async def decompress_entry(node, entry, path, codec, size, chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None, writer=None):
+    # read the compressed blob a chunk at a time and write what it decompresses to
+    loop = asyncio.get_running_loop()
+    d = decompressor(codec)
+    key = entry.key()
+    hash = entry.content_hash()
+    total = entry.content_len()
+    offset = written = 0
+    # the file only appears under its name if it decompressed to the right size
+    async with use_writer(writer) as writer, writer.open(path, size) as f:
+        while offset < total:
+            chunk = await node.blobs().read_at_to_bytes(hash, offset, iroh.ReadAtLen.at_most(chunk_size))
+            if not chunk:
+                raise IOError("blob {} ended after {} of {} bytes".format(hash, offset, total))
+            offset += len(chunk)
+            while True:
+                # one byte more than is left is enough to know it is too much
+                limit = min(chunk_size, size - written + 1)
+                data = await loop.run_in_executor(None, d.decompress, chunk, limit)
+                written += len(data)
+                if written > size:
+                    raise IOError("{!r} decompresses to more than {} bytes".format(key, size))
+                await f.write(data)
+                if on_progress:
+                    on_progress(key, written, size)
+                chunk = d.unconsumed_tail
+                if not chunk and len(data) < limit:
+                    break
+        data = await loop.run_in_executor(None, d.flush)
+        await f.write(data)
+        written += len(data)
+        if written != size:
+            raise IOError("{!r} decompressed to {} bytes, expected {}".format(key, written, size))
+    if on_progress:
+        on_progress(key, size, size)
+    return written
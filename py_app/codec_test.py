@@ -0,0 +1,149 @@
+# tests for the compression stage in codec.py
+import tempfile
+import asyncio
+import os
+
+from py_app import codec
+from py_app.codec import Compressor, choose_codec, compress_file, decompress_entry, available_codecs
+
+
+class FakeBlobs:
+    def __init__(self, data):
+        self.data = data
+
+    async def read_at_to_bytes(self, hash, offset, length):
+        return self.data[offset:offset + length]
+
+
+class FakeNode:
+    def __init__(self, data):
+        self._blobs = FakeBlobs(data)
+
+    def blobs(self):
+        return self._blobs
+
+
+class FakeEntry:
+    def __init__(self, key, size):
+        self._key = key
+        self._size = size
+
+    def key(self):
+        return self._key
+
+    def content_hash(self):
+        return "hash"
+
+    def content_len(self):
+        return self._size
+
+
+def write(dir, name, data):
+    path = os.path.join(dir, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def test_only_compressible_files_get_a_codec():
+    dir = tempfile.TemporaryDirectory()
+    log = write(dir.name, "log", b"".join(b"2024-01-01 12:00:%02d INFO request ok id=%d\n" % (i % 60, i) for i in range(50000)))
+    media = write(dir.name, "media", os.urandom(1024 * 1024))
+    tiny = write(dir.name, "tiny", b"a" * 100)
+    assert choose_codec(log, min_speed=0) in available_codecs()
+    assert choose_codec(media, min_speed=0) is None
+    assert choose_codec(tiny, min_speed=0) is None
+    # a codec slower than the budget isn't used, however well it does
+    assert choose_codec(log, min_speed=10 ** 15) is None
+
+
+def test_decompress_while_receiving(monkeypatch):
+    monkeypatch.setattr(codec.iroh, "ReadAtLen", type("ReadAtLen", (), {"at_most": staticmethod(lambda n: n)}), raising=False)
+    dir = tempfile.TemporaryDirectory()
+    original = b"".join(b"line %d of a csv,with,columns\n" % i for i in range(20000))
+    path = write(dir.name, "data.csv", original)
+    for name in available_codecs():
+        compressed = os.path.join(dir.name, "data." + name)
+        size = compress_file(path, compressed, name)
+        assert size < len(original) // 4
+        with open(compressed, "rb") as f:
+            node = FakeNode(f.read())
+        out = os.path.join(dir.name, "out", name)
+        progress = []
+        written = asyncio.run(decompress_entry(node, FakeEntry(b"data.csv\0", size), out, name, len(original), 4096,
+                                               lambda key, done, total: progress.append(done)))
+        assert written == len(original)
+        with open(out, "rb") as f:
+            assert f.read() == original
+        assert progress[-1] == len(original)
+
+
+def test_blob_that_decompresses_to_too_much_fails_early(monkeypatch):
+    monkeypatch.setattr(codec.iroh, "ReadAtLen", type("ReadAtLen", (), {"at_most": staticmethod(lambda n: n)}), raising=False)
+    dir = tempfile.TemporaryDirectory()
+    real_decompressor = codec.decompressor
+    for name in available_codecs():
+        c = codec.compressor(name)
+        # 256 MiB of zeros in a few hundred KiB
+        bomb = b"".join(c.compress(bytes(1024 * 1024)) for _ in range(256)) + c.flush()
+        decompressors = []
+
+        def counting(name):
+            decompressors.append(CountingDecompressor(real_decompressor(name)))
+            return decompressors[-1]
+
+        monkeypatch.setattr(codec, "decompressor", counting)
+        out = os.path.join(dir.name, name)
+        try:
+            asyncio.run(decompress_entry(FakeNode(bomb), FakeEntry(b"bomb\0", len(bomb)), out, name, 1000, 64 * 1024))
+        except IOError as e:
+            assert "more than 1000 bytes" in str(e)
+        else:
+            assert False, "oversized output not noticed"
+        # it stopped right after the declared size, without expanding the rest
+        assert decompressors[0].out <= 64 * 1024 * 1024
+        assert not os.path.exists(out)
+
+
+class CountingDecompressor:
+    def __init__(self, d):
+        self.d = d
+        self.out = 0
+
+    @property
+    def unconsumed_tail(self):
+        return self.d.unconsumed_tail
+
+    def decompress(self, data, max_length):
+        data = self.d.decompress(data, max_length)
+        self.out += len(data)
+        return data
+
+    def flush(self):
+        return self.d.flush()
+
+
+class FakeDoc:
+    def __init__(self):
+        self.imported = []
+
+    async def get_exact(self, author, key, include_empty):
+        return None
+
+    async def import_file(self, author, key, path, in_place, callback):
+        self.imported.append((key, in_place))
+
+
+def test_files_sent_as_they_are_keep_the_ingest_options():
+    dir = tempfile.TemporaryDirectory()
+    media = write(dir.name, "media", os.urandom(1024 * 1024))
+    doc = FakeDoc()
+    compressor = Compressor(min_speed=0, workers=1)
+    try:
+        # never forked, iroh's threads may be holding locks
+        assert compressor.pool._mp_context.get_start_method() == "spawn"
+        asyncio.run(compressor.send_file(doc, "author", media, dir.name, in_place_threshold=1024))
+        asyncio.run(compressor.send_file(doc, "author", media, dir.name, in_place_threshold=None))
+    finally:
+        compressor.close()
+    assert [in_place for key, in_place in doc.imported] == [True, False]
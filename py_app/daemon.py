@@ -0,0 +1,278 @@
+import iroh
+import asyncio
+import json
+import os
+import time
+
+from py_app.store import NodeStore, default_data_dir
+from py_app.send import send_file, INGEST_MODES
+from py_app.sync import join_and_wait, DEFAULT_SYNC_TIMEOUT
+from py_app.pipeline import receive_doc
+from py_app.resume import ResumeStats, partial_blobs, complete_blob, complete_reserved
+from py_app.dirsync import DirIndex, sync_dir
+from py_app.codec import Compressor
+from py_app.metrics import Metrics
+from py_app.writer import ExportWriter
+from py_app.schedule import Scheduler, DEFAULT_MAX_ACTIVE
+from py_app.daemon_client import default_socket_path, PROGRESS_INTERVAL
+
+"""
+One node that stays up, so a send or receive costs a request instead of a
+node boot.
+
+The daemon owns a NodeStore (so the same node key, author and docs as
+main.py --data-dir) and listens on a unix socket, by default
+<data_dir>/daemon.sock. The protocol is one json object per line:
+
+    -> {"id": 1, "method": "send", "params": {"path": "/tmp/report.csv"}}
+    <- {"id": 1, "progress": ["report.csv", 1024, 4096]}     only with "progress": true
+    <- {"id": 1, "result": {"doc_id": ..., "ticket": ..., "bytes": 4096}}
+    <- {"id": 1, "error": "..."}                              instead of result
+
+Methods: status, list, send, receive, metrics, reprioritize, stop. A
+connection can send several requests, they are answered in order.
+Receives share the link through one Scheduler (schedule.py): each gets a
+priority, status lists them with their scheduler id and reprioritize
+changes the priority of one that is running. Shared docs stay shared for as long
+as the daemon runs. The client side is in daemon_client.py, which doesn't
+import iroh.
+"""
+
+
+class Daemon:
+    def __init__(self, data_dir=None, socket_path=None, max_active=DEFAULT_MAX_ACTIVE, rate=None, peer_rate=None):
+        self.data_dir = data_dir or default_data_dir()
+        self.socket_path = socket_path or default_socket_path(self.data_dir)
+        self.store = None
+        self.node = None
+        self.server = None
+        self.started = None
+        self.running = 0  # requests being worked on
+        self.compressor = None
+        self.writer = ExportWriter()  # for every receive
+        self.metrics = Metrics()  # cheap enough to always keep, see metrics.py
+        self.scheduler = Scheduler(max_active, rate=rate, peer_rate=peer_rate)
+        self.stopped = asyncio.Event()
+
+    async def start(self):
+        # setup event loop, to ensure async callbacks work
+        iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+        self.store = NodeStore(self.data_dir)
+        self.node = await self.store.open()
+        if os.path.exists(self.socket_path):
+            # left over from a daemon that didn't shut down cleanly
+            os.remove(self.socket_path)
+        # only we may connect, from the moment the socket exists
+        umask = os.umask(0o077)
+        try:
+            self.server = await asyncio.start_unix_server(self.handle_connection, self.socket_path)
+        finally:
+            os.umask(umask)
+        self.started = time.monotonic()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.stopped.wait()
+        finally:
+            await self.close()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        if self.compressor is not None:
+            self.compressor.close()
+        await self.writer.close()
+        await self.store.shutdown()
+
+    #
+    # connections
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self.handle_request(line, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            method = getattr(self, "rpc_" + str(request.get("method")), None)
+            if method is None:
+                raise ValueError("unknown method {!r}".format(request.get("method")))
+            params = dict(request.get("params") or {})
+            on_progress = None
+            if params.pop("progress", False):
+                on_progress = ProgressReporter(writer, request_id).update
+            self.running += 1
+            try:
+                result = await method(on_progress=on_progress, **params)
+            finally:
+                self.running -= 1
+            reply = {"id": request_id, "result": result}
+        except Exception as e:
+            reply = {"id": request_id, "error": "{}: {}".format(type(e).__name__, e)}
+        writer.write(json.dumps(reply).encode("utf8") + b"\n")
+        await writer.drain()
+
+    #
+    # methods
+    async def rpc_status(self, on_progress=None):
+        return {
+            "node_id": str(await self.node.net().node_id()),
+            "data_dir": self.data_dir,
+            "uptime": time.monotonic() - self.started,
+            "docs": len(self.store.known_docs()),
+            "running": self.running - 1,  # not counting this request
+            "transfers": self.scheduler.status(),
+        }
+
+    async def rpc_list(self, on_progress=None):
+        return [{"doc_id": doc_id, "role": role, "ticket": ticket, "bytes": size, "last_used": last_used}
+                for doc_id, role, ticket, size, last_used in self.store.known_docs()]
+
+    async def rpc_send(self, path, ingest="import", pack_threshold=None, compress=False, on_progress=None):
+        if ingest not in INGEST_MODES:
+            raise ValueError("unknown ingest mode {!r}".format(ingest))
+        if not os.path.isabs(path):
+            raise ValueError("path must be absolute, the daemon doesn't share the client's working folder")
+        store = self.store
+        doc = None
+        if os.path.isdir(path) and store.dir_doc(path):
+            doc = await self.node.docs().open(store.dir_doc(path))
+        created = doc is None
+        if created:
+            doc = await self.node.docs().create()
+        author = await store.author()
+        doc_id = doc.id()
+        try:
+            ticket = str(await doc.share(iroh.ShareMode.READ, iroh.AddrInfoOptions.RELAY_AND_ADDRESSES))
+            store.remember_doc(doc_id, "sent", ticket)
+            compressor = self.get_compressor() if compress else None
+            transfer = self.metrics.transfer("send")
+            transfer.describe(doc_id=doc_id)
+            with transfer.phase("share") as phase:
+                if os.path.isdir(path):
+                    store.remember_dir(path, doc_id)
+                    stats = await sync_dir(doc, author, path, DirIndex(store.db, doc_id), ingest, on_progress=on_progress,
+                                           pack_threshold=pack_threshold, compressor=compressor)
+                    size = stats.bytes
+                    summary = stats.summary()
+                else:
+                    if compressor is not None:
+                        await compressor.send_file(doc, author, path, None, on_progress, ingest)
+                    else:
+                        await send_file(doc, author, path, ingest, on_progress=on_progress)
+                    size = os.path.getsize(path)
+                    summary = "sent {}".format(os.path.basename(path))
+                phase.bytes = size
+        except BaseException:
+            # a doc nobody got a ticket for is of no use, don't keep it around
+            if created:
+                await self.node.docs().drop_doc(doc_id)
+                store.forget_doc(doc_id)
+            raise
+        store.add_doc_bytes(doc_id, size)
+        self.metrics.count("shared_bytes_total", size)
+        return {"doc_id": doc_id, "ticket": ticket, "bytes": size, "summary": summary}
+
+    async def rpc_receive(self, ticket, out_dir, timeout=DEFAULT_SYNC_TIMEOUT, priority="normal", on_progress=None):
+        if not os.path.isabs(out_dir):
+            raise ValueError("out_dir must be absolute, the daemon doesn't share the client's working folder")
+        store = self.store
+        metrics = self.metrics
+        transfer = metrics.transfer("receive")
+        # only the entries are synced, each blob is fetched inside its admission so the scheduler paces the fetching too
+        doc, watcher = await join_and_wait(self.node, ticket, timeout, download=False, transfer=transfer)
+        doc_id = doc.id()
+        transfer.describe(doc_id=doc_id)
+        store.remember_doc(doc_id, "joined", ticket)
+        resume = ResumeStats(await partial_blobs(self.node))
+        peers = list(watcher.peers.values())
+        await complete_reserved(self.node, doc, peers, resume)
+        scheduled = self.scheduler.transfer(doc_id, priority, next(iter(watcher.peers), None))
+        try:
+            result = await receive_doc(self.node, store, doc, out_dir, on_progress=on_progress,
+                                       ensure_local=metrics.time_fetch(lambda entry: complete_blob(self.node, entry, peers, resume)),
+                                       admit=lambda entry: scheduled.admit(entry.content_len()),
+                                       metrics=metrics, transfer=transfer, writer=self.writer)
+        finally:
+            self.scheduler.finish(scheduled)
+        return {
+            "doc_id": doc_id,
+            "synced": watcher.ready.is_set(),
+            "received": result.received + result.unpacked,
+            "bytes": result.bytes + result.unpacked_bytes,
+            "skipped": result.skipped,
+            "failed": [[key.decode("utf8", "replace"), str(error)] for key, error in result.failed],
+        }
+
+    async def rpc_metrics(self, format="json", on_progress=None):
+        # format: json (the snapshot) or prometheus (text)
+        if format == "json":
+            return self.metrics.snapshot()
+        elif format == "prometheus":
+            return self.metrics.prometheus()
+        raise ValueError("unknown format {!r}".format(format))
+
+    async def rpc_reprioritize(self, transfer, priority, on_progress=None):
+        # transfer is the scheduler id from status
+        self.scheduler.set_priority(transfer, priority)
+        return {"transfer": transfer, "priority": priority}
+
+    async def rpc_stop(self, on_progress=None):
+        # answer first, stop once the reply is out
+        asyncio.get_running_loop().call_soon(self.stopped.set)
+        return {"stopping": True}
+
+    def get_compressor(self):
+        if self.compressor is None:
+            self.compressor = Compressor()
+        return self.compressor
+
+
+class ProgressReporter:
+    # on_progress that streams progress lines back to the client, at most every PROGRESS_INTERVAL seconds
+    def __init__(self, writer, request_id):
+        self.writer = writer
+        self.request_id = request_id
+        self.last = 0.0
+
+    def update(self, key, done, total):
+        now = time.monotonic()
+        if now - self.last < PROGRESS_INTERVAL and done < total:
+            return
+        self.last = now
+        message = {"id": self.request_id, "progress": [key.rstrip(b"\0").decode("utf8", "replace"), done, total]}
+        self.writer.write(json.dumps(message).encode("utf8") + b"\n")
+
+
+async def run_daemon(data_dir=None, socket_path=None, max_active=DEFAULT_MAX_ACTIVE, rate=None, peer_rate=None):
+    daemon = Daemon(data_dir, socket_path, max_active, rate, peer_rate)
+    await daemon.serve_forever()
+
+
+def add_schedule_arguments(parser):
+    parser.add_argument('--max-active', type=int, default=DEFAULT_MAX_ACTIVE,
+                        help='entries received at the same time across all receives (urgent ones may use a few more)')
+    parser.add_argument('--rate-limit', type=int, default=None, help='bytes/second for all receives together')
+    parser.add_argument('--peer-rate-limit', type=int, default=None, help='bytes/second per remote node')
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Run one long lived node and take requests over a unix socket')
+    parser.add_argument('--data-dir', type=str, default=None, help='node data folder (default: ~/.fileflow)')
+    parser.add_argument('--socket', type=str, default=None, help='socket path (default: <data dir>/daemon.sock)')
+    add_schedule_arguments(parser)
+    args = parser.parse_args()
+    asyncio.run(run_daemon(args.data_dir, args.socket, args.max_active, args.rate_limit, args.peer_rate_limit))
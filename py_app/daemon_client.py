@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from py_app.priorities import PRIORITIES
+
+"""
+Talking to the daemon (daemon.py) from scripts and the command line.
+
+Deliberately light: no iroh, no asyncio, just a blocking unix socket, so a
+call costs about as much as starting python. One DaemonClient keeps its
+connection open for as many calls as you like.
+
+    python -m py_app.daemon_client start
+    python -m py_app.daemon_client send ./report.csv
+    python -m py_app.daemon_client receive <ticket> --out-dir ./in
+    python -m py_app.daemon_client stop
+"""
+
+PROGRESS_INTERVAL = 0.2  # seconds between progress lines from the daemon
+DEFAULT_START_TIMEOUT = 30.0  # seconds
+
+
+def default_socket_path(data_dir=None):
+    if data_dir is None:
+        data_dir = os.path.join(os.path.expanduser("~"), ".fileflow")
+    return os.path.join(data_dir, "daemon.sock")
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonClient:
+    def __init__(self, socket_path=None, timeout=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(self.socket_path)
+        self.file = self.sock.makefile("rb")
+        self.next_id = 0
+
+    def call(self, method, on_progress=None, **params):
+        # returns the result, raises DaemonError with the daemon's message if it failed
+        self.next_id += 1
+        if on_progress is not None:
+            params["progress"] = True
+        request = {"id": self.next_id, "method": method, "params": params}
+        self.sock.sendall(json.dumps(request).encode("utf8") + b"\n")
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise DaemonError("daemon closed the connection")
+            reply = json.loads(line)
+            if "progress" in reply:
+                if on_progress is not None:
+                    on_progress(*reply["progress"])
+                continue
+            if "error" in reply:
+                raise DaemonError(reply["error"])
+            return reply["result"]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_running(socket_path):
+    try:
+        with DaemonClient(socket_path, timeout=5) as client:
+            client.call("status")
+        return True
+    except (OSError, DaemonError):
+        return False
+
+
+def start_daemon(data_dir=None, socket_path=None, timeout=DEFAULT_START_TIMEOUT, options=()):
+    # start the daemon in the background and wait until it answers. returns the pid.
+    # options are passed on to the daemon (e.g. --rate-limit)
+    socket_path = socket_path or default_socket_path(data_dir)
+    command = [sys.executable, "-m", "py_app.daemon", "--socket", socket_path]
+    if data_dir:
+        command += ["--data-dir", data_dir]
+    command += list(options)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(command, cwd=root, stdin=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise DaemonError("daemon exited with {}".format(process.returncode))
+        if is_running(socket_path):
+            return process.pid
+        time.sleep(0.05)
+    process.kill()
+    raise DaemonError("daemon did not answer within {} seconds".format(timeout))
+
+
+def print_progress(name, done, total):
+    percent = 100 * done // total if total else 100
+    print("\r{}: {}/{} bytes ({}%)".format(name, done, total, percent), end="\n" if done >= total else "", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Send and receive through a running daemon')
+    parser.add_argument('--data-dir', type=str, default=None, help='data folder of the daemon (default: ~/.fileflow)')
+    parser.add_argument('--socket', type=str, default=None, help='socket path (default: <data dir>/daemon.sock)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    start = commands.add_parser('start', help='start the daemon in the background')
+    start.add_argument('options', nargs=argparse.REMAINDER,
+                       help='passed on to the daemon: --max-active N, --rate-limit BYTES/S, --peer-rate-limit BYTES/S')
+    commands.add_parser('stop', help='stop the daemon')
+    commands.add_parser('status', help='node id, uptime and what the daemon is doing')
+    commands.add_parser('list', help='docs the node knows about')
+    metrics = commands.add_parser('metrics', help='timings and counters of the transfers so far')
+    metrics.add_argument('--prometheus', action='store_true', help='print Prometheus text instead of json')
+    send = commands.add_parser('send', help='share a file or folder, prints the ticket')
+    send.add_argument('path')
+    send.add_argument('--ingest', default='import', help='import or set-bytes')
+    send.add_argument('--pack-threshold', type=int, default=None, help='pack files smaller than this (folders only)')
+    send.add_argument('--compress', action='store_true', help='compress files that shrink enough')
+    receive = commands.add_parser('receive', help='join a doc and write its files')
+    receive.add_argument('ticket')
+    receive.add_argument('--out-dir', default='.', help='folder to write to')
+    receive.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for the sync')
+    receive.add_argument('--priority', choices=list(PRIORITIES), default='normal', help='share of the link next to other receives')
+    reprioritize = commands.add_parser('reprioritize', help='change the priority of a running receive')
+    reprioritize.add_argument('transfer', type=int, help='its id, from status')
+    reprioritize.add_argument('priority', choices=list(PRIORITIES))
+    args = parser.parse_args(argv)
+
+    socket_path = args.socket or default_socket_path(args.data_dir)
+    if args.command == 'start':
+        if is_running(socket_path):
+            print("Daemon already running on {}".format(socket_path))
+            return 0
+        pid = start_daemon(args.data_dir, socket_path, options=args.options)
+        print("Daemon {} listening on {}".format(pid, socket_path))
+        return 0
+
+    try:
+        client = DaemonClient(socket_path)
+    except OSError as e:
+        print("No daemon on {} ({}), start one with: python -m py_app.daemon_client start".format(socket_path, e), file=sys.stderr)
+        return 1
+    with client:
+        try:
+            if args.command == 'send':
+                result = client.call('send', print_progress, path=os.path.abspath(args.path), ingest=args.ingest,
+                                     pack_threshold=args.pack_threshold, compress=args.compress)
+                print(result["summary"])
+                print(result["ticket"])
+            elif args.command == 'receive':
+                result = client.call('receive', print_progress, ticket=args.ticket, out_dir=os.path.abspath(args.out_dir),
+                                     timeout=args.timeout, priority=args.priority)
+                print("Received {} files ({} bytes), {} already on disk".format(len(result["received"]), result["bytes"], result["skipped"]))
+                for key, error in result["failed"]:
+                    print("Failed to receive {!r}: {}".format(key, error))
+            elif args.command == 'metrics' and args.prometheus:
+                print(client.call('metrics', format='prometheus'), end="")
+            elif args.command == 'reprioritize':
+                client.call('reprioritize', transfer=args.transfer, priority=args.priority)
+            else:
+                print(json.dumps(client.call(args.command), indent=2))
+        except DaemonError as e:
+            print(e, file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+# tests for the daemon client in daemon_client.py, against a stand in daemon
+import tempfile
+import threading
+import socket
+import json
+import os
+
+import pytest
+
+from py_app.daemon_client import DaemonClient, DaemonError, is_running
+
+
+def serve(path, ready):
+    # answers status, streams two progress lines for send, errors on anything else
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    ready.set()
+    conn, _ = server.accept()
+    with conn, conn.makefile("rwb") as f:
+        for line in f:
+            request = json.loads(line)
+            replies = []
+            if request["method"] == "status":
+                replies.append({"id": request["id"], "result": {"running": 0}})
+            elif request["method"] == "send":
+                if request["params"].get("progress"):
+                    replies += [{"id": request["id"], "progress": ["a", 1, 2]}, {"id": request["id"], "progress": ["a", 2, 2]}]
+                replies.append({"id": request["id"], "result": {"ticket": "t"}})
+            else:
+                replies.append({"id": request["id"], "error": "ValueError: unknown method"})
+            for reply in replies:
+                f.write(json.dumps(reply).encode() + b"\n")
+            f.flush()
+    server.close()
+
+
+def test_client_calls_and_progress():
+    dir = tempfile.TemporaryDirectory()
+    path = os.path.join(dir.name, "daemon.sock")
+    assert not is_running(path)
+    ready = threading.Event()
+    thread = threading.Thread(target=serve, args=(path, ready), daemon=True)
+    thread.start()
+    ready.wait(5)
+    progress = []
+    with DaemonClient(path, timeout=5) as client:
+        assert client.call("status") == {"running": 0}
+        assert client.call("send", lambda *p: progress.append(p), path="/x") == {"ticket": "t"}
+        assert progress == [("a", 1, 2), ("a", 2, 2)]
+        with pytest.raises(DaemonError):
+            client.call("nope")
+    thread.join(5)
@@ -0,0 +1,102 @@
+import os
+import shutil
+
+from py_app.receive import receive_entry, target_path, DEFAULT_CHUNK_SIZE
+
+"""
+Not fetching or writing content we already have on disk.
+
+Every file we write is remembered with the hash of its content (store.py,
+content table). When an entry comes in whose hash is already in a file
+somewhere, from this doc or any earlier one, that file is cloned instead:
+    - reflink (FICLONE, btrfs/xfs/...): instant, shares blocks until one
+      side is changed, so it is as safe as a copy
+    - hardlink, only if asked for (link=True): instant too, but both names
+      are then the same file, editing one edits the other
+    - copy: a local copy, still no network
+A file that was changed since we wrote it (size or mtime moved) is not used.
+
+Used as the receive hook of receive_all, with its ensure_local in front of
+the real one so content we have locally is never fetched.
+"""
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+
+
+def reflink(src, dst):
+    try:
+        import fcntl  # not on windows
+    except ImportError:
+        raise OSError("reflink is not supported here")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def materialize(src, dst, link=False):
+    # put the content of src at dst as cheaply as we can. returns how it was done
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp = dst + ".fileflow-tmp"
+    try:
+        if link:
+            try:
+                os.link(src, tmp)
+                os.replace(tmp, dst)
+                return "hardlink"
+            except OSError:
+                pass
+        try:
+            reflink(src, tmp)
+            os.replace(tmp, dst)
+            return "reflink"
+        except OSError:
+            pass
+        # copyfile uses copy_file_range/sendfile where it can, nothing goes through python
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+        return "copy"
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class DedupStats:
+    def __init__(self):
+        self.hits = 0
+        self.bytes = 0  # bytes that didn't have to be fetched or written from the blob store
+        self.methods = {}  # "reflink" / "hardlink" / "copy" -> count
+
+    def summary(self):
+        methods = ", ".join("{} {}".format(count, method) for method, count in sorted(self.methods.items()))
+        return "{} entries ({} bytes) were already on disk{}".format(self.hits, self.bytes, " ({})".format(methods) if methods else "")
+
+
+class DedupReceiver:
+    def __init__(self, store, receive=None, ensure_local=None, link=False):
+        self.store = store
+        self.inner_receive = receive or receive_entry
+        self.inner_ensure_local = ensure_local
+        self.link = link
+        self.stats = DedupStats()
+
+    async def ensure_local(self, entry):
+        # only fetch what isn't on disk already
+        if self.store.find_content(entry.content_hash().to_hex()) is not None:
+            return
+        if self.inner_ensure_local is not None:
+            await self.inner_ensure_local(entry)
+
+    async def receive(self, node, doc, entry, out_dir=".", mode="export", chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None,
+                      writer=None):
+        source = self.store.find_content(entry.content_hash().to_hex())
+        if source is None:
+            return await self.inner_receive(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer)
+        path = target_path(entry.key(), out_dir)
+        if os.path.abspath(path) != source:
+            method = materialize(source, path, self.link)
+            self.stats.methods[method] = self.stats.methods.get(method, 0) + 1
+        size = os.path.getsize(path)
+        self.stats.hits += 1
+        self.stats.bytes += size
+        if on_progress:
+            on_progress(entry.key(), size, size)
+        return path
@@ -0,0 +1,100 @@
+# tests for the receive side content dedup in dedup.py
+import tempfile
+import asyncio
+import os
+import sys
+
+from py_app.dedup import DedupReceiver, materialize
+from py_app.store import NodeStore
+
+
+class FakeHash:
+    def __init__(self, hex):
+        self.hex = hex
+
+    def to_hex(self):
+        return self.hex
+
+
+class FakeEntry:
+    def __init__(self, key, hex, size):
+        self._key = key
+        self._hash = FakeHash(hex)
+        self._size = size
+
+    def key(self):
+        return self._key
+
+    def content_hash(self):
+        return self._hash
+
+    def content_len(self):
+        return self._size
+
+
+def test_materialize_never_shares_a_file_unless_asked():
+    dir = tempfile.TemporaryDirectory()
+    src = os.path.join(dir.name, "src")
+    with open(src, "wb") as f:
+        f.write(b"content")
+    dst = os.path.join(dir.name, "sub", "dst")
+    assert materialize(src, dst) in ("reflink", "copy")
+    with open(dst, "ab") as f:
+        f.write(b" changed")
+    with open(src, "rb") as f:
+        assert f.read() == b"content"
+    assert materialize(src, os.path.join(dir.name, "linked"), link=True) == "hardlink"
+    assert os.path.samefile(src, os.path.join(dir.name, "linked"))
+
+
+def test_materialize_copies_without_fcntl(monkeypatch):
+    # as on windows, where there is no fcntl module
+    monkeypatch.setitem(sys.modules, "fcntl", None)
+    dir = tempfile.TemporaryDirectory()
+    src = os.path.join(dir.name, "src")
+    with open(src, "wb") as f:
+        f.write(b"content")
+    assert materialize(src, os.path.join(dir.name, "dst")) == "copy"
+    with open(os.path.join(dir.name, "dst"), "rb") as f:
+        assert f.read() == b"content"
+
+
+def test_duplicates_are_not_fetched():
+    data = tempfile.TemporaryDirectory()
+    out = tempfile.TemporaryDirectory()
+    store = NodeStore(data.name)
+    fetched, written = [], []
+
+    async def ensure_local(entry):
+        fetched.append(entry.key())
+
+    async def receive(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer=None):
+        path = os.path.join(out_dir, entry.key().decode())
+        with open(path, "wb") as f:
+            f.write(b"x" * entry.content_len())
+        written.append(entry.key())
+        return path
+
+    dedup = DedupReceiver(store, receive, ensure_local)
+
+    async def get(entry):
+        await dedup.ensure_local(entry)
+        path = await dedup.receive(None, None, entry, out.name)
+        store.mark_received("doc", entry, path)
+        return path
+
+    first = asyncio.run(get(FakeEntry(b"a", "h1", 10)))
+    copy = asyncio.run(get(FakeEntry(b"b", "h1", 10)))
+    other = asyncio.run(get(FakeEntry(b"c", "h2", 5)))
+    assert fetched == [b"a", b"c"] and written == [b"a", b"c"]
+    assert os.path.getsize(copy) == 10 and os.path.getsize(other) == 5
+    assert dedup.stats.hits == 1 and dedup.stats.bytes == 10
+    #
+    # a file changed after it was written no longer counts as holding its content
+    with open(first, "ab") as f:
+        f.write(b"more")
+    os.remove(copy)
+    assert store.find_content("h1") is None
+    asyncio.run(get(FakeEntry(b"d", "h1", 10)))
+    assert fetched[-1] == b"d"
+    store.close()
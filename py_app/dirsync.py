@@ -0,0 +1,286 @@
+import asyncio
+import os
+
+from py_app.send import send_file, file_key, DEFAULT_IN_PLACE_THRESHOLD
+from py_app.pack import Packer, DEFAULT_PACK_SIZE
+
+"""
+Sharing a folder, and keeping the share up to date on later runs.
+
+The folder is walked lazily with os.scandir, so a tree of a million files is
+never held in memory. Every file we shared is remembered in the files table
+of state.db (see store.py) with its size, mtime and content hash. A later run
+compares what scandir reports against that:
+    - same size and mtime: unchanged, nothing is read
+    - anything else: new or changed, imported again
+    - in the index but not seen this run: removed, a deletion marker is
+      written for its key so receivers drop it too
+So a re-sync of a big tree only stats every file and reads the ones that
+changed, it never rehashes the rest.
+
+With a pack_threshold, new or changed files smaller than it are packed
+together instead of getting an entry each (see pack.py). With a compressor
+the other files go through the codec stage (see codec.py).
+"""
+
+DEFAULT_PARALLEL = 4
+BATCH_SIZE = 1000  # index rows written per transaction
+
+
+class DirSyncStats:
+    def __init__(self):
+        self.scanned = 0
+        self.unchanged = 0
+        self.added = 0
+        self.changed = 0
+        self.deleted = 0
+        self.bytes = 0  # bytes imported this run
+        self.failed = []  # (path, exception)
+
+    def summary(self):
+        return "scanned {} files: {} added, {} changed, {} deleted, {} unchanged ({} bytes imported)".format(
+            self.scanned, self.added, self.changed, self.deleted, self.unchanged, self.bytes)
+
+
+def walk_files(root):
+    # every regular file under root with its stat, depth first. symlinks are not followed
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                for item in it:
+                    if item.is_dir(follow_symlinks=False):
+                        stack.append(item.path)
+                    elif item.is_file(follow_symlinks=False):
+                        yield item.path, item.stat(follow_symlinks=False)
+        except OSError:
+            # folder went away or can't be read, whatever was in it counts as removed
+            continue
+
+
+class DirIndex:
+    # the files table for one shared doc
+    def __init__(self, db, doc_id):
+        self.db = db
+        self.doc_id = doc_id
+
+    def generation(self):
+        # runs are numbered, rows touched by this run get its number in seen
+        row = self.db.execute("SELECT COALESCE(MAX(seen), 0) FROM files WHERE doc_id = ?", (self.doc_id,)).fetchone()
+        return row[0] + 1
+
+    def mark_unchanged(self, path, stat, generation):
+        # true if the file is in the index with the same size and mtime, in which case it is marked seen
+        cursor = self.db.execute(
+            "UPDATE files SET seen = ? WHERE doc_id = ? AND path = ? AND size = ? AND mtime_ns = ?",
+            (generation, self.doc_id, path, stat.st_size, stat.st_mtime_ns),
+        )
+        return cursor.rowcount > 0
+
+    def known(self, path):
+        return self.db.execute("SELECT 1 FROM files WHERE doc_id = ? AND path = ?", (self.doc_id, path)).fetchone() is not None
+
+    def record(self, path, key, stat, hash, generation):
+        self.db.execute(
+            "INSERT OR REPLACE INTO files (doc_id, path, key, size, mtime_ns, hash, seen) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.doc_id, path, key, stat.st_size, stat.st_mtime_ns, hash, generation),
+        )
+
+    def unseen(self, generation):
+        return self.db.execute("SELECT path, key FROM files WHERE doc_id = ? AND seen != ?", (self.doc_id, generation)).fetchall()
+
+    def forget(self, path):
+        self.db.execute("DELETE FROM files WHERE doc_id = ? AND path = ?", (self.doc_id, path))
+
+    def key_for(self, path):
+        row = self.db.execute("SELECT key FROM files WHERE doc_id = ? AND path = ?", (self.doc_id, path)).fetchone()
+        return row[0] if row else None
+
+    def under(self, folder):
+        # (path, key) of every indexed file inside folder
+        folder = folder.rstrip(os.sep) + os.sep
+        upper = folder[:-1] + chr(ord(os.sep) + 1)
+        return self.db.execute("SELECT path, key FROM files WHERE doc_id = ? AND path >= ? AND path < ?",
+                               (self.doc_id, folder, upper)).fetchall()
+
+
+class DirSharer:
+    # keeps one doc in step with one folder, either all at once (sync_dir) or
+    # a few paths at a time (sync_paths, used by watch.py)
+    def __init__(self, doc, author, root, index, mode="import", in_place_threshold=DEFAULT_IN_PLACE_THRESHOLD,
+                 parallel=DEFAULT_PARALLEL, on_progress=None, on_file=None, pack_threshold=None, pack_size=DEFAULT_PACK_SIZE,
+                 compressor=None):
+        self.doc = doc
+        self.author = author
+        self.root = os.path.abspath(root)
+        self.index = index
+        self.mode = mode
+        self.in_place_threshold = in_place_threshold
+        self.slots = asyncio.Semaphore(parallel)
+        self.on_progress = on_progress
+        self.on_file = on_file
+        if not os.path.isdir(self.root):
+            raise ValueError("{} is not a folder".format(self.root))
+        self.compressor = compressor  # codec.Compressor, files that aren't packed go through it
+        self.pack_threshold = pack_threshold
+        self.packer = None
+        self.packing = {}  # path -> new, files waiting for the packer
+        if pack_threshold is not None:
+            self.packer = Packer(doc, author, index.db, index.doc_id, self.root, pack_size)
+
+    async def share(self, path, stat, generation, stats):
+        new = not self.index.known(path)
+        if self.packer is not None:
+            was_packed = self.packer.drop(path)
+            if stat.st_size < self.pack_threshold:
+                if not new and not was_packed:
+                    # it used to be an entry of its own, from now on it lives in a pack
+                    await self.doc.delete(self.author, self.index.key_for(path))
+                self.packer.add(path, stat)
+                self.packing[path] = new
+                return
+        try:
+            if self.compressor is not None:
+                key = await self.compressor.send_file(self.doc, self.author, path, self.root, self.on_progress, self.mode,
+                                                      self.in_place_threshold)
+            else:
+                key = await send_file(self.doc, self.author, path, self.mode, self.root, self.in_place_threshold, self.on_progress)
+            entry = await self.doc.get_exact(self.author, key, False)
+            self.index.record(path, key, stat, entry.content_hash().to_hex(), generation)
+        except Exception as e:
+            stats.failed.append((path, e))
+            return
+        if new:
+            stats.added += 1
+        else:
+            stats.changed += 1
+        stats.bytes += stat.st_size
+        if self.on_file is not None:
+            self.on_file(path, key)
+
+    async def start_share(self, tasks, path, stat, generation, stats):
+        # the slot is taken before the task exists, so however big the tree at most parallel shares are pending
+        await self.slots.acquire()
+        task = asyncio.ensure_future(self.share_in_slot(path, stat, generation, stats))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def share_in_slot(self, path, stat, generation, stats):
+        try:
+            await self.share(path, stat, generation, stats)
+        finally:
+            self.slots.release()
+
+    async def delete(self, path, key, stats):
+        # path_to_key ends keys with \0, so deleting a key as a prefix only ever matches that one entry.
+        # for a packed file there is no entry, but the marker still tells followers to remove it
+        await self.doc.delete(self.author, key)
+        if self.packer is not None:
+            self.packer.drop(path)
+        self.index.forget(path)
+        stats.deleted += 1
+
+    async def flush_packs(self, generation, stats):
+        if self.packer is None:
+            return
+        try:
+            written = await self.packer.flush()
+        except Exception as e:
+            stats.failed += [(path, e) for path in self.packing]
+            self.packing = {}
+            return
+        for path, key, stat, pack_id in written:
+            self.index.record(path, key, stat, "pack/{}".format(pack_id), generation)
+            if self.packing.pop(path):
+                stats.added += 1
+            else:
+                stats.changed += 1
+            stats.bytes += stat.st_size
+            if self.on_file is not None:
+                self.on_file(path, key)
+
+    async def sync_dir(self):
+        # bring the doc up to date with the whole folder. returns a DirSyncStats
+        stats = DirSyncStats()
+        index = self.index
+        generation = index.generation()
+        tasks = set()
+        #
+        # walk the tree, only files whose size or mtime moved get imported
+        with index.db:
+            for path, stat in walk_files(self.root):
+                stats.scanned += 1
+                if index.mark_unchanged(path, stat, generation):
+                    stats.unchanged += 1
+                else:
+                    await self.start_share(tasks, path, stat, generation, stats)
+                if stats.scanned % BATCH_SIZE == 0:
+                    # commit as we go and let the imports run
+                    index.db.commit()
+                    await asyncio.sleep(0)
+            while tasks:
+                await asyncio.gather(*list(tasks))
+            await self.flush_packs(generation, stats)
+        #
+        # whatever the walk didn't see was removed
+        with index.db:
+            for path, key in index.unseen(generation):
+                if os.path.isfile(path) and file_key(path, self.root) == key:
+                    # the import of this file failed, keep the old entry
+                    continue
+                await self.delete(path, key, stats)
+            if self.packer is not None:
+                await self.packer.rewrite_dirty()
+        return stats
+
+    async def sync_paths(self, paths):
+        # like sync_dir, but only looks at paths. a path can be a file, a folder
+        # (everything in it is looked at) or something that no longer exists
+        stats = DirSyncStats()
+        index = self.index
+        generation = index.generation()
+        tasks = set()
+        with index.db:
+            for path in sorted(set(paths)):
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    stat = None
+                if stat is not None and os.path.isdir(path) and not os.path.islink(path):
+                    for file, file_stat in walk_files(path):
+                        stats.scanned += 1
+                        if index.mark_unchanged(file, file_stat, generation):
+                            stats.unchanged += 1
+                        else:
+                            await self.start_share(tasks, file, file_stat, generation, stats)
+                    # files the index has in there that are gone now
+                    for file, key in index.under(path):
+                        if not os.path.isfile(file):
+                            await self.delete(file, key, stats)
+                elif stat is not None and os.path.isfile(path) and not os.path.islink(path):
+                    stats.scanned += 1
+                    if index.mark_unchanged(path, stat, generation):
+                        stats.unchanged += 1
+                    else:
+                        await self.start_share(tasks, path, stat, generation, stats)
+                else:
+                    # removed, or replaced by something we don't share
+                    key = index.key_for(path)
+                    if key is not None:
+                        await self.delete(path, key, stats)
+                    for file, key in index.under(path):
+                        await self.delete(file, key, stats)
+            while tasks:
+                await asyncio.gather(*list(tasks))
+            await self.flush_packs(generation, stats)
+        return stats
+
+
+async def sync_dir(doc, author, root, index, mode="import", in_place_threshold=DEFAULT_IN_PLACE_THRESHOLD,
+                   parallel=DEFAULT_PARALLEL, on_progress=None, on_file=None, pack_threshold=None, pack_size=DEFAULT_PACK_SIZE,
+                   compressor=None):
+    # bring doc up to date with the folder at root. returns a DirSyncStats
+    sharer = DirSharer(doc, author, root, index, mode, in_place_threshold, parallel, on_progress, on_file,
+                       pack_threshold, pack_size, compressor)
+    return await sharer.sync_dir()
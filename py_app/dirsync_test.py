@@ -0,0 +1,182 @@
+# tests for the incremental folder share in dirsync.py
+import tempfile
+import asyncio
+import os
+
+from py_app import dirsync
+from py_app.dirsync import DirIndex, sync_dir
+from py_app.store import NodeStore
+
+
+class FakeHash:
+    def __init__(self, hex):
+        self.hex = hex
+
+    def to_hex(self):
+        return self.hex
+
+
+class FakeEntry:
+    def __init__(self, hex):
+        self._hash = FakeHash(hex)
+
+    def content_hash(self):
+        return self._hash
+
+
+class FakeDoc:
+    def __init__(self):
+        self.imported = []
+        self.deleted = []
+
+    async def get_exact(self, author, key, include_empty):
+        return FakeEntry("hash")
+
+    async def delete(self, author, key):
+        self.deleted.append(key)
+        return 1
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_sync_dir_only_sends_changes(monkeypatch):
+    doc = FakeDoc()
+
+    async def fake_send_file(doc, author, path, mode, root, in_place_threshold, on_progress):
+        doc.imported.append(os.path.relpath(path, root))
+        return dirsync.file_key(path, root)
+
+    monkeypatch.setattr(dirsync, "send_file", fake_send_file)
+    data = tempfile.TemporaryDirectory()
+    root = tempfile.TemporaryDirectory()
+    for name in ("a", "b", os.path.join("sub", "c"), os.path.join("sub", "deeper", "d")):
+        write(os.path.join(root.name, name), name.encode())
+    store = NodeStore(data.name)
+    index = DirIndex(store.db, "doc")
+    #
+    # first run shares everything
+    stats = asyncio.run(sync_dir(doc, "author", root.name, index))
+    assert sorted(doc.imported) == ["a", "b", os.path.join("sub", "c"), os.path.join("sub", "deeper", "d")]
+    assert (stats.scanned, stats.added, stats.changed, stats.deleted) == (4, 4, 0, 0)
+    #
+    # nothing changed, nothing is sent
+    doc.imported.clear()
+    stats = asyncio.run(sync_dir(doc, "author", root.name, index))
+    assert doc.imported == [] and stats.unchanged == 4
+    #
+    # one changed, one new, one removed
+    write(os.path.join(root.name, "a"), b"longer than before")
+    write(os.path.join(root.name, "e"), b"e")
+    os.remove(os.path.join(root.name, "sub", "c"))
+    stats = asyncio.run(sync_dir(doc, "author", root.name, index))
+    assert sorted(doc.imported) == ["a", "e"]
+    assert (stats.added, stats.changed, stats.deleted, stats.unchanged) == (1, 1, 1, 2)
+    assert doc.deleted == [dirsync.file_key(os.path.join(root.name, "sub", "c"), root.name)]
+    #
+    # the index outlives the store
+    store.close()
+    store = NodeStore(data.name)
+    doc.imported.clear()
+    stats = asyncio.run(sync_dir(doc, "author", root.name, DirIndex(store.db, "doc")))
+    assert doc.imported == [] and stats.unchanged == 4
+    store.close()
+
+
+def test_sync_paths_handles_files_folders_and_removals(monkeypatch):
+    doc = FakeDoc()
+
+    async def fake_send_file(doc, author, path, mode, root, in_place_threshold, on_progress):
+        doc.imported.append(os.path.relpath(path, root))
+        return dirsync.file_key(path, root)
+
+    monkeypatch.setattr(dirsync, "send_file", fake_send_file)
+    data = tempfile.TemporaryDirectory()
+    root = tempfile.TemporaryDirectory()
+    for name in ("a", os.path.join("sub", "b"), os.path.join("sub", "c")):
+        write(os.path.join(root.name, name), name.encode())
+    store = NodeStore(data.name)
+    sharer = dirsync.DirSharer(doc, "author", root.name, DirIndex(store.db, "doc"))
+    asyncio.run(sharer.sync_dir())
+    doc.imported.clear()
+    #
+    # a new file, an unchanged one, and a folder that was removed
+    write(os.path.join(root.name, "d"), b"d")
+    for name in ("b", "c"):
+        os.remove(os.path.join(root.name, "sub", name))
+    os.rmdir(os.path.join(root.name, "sub"))
+    paths = [os.path.join(root.name, name) for name in ("a", "d", "sub")]
+    stats = asyncio.run(sharer.sync_paths(paths))
+    assert doc.imported == ["d"]
+    assert (stats.added, stats.unchanged, stats.deleted) == (1, 1, 2)
+    assert sorted(doc.deleted) == sorted(dirsync.file_key(os.path.join(root.name, "sub", name), root.name) for name in ("b", "c"))
+    store.close()
+
+
+def test_small_files_go_into_packs(monkeypatch):
+    doc = FakeDoc()
+    doc.packs = {}
+
+    async def set_bytes(author, key, value):
+        doc.packs[key] = bytes(value)
+        return FakeHash("packhash")
+
+    async def fake_send_file(doc, author, path, mode, root, in_place_threshold, on_progress):
+        doc.imported.append(os.path.relpath(path, root))
+        return dirsync.file_key(path, root)
+
+    doc.set_bytes = set_bytes
+    monkeypatch.setattr(dirsync, "send_file", fake_send_file)
+    data = tempfile.TemporaryDirectory()
+    root = tempfile.TemporaryDirectory()
+    write(os.path.join(root.name, "big"), b"x" * 100)
+    for name in ("a", "b", "c"):
+        write(os.path.join(root.name, name), name.encode())
+    store = NodeStore(data.name)
+    index = DirIndex(store.db, "doc")
+    stats = asyncio.run(sync_dir(doc, "author", root.name, index, pack_threshold=10))
+    assert doc.imported == ["big"]
+    assert stats.added == 4
+    assert len(doc.packs) == 2  # one pack and its index
+    #
+    # removing a packed file leaves a deletion marker and an index without it
+    os.remove(os.path.join(root.name, "a"))
+    stats = asyncio.run(sync_dir(doc, "author", root.name, index, pack_threshold=10))
+    assert stats.deleted == 1 and stats.unchanged == 3
+    assert doc.deleted == [dirsync.file_key(os.path.join(root.name, "a"), root.name)]
+    store.close()
+
+
+def test_sync_dir_keeps_few_shares_pending(monkeypatch):
+    doc = FakeDoc()
+    pending = {"now": 0, "most": 0}
+
+    async def slow_send_file(doc, author, path, mode, root, in_place_threshold, on_progress):
+        await asyncio.sleep(0.001)
+        return dirsync.file_key(path, root)
+
+    real_share = dirsync.DirSharer.share
+
+    async def counted_share(self, *args):
+        pending["now"] += 1
+        pending["most"] = max(pending["most"], pending["now"])
+        try:
+            await real_share(self, *args)
+        finally:
+            pending["now"] -= 1
+
+    monkeypatch.setattr(dirsync, "send_file", slow_send_file)
+    monkeypatch.setattr(dirsync.DirSharer, "share", counted_share)
+    data = tempfile.TemporaryDirectory()
+    root = tempfile.TemporaryDirectory()
+    for i in range(50):
+        write(os.path.join(root.name, str(i)), b"x")
+    store = NodeStore(data.name)
+    stats = asyncio.run(sync_dir(doc, "author", root.name, DirIndex(store.db, "doc"), parallel=3))
+    assert stats.added == 50
+    # a task is only made once a slot is free, not one per file up front
+    assert pending["most"] == 3
+    store.close()
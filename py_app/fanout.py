@@ -0,0 +1,296 @@
+import iroh
+import asyncio
+import json
+import time
+
+from py_app.sync import SyncWatcher, join_and_wait, DEFAULT_SYNC_TIMEOUT
+from py_app.listing import iter_entries
+from py_app.pipeline import receive_doc
+from py_app.resume import ResumeStats, partial_blobs, complete_blob, complete_reserved
+
+"""
+Sending the same doc to many receivers at once.
+
+With one read ticket every receiver downloads everything from the origin,
+and the origin's uplink decides how long it takes for all of them. Here the
+receivers that are done serve the ones still waiting, so the number of
+sources grows as the distribution goes on.
+
+The receivers and the origin talk through a second doc, the roster, which
+the origin shares with write access (the fan-out ticket):
+
+    peer/<node id>     written by each receiver: its state (waiting,
+                       syncing, receiving, done, failed), entries synced
+                       and bytes received so far and, once done, a read
+                       ticket of the content doc that points at itself
+    assign/<node id>   written by the origin: which ticket to receive from
+
+FanOut (origin) watches the peer entries and hands each waiting receiver a
+source that has a free slot: the origin, or a receiver that is done, each
+serving at most max_serving receivers at a time. The rest wait until a slot
+frees up. A receiver that fails, or is not heard from for stall_timeout
+seconds, is assigned again (attempt goes up), if possible from another
+source. A receiver that reports done is taken as a source even if it was
+meanwhile assigned again, whatever slot it held is freed. The per receiver
+progress is in FanOut.peers.
+
+fan_out_receive (receiver) joins the roster, says it is waiting, receives
+the doc from whatever it is assigned, and announces itself as a source.
+It has to stay up afterwards to serve others. Like main.py --dedup it only
+syncs the entries and fetches each blob as it writes it (resume.py), so a
+sync that is slow to finish doesn't fail the attempt, what has arrived is
+received and the progress goes to the roster from the start of the sync.
+"""
+
+PEER_PREFIX = b"peer/"
+ASSIGN_PREFIX = b"assign/"
+DEFAULT_MAX_SERVING = 4
+POLL_INTERVAL = 0.5  # seconds between looks at the roster
+PROGRESS_INTERVAL = 1.0  # seconds between progress updates of a receiver
+DEFAULT_STALL_TIMEOUT = 120.0  # seconds without news from a receiver before its slot is given to another
+ORIGIN = "origin"
+
+
+async def read_json(node, entry):
+    # None while the entry's content hasn't arrived yet
+    if entry.content_len() == 0:
+        return None
+    try:
+        return json.loads(await node.blobs().read_to_bytes(entry.content_hash()))
+    except Exception:
+        return None
+
+
+async def write_json(doc, author, key, value):
+    await doc.set_bytes(author, key, json.dumps(value).encode("utf8"))
+
+
+class PeerState:
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.state = "waiting"
+        self.entries = 0  # synced, while syncing
+        self.bytes = 0
+        self.total = 0
+        self.ticket = None  # to receive from this peer, once it is done
+        self.source = None  # who it was assigned to
+        self.attempt = 0
+        self.tried = set()  # sources that failed it
+        self.started = None
+        self.finished = None
+        self.heard = time.monotonic()  # last time its report changed
+
+    def summary(self):
+        percent = 100 * self.bytes // self.total if self.total else 0
+        if self.state == "syncing":
+            line = "{}: syncing, {} entries".format(self.node_id[:10], self.entries)
+        else:
+            line = "{}: {} {}/{} bytes ({}%)".format(self.node_id[:10], self.state, self.bytes, self.total, percent)
+        if self.source is not None:
+            line += " from {}".format(self.source if self.source == ORIGIN else self.source[:10])
+        return line
+
+
+class FanOut:
+    # origin side, assigns sources to receivers. run() until cancelled
+    def __init__(self, node, roster, author, ticket, max_serving=DEFAULT_MAX_SERVING, on_update=None,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT):
+        if max_serving <= 0:
+            raise ValueError("max_serving must be positive")
+        self.node = node
+        self.roster = roster
+        self.author = author
+        self.ticket = ticket  # read ticket of the content doc, pointing at us
+        self.max_serving = max_serving
+        self.on_update = on_update  # on_update(PeerState) whenever a receiver changes
+        self.stall_timeout = stall_timeout
+        self.peers = {}  # node id -> PeerState
+        self.serving = {ORIGIN: 0}  # source -> receivers it is serving now
+
+    async def run(self, poll_interval=POLL_INTERVAL):
+        while True:
+            await self.poll()
+            await asyncio.sleep(poll_interval)
+
+    async def poll(self):
+        async for entry in iter_entries(self.roster, PEER_PREFIX):
+            report = await read_json(self.node, entry)
+            if report is not None:
+                self.update(entry.key()[len(PEER_PREFIX):].decode("utf8"), report)
+        await self.assign_waiting()
+
+    def update(self, node_id, report):
+        peer = self.peers.get(node_id)
+        if peer is None:
+            peer = self.peers[node_id] = PeerState(node_id)
+        if report.get("attempt", 0) < peer.attempt and not (report["state"] == "done" and report.get("ticket")):
+            # left over from an earlier attempt. unless it got everything after all, then it is done
+            # whatever it was assigned since, and the slot it holds now is freed below
+            return
+        changed = (report["state"], report.get("entries", 0), report.get("bytes", 0)) != (peer.state, peer.entries, peer.bytes)
+        if changed:
+            peer.heard = time.monotonic()
+        if report["state"] in ("done", "failed") and peer.state not in ("done", "failed") and peer.source is not None:
+            self.serving[peer.source] -= 1
+            peer.finished = time.monotonic()
+        if report["state"] == "failed" and peer.source is not None:
+            peer.tried.add(peer.source)
+        if report["state"] == "done" and report.get("ticket") and node_id not in self.serving:
+            # from now on it can serve others
+            peer.ticket = report["ticket"]
+            self.serving[node_id] = 0
+        peer.state = report["state"]
+        peer.entries = report.get("entries", 0)
+        peer.bytes = report.get("bytes", 0)
+        peer.total = report.get("total", 0)
+        if changed and self.on_update is not None:
+            self.on_update(peer)
+
+    def pick_source(self, peer):
+        # the least busy source with a free slot, receivers before the origin so its uplink is kept for the rest
+        free = [source for source, serving in self.serving.items()
+                if serving < self.max_serving and source != peer.node_id and source not in peer.tried]
+        if not free:
+            return None
+        return min(free, key=lambda source: (self.serving[source], source == ORIGIN))
+
+    async def assign_waiting(self):
+        now = time.monotonic()
+        for peer in self.peers.values():
+            if peer.state not in ("done", "failed") and peer.source is not None and now - peer.heard > self.stall_timeout:
+                # gone quiet, its slot goes to someone else
+                self.serving[peer.source] -= 1
+                peer.tried.add(peer.source)
+                peer.state = "failed"
+            if peer.state == "failed":
+                # give it another go from somewhere else
+                peer.state = "waiting"
+                peer.source = None
+            if peer.state != "waiting" or peer.source is not None:
+                continue
+            source = self.pick_source(peer)
+            if source is None:
+                if len(peer.tried) >= len(self.serving):
+                    # every source failed it once, start over
+                    peer.tried.clear()
+                continue
+            peer.source = source
+            peer.attempt += 1
+            peer.started = peer.heard = now
+            self.serving[source] += 1
+            ticket = self.ticket if source == ORIGIN else self.peers[source].ticket
+            await write_json(self.roster, self.author, ASSIGN_PREFIX + peer.node_id.encode("utf8"),
+                             {"source": source, "ticket": ticket, "attempt": peer.attempt})
+            if self.on_update is not None:
+                self.on_update(peer)
+
+    def summary(self):
+        done = [peer for peer in self.peers.values() if peer.state == "done"]
+        return "{} receivers, {} done, {} sources serving {}".format(
+            len(self.peers), len(done), len(self.serving), sum(self.serving.values()))
+
+
+class ProgressWriter:
+    # on_progress for receive_all that writes the receiver's progress to the roster now and then
+    def __init__(self, roster, author, key, attempt, interval=PROGRESS_INTERVAL):
+        self.roster = roster
+        self.author = author
+        self.key = key
+        self.attempt = attempt
+        self.interval = interval
+        self.done = {}
+        self.entries = 0
+        self.bytes = 0
+        self.total = 0
+        self.last = 0.0
+        self.writing = None  # a progress write still under way
+
+    def update(self, key, written, total):
+        if key not in self.done:
+            self.total += total
+        self.bytes += written - self.done.get(key, 0)
+        self.done[key] = written
+        now = time.monotonic()
+        if now - self.last >= self.interval and (self.writing is None or self.writing.done()):
+            self.last = now
+            self.writing = asyncio.ensure_future(self.write("receiving"))
+
+    async def write(self, state, **extra):
+        report = {"state": state, "entries": self.entries, "bytes": self.bytes, "total": self.total, "attempt": self.attempt}
+        report.update(extra)
+        await write_json(self.roster, self.author, self.key, report)
+
+    async def syncing(self, watcher):
+        # while the doc syncs, how many entries have arrived. runs until cancelled
+        while True:
+            self.entries = watcher.entries
+            await self.write("syncing")
+            await asyncio.sleep(self.interval)
+
+    async def finish(self, state, **extra):
+        # the last word, never overtaken by a progress write
+        if self.writing is not None:
+            await asyncio.gather(self.writing, return_exceptions=True)
+        await self.write(state, **extra)
+
+
+async def wait_assignment(node, roster, node_id, attempt, poll_interval=POLL_INTERVAL):
+    # the first assignment newer than attempt
+    key = ASSIGN_PREFIX + node_id.encode("utf8")
+    while True:
+        async for entry in iter_entries(roster, key):
+            if entry.key() == key:
+                assignment = await read_json(node, entry)
+                if assignment is not None and assignment["attempt"] > attempt:
+                    return assignment
+        await asyncio.sleep(poll_interval)
+
+
+async def fan_out_receive(node, store, roster_ticket, out_dir=".", timeout=DEFAULT_SYNC_TIMEOUT, on_progress=None,
+                          on_assigned=None, poll_interval=POLL_INTERVAL, writer=None):
+    # receive a fanned out doc into out_dir. returns (content doc, ReceiveResult) once we are a source for others
+    roster, _ = await join_and_wait(node, roster_ticket, timeout)
+    author = await store.author()
+    node_id = str(await node.net().node_id())
+    key = PEER_PREFIX + node_id.encode("utf8")
+    attempt = 0
+    await write_json(roster, author, key, {"state": "waiting", "attempt": attempt})
+    while True:
+        assignment = await wait_assignment(node, roster, node_id, attempt, poll_interval)
+        attempt = assignment["attempt"]
+        if on_assigned is not None:
+            on_assigned(assignment)
+        progress = ProgressWriter(roster, author, key, attempt)
+
+        def update(key, written, total):
+            progress.update(key, written, total)
+            if on_progress is not None:
+                on_progress(key, written, total)
+
+        try:
+            # only the entries are synced, blobs are fetched as they are written
+            watcher = SyncWatcher(content=False)
+            syncing = asyncio.ensure_future(progress.syncing(watcher))
+            try:
+                doc, watcher = await join_and_wait(node, assignment["ticket"], timeout, watcher, download=False)
+            finally:
+                syncing.cancel()
+                await asyncio.gather(syncing, return_exceptions=True)
+            # a sync that didn't finish in time still left us the entries it got, and peers to fetch from
+            doc_id = doc.id()
+            store.remember_doc(doc_id, "joined", assignment["ticket"])
+            await progress.write("receiving")
+            resume = ResumeStats(await partial_blobs(node))
+            peers = list(watcher.peers.values())
+            await complete_reserved(node, doc, peers, resume)
+            result = await receive_doc(node, store, doc, out_dir, on_progress=update,
+                                       ensure_local=lambda entry: complete_blob(node, entry, peers, resume), writer=writer)
+            if result.failed:
+                raise IOError("{} entries failed, the first: {!r}: {}".format(len(result.failed), *result.failed[0]))
+        except Exception as e:
+            await progress.finish("failed", error=str(e))
+            continue
+        # everything is here, now we can hand it on
+        ticket = await doc.share(iroh.ShareMode.READ, iroh.AddrInfoOptions.RELAY_AND_ADDRESSES)
+        await progress.finish("done", ticket=str(ticket))
+        return doc, result
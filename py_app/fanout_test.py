@@ -0,0 +1,170 @@
+# tests for assigning sources to receivers, and for the receiving side, in fanout.py
+import asyncio
+import json
+
+from py_app import fanout as fanout_module
+from py_app.fanout import FanOut, ORIGIN, fan_out_receive
+from py_app.pipeline import ReceiveResult
+
+
+class FakeRoster:
+    def __init__(self):
+        self.assigned = {}  # node id -> assignment, or report for a receiver
+        self.written = []  # (key, value) of every write, in order
+
+    async def set_bytes(self, author, key, value):
+        self.assigned[key.decode().split("/", 1)[1]] = json.loads(value)
+        self.written.append((key, json.loads(value)))
+
+
+class FakeNet:
+    async def node_id(self):
+        return "me"
+
+
+class FakeNode:
+    def net(self):
+        return FakeNet()
+
+
+class FakeStore:
+    def __init__(self):
+        self.docs = []
+
+    async def author(self):
+        return "author"
+
+    def remember_doc(self, doc_id, how, ticket):
+        self.docs.append((doc_id, how, ticket))
+
+
+class FakeDoc:
+    def __init__(self, ticket):
+        self.ticket = ticket
+
+    def id(self):
+        return "doc-" + self.ticket
+
+    async def share(self, mode, addr_options):
+        return "from-me"
+
+
+def test_done_receivers_serve_the_rest():
+    roster = FakeRoster()
+    fanout = FanOut(None, roster, None, "origin-ticket", max_serving=1)
+
+    async def step(reports):
+        for node_id, report in reports.items():
+            fanout.update(node_id, report)
+        await fanout.assign_waiting()
+
+    async def run():
+        await step({"a": {"state": "waiting"}, "b": {"state": "waiting"}, "c": {"state": "waiting"}})
+        # one slot at the origin, the others queue
+        assert roster.assigned == {"a": {"source": ORIGIN, "ticket": "origin-ticket", "attempt": 1}}
+        await step({"a": {"state": "done", "ticket": "a-ticket", "attempt": 1}})
+        # a serves one, the origin the other
+        assert roster.assigned["b"]["ticket"] == "a-ticket" and roster.assigned["c"]["source"] == ORIGIN
+        assert fanout.serving == {ORIGIN: 1, "a": 1}
+        # b fails on a, and gets another source once one is free
+        await step({"b": {"state": "failed", "attempt": 1}})
+        assert roster.assigned["b"]["attempt"] == 1 and fanout.serving == {ORIGIN: 1, "a": 0}
+        await step({"c": {"state": "done", "ticket": "c-ticket", "attempt": 1}})
+        assert roster.assigned["b"]["attempt"] == 2 and roster.assigned["b"]["source"] in (ORIGIN, "c")
+        # a late report from the failed attempt changes nothing
+        await step({"b": {"state": "receiving", "bytes": 5, "attempt": 1}})
+        assert fanout.peers["b"].bytes == 0
+
+    asyncio.run(run())
+    assert fanout.summary() == "3 receivers, 2 done, 3 sources serving 1"
+
+
+def test_quiet_receivers_lose_their_slot():
+    roster = FakeRoster()
+    fanout = FanOut(None, roster, None, "origin-ticket", max_serving=1, stall_timeout=0)
+
+    async def run():
+        fanout.update("a", {"state": "waiting"})
+        fanout.update("b", {"state": "waiting"})
+        await fanout.assign_waiting()
+        assert list(roster.assigned) == ["a"]
+        fanout.peers["a"].heard -= 1
+        await fanout.assign_waiting()
+
+    asyncio.run(run())
+    # the origin failed a once, b gets the slot and a waits for the next free source
+    assert roster.assigned["b"]["source"] == ORIGIN
+    assert fanout.peers["a"].source is None and fanout.peers["a"].state == "waiting"
+
+
+def test_late_done_counts_and_frees_the_new_slot():
+    roster = FakeRoster()
+    fanout = FanOut(None, roster, None, "origin-ticket", max_serving=2, stall_timeout=0)
+
+    async def run():
+        fanout.update("a", {"state": "waiting"})
+        await fanout.assign_waiting()
+        # a goes quiet and is assigned again
+        fanout.peers["a"].heard -= 1
+        await fanout.assign_waiting()
+        fanout.peers["a"].heard += 1
+        await fanout.assign_waiting()
+        assert roster.assigned["a"]["attempt"] == 2 and fanout.serving == {ORIGIN: 1}
+        # but the first attempt got through after all
+        fanout.update("a", {"state": "done", "ticket": "a-ticket", "attempt": 1})
+
+    asyncio.run(run())
+    assert fanout.peers["a"].state == "done" and fanout.peers["a"].ticket == "a-ticket"
+    assert fanout.serving == {ORIGIN: 0, "a": 0}
+
+
+def test_receiver_retries_until_done(monkeypatch):
+    roster = FakeRoster()
+    store = FakeStore()
+    assignments = [{"source": ORIGIN, "ticket": "a", "attempt": 1}, {"source": "b", "ticket": "b", "attempt": 2}]
+
+    async def join_and_wait(node, ticket, timeout, watcher=None, download=True):
+        if ticket == "roster-ticket":
+            return roster, None
+        assert not download and not watcher.content
+        # the entries come in while the sync runs, and the roster hears of them
+        watcher.entries = 3
+        await asyncio.sleep(0)
+        return FakeDoc(ticket), watcher
+
+    async def wait_assignment(node, roster, node_id, attempt, poll_interval):
+        assert node_id == "me" and assignments[0]["attempt"] > attempt
+        return assignments.pop(0)
+
+    async def receive_doc(node, store, doc, out_dir, on_progress=None, ensure_local=None, writer=None):
+        result = ReceiveResult()
+        if doc.ticket == "a":
+            result.failed.append(("x", IOError("source went away")))
+        else:
+            on_progress(b"x", 10, 10)
+        return result
+
+    async def nothing(*args):
+        return set()
+
+    monkeypatch.setattr(fanout_module, "join_and_wait", join_and_wait)
+    monkeypatch.setattr(fanout_module, "wait_assignment", wait_assignment)
+    monkeypatch.setattr(fanout_module, "receive_doc", receive_doc)
+    monkeypatch.setattr(fanout_module, "partial_blobs", nothing)
+    monkeypatch.setattr(fanout_module, "complete_reserved", nothing)
+
+    doc, result = asyncio.run(fan_out_receive(FakeNode(), store, "roster-ticket", poll_interval=0))
+    assert doc.ticket == "b" and not result.failed
+    assert store.docs == [("doc-a", "joined", "a"), ("doc-b", "joined", "b")]
+    reports = [value for key, value in roster.written]
+    assert all(key == b"peer/me" for key, value in roster.written)
+    assert [(report["state"], report["attempt"]) for report in reports] == [
+        ("waiting", 0),
+        ("syncing", 1), ("receiving", 1), ("failed", 1),
+        ("syncing", 2), ("receiving", 2), ("receiving", 2), ("done", 2),
+    ]
+    assert reports[1]["entries"] == 3
+    assert reports[3]["error"] == "1 entries failed, the first: 'x': source went away"
+    # the progress write is in before the last word, which carries the ticket others receive from
+    assert reports[6]["bytes"] == 10 and reports[6]["total"] == 10
+    assert reports[-1]["ticket"] == "from-me"
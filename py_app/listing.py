@@ -0,0 +1,51 @@
+from iroh import Query, QueryOptions, SortBy, SortDirection
+import asyncio
+
+"""
+Listing the entries of a doc a page at a time.
+
+doc.get_many(Query.all(None)) builds one list with every entry in it. Here we
+ask for page_size entries at a time using QueryOptions offset/limit, and
+fetch the next page in the background while the caller works on the current
+one.
+"""
+
+DEFAULT_PAGE_SIZE = 1000
+
+
+def page_query(prefix, offset, page_size, sort_by=SortBy.KEY_AUTHOR, direction=SortDirection.ASC):
+    opts = QueryOptions(sort_by=sort_by, direction=direction, offset=offset, limit=page_size)
+    if prefix:
+        return Query.key_prefix(prefix, opts)
+    return Query.all(opts)
+
+
+async def iter_pages(doc, prefix=None, page_size=DEFAULT_PAGE_SIZE, sort_by=SortBy.KEY_AUTHOR, direction=SortDirection.ASC):
+    # yields lists of up to page_size entries, optionally only keys starting with prefix
+    if page_size <= 0:
+        raise ValueError("page_size must be positive")
+    offset = 0
+    next_page = asyncio.ensure_future(doc.get_many(page_query(prefix, offset, page_size, sort_by, direction)))
+    try:
+        while True:
+            page = await next_page
+            next_page = None
+            if not page:
+                return
+            offset += len(page)
+            if len(page) == page_size:
+                # start on the next page before handing this one over
+                next_page = asyncio.ensure_future(doc.get_many(page_query(prefix, offset, page_size, sort_by, direction)))
+            yield page
+            if next_page is None:
+                return
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+async def iter_entries(doc, prefix=None, page_size=DEFAULT_PAGE_SIZE, sort_by=SortBy.KEY_AUTHOR, direction=SortDirection.ASC):
+    # same as iter_pages, one entry at a time
+    async for page in iter_pages(doc, prefix, page_size, sort_by, direction):
+        for entry in page:
+            yield entry
@@ -0,0 +1,38 @@
+# tests for the paged doc listing in listing.py
+from iroh import Iroh, NodeOptions
+import tempfile
+import asyncio
+import iroh
+
+from py_app.listing import iter_pages, iter_entries
+
+
+async def test_iter_pages():
+    # setup event loop, to ensure async callbacks work
+    iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+
+    #
+    # create node
+    dir = tempfile.TemporaryDirectory()
+    options = NodeOptions()
+    options.enable_docs = True
+    node = await Iroh.persistent_with_options(dir.name, options)
+    doc = await node.docs().create()
+    author = await node.authors().create()
+    #
+    # 25 entries under "a/", 5 under "b/"
+    for i in range(25):
+        await doc.set_bytes(author, "a/{:02}".format(i).encode(), b"a")
+    for i in range(5):
+        await doc.set_bytes(author, "b/{:02}".format(i).encode(), b"b")
+    #
+    # pages are full apart from the last one, and keys come back in order
+    pages = [page async for page in iter_pages(doc, page_size=10)]
+    assert [len(page) for page in pages] == [10, 10, 10]
+    keys = [entry.key() for page in pages for entry in page]
+    assert keys == sorted(keys)
+    #
+    # prefix filter
+    keys = [entry.key() async for entry in iter_entries(doc, b"a/", page_size=10)]
+    assert keys == ["a/{:02}".format(i).encode() for i in range(25)]
+    assert [entry.key() async for entry in iter_entries(doc, b"c/")] == []
@@ -4,80 +4,312 @@ import argparse
 import asyncio
 import tempfile
 import os
+import sys
 
+from py_app.receive import print_progress, DEFAULT_CHUNK_SIZE, RECEIVE_MODES
+from py_app.send import send_file, DEFAULT_IN_PLACE_THRESHOLD, INGEST_MODES
+from py_app.sync import join_and_wait, DEFAULT_SYNC_TIMEOUT
+from py_app.pipeline import receive_doc, TotalProgress, DEFAULT_MAX_ENTRIES, DEFAULT_MAX_BYTES, ORDERS
+from py_app.listing import iter_pages, DEFAULT_PAGE_SIZE
+from py_app.store import NodeStore
+from py_app.resume import ResumeStats, partial_blobs, complete_blob, complete_reserved
+from py_app.dirsync import DirIndex, sync_dir
+from py_app.watch import watch_dir, follow_doc, follow_subscribe, DEFAULT_DEBOUNCE
+from py_app.pack import is_reserved, DEFAULT_PACK_SIZE
+from py_app.codec import Compressor, CodecMap, DEFAULT_MIN_SPEED
+from py_app.dedup import DedupReceiver
+from py_app.verify import verify_entries, repair, default_workers
+from py_app.metrics import Metrics, NO_METRICS, serve_metrics
+from py_app.profiling import Profiler
+from py_app.fanout import FanOut, fan_out_receive, DEFAULT_MAX_SERVING
+from py_app.writer import ExportWriter, DEFAULT_THREADS, FSYNC_MODES
 
-async def main():
+
+async def main(argv=None, prog=None):
     # setup event loop, to ensure async callbacks work
     iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
 
     # parse arguments
-    parser = argparse.ArgumentParser(description='Python Iroh Node Demo')
+    parser = argparse.ArgumentParser(prog=prog, description='Python Iroh Node Demo')
     parser.add_argument('--ticket', type=str, help='ticket to join a document')
+    parser.add_argument('--file', type=str, default=os.path.join(os.path.dirname(__file__), 'flag.png'), help='file to share')
+    parser.add_argument('--dir', type=str, default=None,
+                        help='share a whole folder instead of --file. With --data-dir, later runs only send what changed')
+    parser.add_argument('--watch', action='store_true', help='with --dir, keep running and send changes to the folder as they happen')
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE,
+                        help='seconds of quiet after a change before --watch sends it')
+    parser.add_argument('--pack-threshold', type=int, default=None,
+                        help='with --dir, files smaller than this many bytes are sent together in packs of about --pack-size')
+    parser.add_argument('--pack-size', type=int, default=DEFAULT_PACK_SIZE, help='target size in bytes of one pack')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress files that shrink enough (zstd if installed, else zlib), receivers decompress them')
+    parser.add_argument('--compress-min-speed', type=int, default=DEFAULT_MIN_SPEED,
+                        help='bytes/second a codec has to manage on this machine to be used, set it near the link speed')
+    parser.add_argument('--dedup', action='store_true',
+                        help='with --data-dir, content already on disk from any earlier receive is copied locally instead of fetched')
+    parser.add_argument('--dedup-hardlink', action='store_true',
+                        help='with --dedup, hardlink duplicates when they can\'t be reflinked (both names are then the same file)')
+    parser.add_argument('--verify', action='store_true',
+                        help='after receiving, hash every written file against its entry and receive the bad ones again (needs blake3)')
+    parser.add_argument('--verify-workers', type=int, default=default_workers(), help='processes hashing files for --verify')
+    parser.add_argument('--fan-out', action='store_true',
+                        help='sending to many receivers: receivers that are done serve the others, see fanout.py')
+    parser.add_argument('--max-serving', type=int, default=DEFAULT_MAX_SERVING,
+                        help='with --fan-out, receivers served at the same time by us and by each receiver that is done')
+    parser.add_argument('--fan-out-ticket', type=str, default=None, help='receive from a --fan-out sender with this ticket')
+    parser.add_argument('--follow', action='store_true', help='with --ticket, keep running and write new entries as they arrive')
+    parser.add_argument('--ingest', choices=INGEST_MODES, default='import',
+                        help='import: iroh reads the file itself, set-bytes: memory map the file and pass it to set_bytes')
+    parser.add_argument('--in-place-threshold', type=int, default=DEFAULT_IN_PLACE_THRESHOLD,
+                        help='files this size or bigger are shared in place instead of copied into the blob store')
+    parser.add_argument('--out-dir', type=str, default='.', help='folder received files are written to')
+    parser.add_argument('--receive-mode', choices=RECEIVE_MODES, default='export',
+                        help='export: iroh writes each entry to disk, chunked: copy entries in --chunk-size pieces')
+    parser.add_argument('--sync-timeout', type=float, default=DEFAULT_SYNC_TIMEOUT,
+                        help='seconds to wait for the doc and its content to sync before reading what is there')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='buffer size in bytes for --receive-mode chunked')
+    parser.add_argument('--write-threads', type=int, default=DEFAULT_THREADS,
+                        help='threads writing chunked, decompressed and unpacked files to disk')
+    parser.add_argument('--fsync', choices=FSYNC_MODES, default='none',
+                        help='sync written files to disk: never (none), a batch at a time (batch) or each before it is renamed (each)')
+    parser.add_argument('--parallel', type=int, default=DEFAULT_MAX_ENTRIES, help='number of entries received at the same time')
+    parser.add_argument('--max-inflight-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help='cap on the combined size of the entries being received at the same time')
+    parser.add_argument('--order', choices=ORDERS, default='none', help='receive large or small entries first (within each page)')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help='number of entries listed from the doc at a time')
+    parser.add_argument('--prefix', type=str, default=None, help='only receive entries whose key starts with this')
+    parser.add_argument('--data-dir', type=str, default=None,
+                        help='keep the node key, author, docs and blobs here between runs (default: a temporary folder)')
+    parser.add_argument('--metrics-log', type=str, default=None,
+                        help='append one json line per transfer phase (startup, join, sync, receive, ...) to this file')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve metrics on 127.0.0.1:PORT, /metrics for Prometheus, /metrics.json for a snapshot')
+    parser.add_argument('--profile', type=str, default=None, metavar='DIR',
+                        help='profile cpu and memory use of the whole run, write the profiles and a summary.txt to DIR')
+    parser.add_argument('--gc-max-bytes', type=int, default=None,
+                        help='after receiving, drop the least recently used docs until the store is under this size')
+
+    args = parser.parse_args(argv)
+    if args.watch and not args.dir:
+        parser.error("--watch needs --dir")
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile)
+        profiler.start()
+    # everything that writes files a piece at a time goes through this one
+    writer = ExportWriter(args.write_threads, fsync=args.fsync)
+    try:
+        await run(args, writer)
+    finally:
+        # also when --watch or --follow are stopped with ctrl-c
+        await writer.close()
+        if profiler is not None:
+            print("Profile written to {}, see {}".format(args.profile, profiler.stop()))
+
+    # keeps a console window open when started by double click, but never holds up irohui in a script or a pipe
+    if sys.stdin.isatty():
+        input("Press Enter to exit...")
+
 
-    args = parser.parse_args()
+async def run(args, writer):
+    # metrics cost nothing unless asked for
+    metrics = NO_METRICS
+    log = open(args.metrics_log, "a") if args.metrics_log else None
+    server = None
+    compressor = None
+    try:
+        if args.compress and not (args.ticket or args.fan_out_ticket):
+            # sending only, its process pool and temporary folder go away with it
+            compressor = Compressor(min_speed=args.compress_min_speed)
+        if args.metrics_log is not None or args.metrics_port is not None:
+            metrics = Metrics(log)
+        if args.metrics_port is not None:
+            server = await serve_metrics(metrics, port=args.metrics_port)
+            print("Metrics on http://127.0.0.1:{}/metrics".format(args.metrics_port))
+        await run_transfer(args, metrics, writer, compressor)
+    finally:
+        if compressor is not None:
+            compressor.close()
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        if log is not None:
+            log.close()
 
-    # create iroh node
-    dir = tempfile.TemporaryDirectory()
-    options = iroh.NodeOptions()
-    options.enable_docs = True
-    node = await Iroh.persistent_with_options(dir.name, options)
+
+async def run_transfer(args, metrics, writer, compressor):
+    transfer = metrics.transfer("receive" if args.ticket else "send")
+
+    # create iroh node, reusing its key, author, docs and blobs if --data-dir was used before
+    store = NodeStore(args.data_dir, gc=args.gc_max_bytes is not None)
+    with transfer.phase("startup"):
+        node = await store.open()
     node_id = await node.net().node_id()
     print("Started Iroh node: {}".format(node_id))
 
-    if not args.ticket:
+    if args.fan_out_ticket:
+        # the fan-out sender tells us who to receive from, once we have everything we serve others
+        def on_assigned(assignment):
+            print("Receiving from {}".format(assignment["source"]))
+
+        progress = TotalProgress()
+        with transfer.phase("receive"):
+            doc, result = await fan_out_receive(node, store, args.fan_out_ticket, args.out_dir, args.sync_timeout,
+                                                progress.update, on_assigned, writer=writer)
+        print()
+        print("Received {} entries ({} bytes), {} already on disk".format(len(result.received), result.bytes, result.skipped))
+        print("Serving {} to other receivers, keep this running".format(doc.id()))
+    elif not args.ticket:
         print("In example mode")
         print("(To run the sync demo, please provide a ticket to join a document)")
         print()
 
-        # create doc
-        doc = await node.docs().create()
-        author = await node.authors().create()
+        # create doc, a folder shared before goes back into the doc it was shared in
+        doc = None
+        if args.dir and store.dir_doc(args.dir):
+            doc = await node.docs().open(store.dir_doc(args.dir))
+        if doc is None:
+            doc = await node.docs().create()
+        author = await store.author()
         doc_id = doc.id()
         # create ticket to share doc
         ticket = await doc.share(iroh.ShareMode.READ, iroh.AddrInfoOptions.RELAY_AND_ADDRESSES)
+        store.remember_doc(doc_id, "sent", str(ticket))
+        transfer.describe(doc_id=doc_id)
 
         # add data to doc
-        #file_name = input("Enter file name with file extention (file must be in same folder as main): ")
-        file_path = "C:/Users/aaron/OneDrive/Documents/Programming/Rust/SendmeInterface/py_app/flag.png"
-        file_name = os.path.basename(file_path)
-        
-        #print(file_name)
-        with open(file_path, "rb") as f:
-            bytes = bytearray(f.read())
-        await doc.set_bytes(author, file_name.encode('utf-8'), bytes)
+        with transfer.phase("share") as phase:
+            if args.dir:
+                store.remember_dir(args.dir, doc_id)
+                stats = await sync_dir(doc, author, args.dir, DirIndex(store.db, doc_id), args.ingest, args.in_place_threshold,
+                                       pack_threshold=args.pack_threshold, pack_size=args.pack_size, compressor=compressor)
+                shared = stats.bytes
+                print("Shared {}: {}".format(args.dir, stats.summary()))
+                for path, error in stats.failed:
+                    print("Failed to share {}: {}".format(path, error))
+            elif compressor is not None:
+                await compressor.send_file(doc, author, args.file, None, print_progress, args.ingest, args.in_place_threshold)
+                shared = os.path.getsize(args.file)
+            else:
+                await send_file(doc, author, args.file, args.ingest, None, args.in_place_threshold, print_progress)
+                shared = os.path.getsize(args.file)
+            phase.bytes = shared
+        store.add_doc_bytes(doc_id, shared)
+        metrics.count("shared_bytes_total", shared)
+        if compressor is not None:
+            print("Compression: {}".format(compressor.summary()))
         print("Created doc: {}".format(doc_id))
-        print("Keep this running and in another terminal run:\n\npython main.py --ticket {}".format(ticket))
+        running = []
+        if args.fan_out:
+            # receivers meet in a second doc they can all write to
+            roster = await node.docs().create()
+            roster_ticket = await roster.share(iroh.ShareMode.WRITE, iroh.AddrInfoOptions.RELAY_AND_ADDRESSES)
+            fanout = FanOut(node, roster, author, str(ticket), args.max_serving, on_update=lambda peer: print(peer.summary()))
+            print("Keep this running and on every receiver run:\n\npython -m py_app.main --fan-out-ticket {}".format(roster_ticket))
+            running.append(fanout.run())
+        else:
+            print("Keep this running and in another terminal run:\n\npython -m py_app.main --ticket {}".format(ticket))
+
+        if args.watch:
+            print("Watching {} for changes (ctrl-c to stop)".format(args.dir))
+            def on_batch(stats):
+                if stats.added or stats.changed or stats.deleted:
+                    store.add_doc_bytes(doc_id, stats.bytes)
+                    print("{}: {}".format(args.dir, stats.summary()))
+
+            running.append(watch_dir(doc, author, args.dir, DirIndex(store.db, doc_id), args.ingest, args.in_place_threshold,
+                                     debounce=args.debounce, on_batch=on_batch, pack_threshold=args.pack_threshold,
+                                     pack_size=args.pack_size, compressor=compressor))
+        await asyncio.gather(*running)
     else:
-        # join doc
-        doc_ticket = iroh.DocTicket(args.ticket)
-        doc = await node.docs().join(doc_ticket)
+        # join doc and wait for the remote's entries and content to arrive
+        # with --dedup only entries are synced, blobs are fetched below for what isn't on disk yet
+        doc, watcher = await join_and_wait(node, args.ticket, args.sync_timeout, download=not args.dedup,
+                                           transfer=transfer)
         doc_id = doc.id()
+        # entries that arrive while the receive below runs are queued for --follow
+        # with --dedup nothing downloads on its own, follow_doc fetches each entry itself
+        follower = await follow_subscribe(doc, content=not args.dedup) if args.follow else None
+        transfer.describe(doc_id=doc_id)
         print("Joined doc: {}".format(doc_id))
+        store.remember_doc(doc_id, "joined", args.ticket)
+        if not watcher.ready.is_set():
+            print("Sync did not finish within {} seconds, receiving what has arrived so far".format(args.sync_timeout))
+        elif watcher.pending and not args.dedup:
+            print("{} blobs could not be downloaded".format(len(watcher.pending)))
 
-        # sync & print
-        print("Waiting 2 seconds to let stuff sync...")
-        await asyncio.sleep(2)
+        # anything left over from an interrupted run only needs its missing ranges fetched
+        resume = ResumeStats(await partial_blobs(node))
+        peers = list(watcher.peers.values())
 
-        # query all keys
-        query = iroh.Query.all(None)
-        keys = await doc.get_many(query)
-        #print(keys[0])
-        #print(dir(keys[0]))
+        # list the doc a page at a time, receiving each page while the next is fetched
+        prefix = args.prefix.encode('utf-8') if args.prefix else None
+        pages = iter_pages(doc, prefix, args.page_size)
         print("Data:")
-        for entry in keys:
-            # get key, hash, and content for each entry
-            key = entry.key()
-            
-            hash = entry.content_hash()
-            content = await node.blobs().read_to_bytes(entry.content_hash())
-            #print("{}, {} (hash: {})".format(key.decode("utf8"),content.decode("utf8"), hash))
-            #copy_path = f"copy_of_{}".format(key.decode("utf8"))
-            copy_path = f"copy_of_{key.decode('utf8')}"
-            with open(copy_path, "wb") as file:
-                file.write(content)
-
-
-    input("Press Enter to exit...")
+        progress = TotalProgress()
+        if args.dedup:
+            # nothing was downloaded on its own
+            await complete_reserved(node, doc, peers, resume)
+        # compressed entries are decompressed on the way to disk, and are their original size once there
+        codecs = await CodecMap().load(node, doc)
+        receive = codecs.receive
+        ensure_local = metrics.time_fetch(lambda entry: complete_blob(node, entry, peers, resume))
+        dedup = None
+        if args.dedup:
+            dedup = DedupReceiver(store, receive, ensure_local, link=args.dedup_hardlink)
+            receive, ensure_local = dedup.receive, dedup.ensure_local
+        result = await receive_doc(node, store, doc, args.out_dir, pages, args.receive_mode, args.chunk_size,
+                                   args.parallel, args.max_inflight_bytes, args.order, progress.update,
+                                   codecs=codecs, receive=receive, ensure_local=ensure_local, metrics=metrics, transfer=transfer,
+                                   writer=writer)
+        print()
+        print("Received {} entries ({} bytes), {} already on disk".format(len(result.received), result.bytes, result.skipped))
+        if result.unpacked:
+            print("Unpacked {} small files ({} bytes)".format(len(result.unpacked), result.unpacked_bytes))
+        print(resume.summary().capitalize())
+        if dedup is not None:
+            print(dedup.stats.summary().capitalize())
+        for key, error in result.failed:
+            print("Failed to receive {!r}: {}".format(key, error))
+
+        if args.verify:
+            # every file of the doc is checked, also those received by earlier runs
+            with transfer.phase("verify") as phase:
+                checked = await verify_entries(iter_pages(doc, prefix, args.page_size), args.out_dir, args.verify_workers,
+                                               skip=lambda entry: is_reserved(entry.key()) or entry.content_len() == 0 or codecs.is_compressed(entry))
+                phase.bytes = checked.bytes
+            print("Verify: {}".format(checked.summary()))
+            if checked.bad:
+                for entry, path, reason in checked.bad:
+                    print("{}: {}".format(path, reason))
+                repaired, still_bad = await repair(node, doc, checked, args.out_dir, args.receive_mode, args.chunk_size,
+                                                   args.verify_workers, ensure_local=lambda entry: complete_blob(node, entry, peers, resume),
+                                                   receive=codecs.receive,
+                                                   on_received=lambda entry, path: store.mark_received(doc_id, entry, path),
+                                                   writer=writer)
+                print("Received {} entries again, {} still bad".format(len(repaired.received), len(still_bad.bad)))
+                for key, error in repaired.failed:
+                    print("Failed to receive {!r}: {}".format(key, error))
+
+        if args.gc_max_bytes is not None:
+            dropped = await store.collect_garbage(args.gc_max_bytes, keep={doc_id})
+            if dropped:
+                print("Dropped {} old docs to stay under {} bytes".format(len(dropped), args.gc_max_bytes))
+
+        if args.follow:
+            print("Following {} (ctrl-c to stop)".format(doc_id))
+            def on_received(entry, path):
+                store.mark_received(doc_id, entry, path)
+                print("received {}".format(path))
+
+            await follow_doc(node, doc, args.out_dir, args.receive_mode, on_received=on_received,
+                             on_removed=lambda entry, path: print("removed {}".format(path)),
+                             on_failed=lambda entry, error: print("Failed to receive {!r}: {}".format(entry.key(), error)),
+                             codecs=codecs, follower=follower,
+                             skip=lambda entry: store.is_received(doc_id, codecs.as_written(entry), args.out_dir),
+                             writer=writer, ensure_local=ensure_local, receive=receive)
+
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,276 @@
+import asyncio
+import bisect
+import itertools
+import json
+import time
+
+"""
+Where the time of a transfer goes.
+
+A Metrics object keeps
+    - phases: every transfer (one send, one receive) is timed phase by phase,
+      startup, join, sync, receive, unpack, share, verify, ... Each phase
+      that ends is added to the phase_seconds histogram and written to the
+      log.
+    - counters: bytes and entries fetched, written, sent
+    - histograms: per entry fetch and write latency (these overlap inside
+      the receive phase, they are not phases of their own), entry sizes,
+      throughput of phases that moved bytes
+
+and can hand them out as a json snapshot (snapshot()), as Prometheus text
+(prometheus()), over http (serve_metrics, GET /metrics or /metrics.json) and
+as one json line per event in a log file.
+
+Turned off, NO_METRICS is used instead: its methods do nothing and the hooks
+it is asked to time are returned as they are, so nothing is measured and
+nothing is wrapped.
+
+    metrics = Metrics(log=open("transfer.jsonl", "a"))
+    transfer = metrics.transfer("receive")
+    with transfer.phase("sync"):
+        ...
+    with transfer.phase("receive") as phase:
+        phase.bytes = await receive_everything()
+"""
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)  # seconds
+SIZE_BUCKETS = tuple(4 ** n for n in range(5, 17))  # 1 KiB .. 4 GiB
+THROUGHPUT_BUCKETS = tuple(1024 * 1024 * 2 ** n for n in range(0, 14))  # 1 MiB/s .. 8 GiB/s
+BUCKETS = {
+    "phase_seconds": LATENCY_BUCKETS,
+    "fetch_seconds": LATENCY_BUCKETS,
+    "write_seconds": LATENCY_BUCKETS,
+    "entry_bytes": SIZE_BUCKETS,
+    "throughput_bytes_per_second": THROUGHPUT_BUCKETS,
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+
+class Phase:
+    def __init__(self, transfer, name):
+        self.transfer = transfer
+        self.name = name
+        self.start = None
+        self.end = None
+        self.bytes = 0  # set while in the phase to get its throughput
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        self.end = time.monotonic()
+        self.transfer.phase_done(self, error)
+
+
+class Transfer:
+    def __init__(self, metrics, id, kind):
+        self.metrics = metrics
+        self.id = id
+        self.kind = kind
+        self.started = time.time()
+        self.info = {}  # e.g. the doc id, once it is known
+        self.phases = []  # (name, seconds, bytes)
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def describe(self, **info):
+        self.info.update(info)
+        self.metrics.log_event("transfer", transfer=self.id, kind=self.kind, **info)
+
+    def phase_done(self, phase, error=None):
+        seconds = phase.end - phase.start
+        self.phases.append((phase.name, seconds, phase.bytes))
+        metrics = self.metrics
+        metrics.observe("phase_seconds", seconds, kind=self.kind, phase=phase.name)
+        if phase.bytes and seconds > 0:
+            metrics.observe("throughput_bytes_per_second", phase.bytes / seconds, kind=self.kind, phase=phase.name)
+        metrics.log_event("phase", transfer=self.id, kind=self.kind, phase=phase.name, seconds=seconds, bytes=phase.bytes,
+                          error=None if error is None else "{}: {}".format(type(error).__name__, error))
+
+    def snapshot(self):
+        return {"id": self.id, "kind": self.kind, "started": self.started, "info": self.info,
+                "phases": [{"phase": name, "seconds": seconds, "bytes": size} for name, seconds, size in self.phases]}
+
+
+class Metrics:
+    enabled = True
+
+    def __init__(self, log=None, keep_transfers=100):
+        self.log = log  # text file, one json object per line
+        self.keep_transfers = keep_transfers
+        self.counters = {}  # (name, labels) -> number
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.transfers = []  # the last keep_transfers of them
+        self.ids = itertools.count(1)
+
+    def transfer(self, kind):
+        transfer = Transfer(self, next(self.ids), kind)
+        self.transfers.append(transfer)
+        del self.transfers[:-self.keep_transfers]
+        self.log_event("transfer", transfer=transfer.id, kind=kind)
+        return transfer
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(BUCKETS.get(name, LATENCY_BUCKETS))
+        histogram.observe(value)
+
+    def log_event(self, event, **fields):
+        if self.log is None:
+            return
+        fields["event"] = event
+        fields["time"] = time.time()
+        self.log.write(json.dumps(fields) + "\n")
+        self.log.flush()
+
+    #
+    # hooks for receive_all (see pipeline.py)
+    def time_fetch(self, ensure_local):
+        # ensure_local that records how long getting each blob into the store took
+        async def timed(entry):
+            start = time.monotonic()
+            await ensure_local(entry)
+            self.observe("fetch_seconds", time.monotonic() - start)
+            self.count("fetched_entries_total")
+        return timed
+
+    def time_write(self, receive):
+        # receive that records how long writing each entry to disk took, and how big it was
+        async def timed(node, doc, entry, *args):
+            start = time.monotonic()
+            path = await receive(node, doc, entry, *args)
+            self.observe("write_seconds", time.monotonic() - start)
+            self.observe("entry_bytes", entry.content_len())
+            self.count("written_entries_total")
+            self.count("written_bytes_total", entry.content_len())
+            return path
+        return timed
+
+    #
+    # output
+    def snapshot(self):
+        return {
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(self.counters.items())],
+            "histograms": [dict(histogram.snapshot(), name=name, labels=dict(labels))
+                           for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])],
+            "transfers": [transfer.snapshot() for transfer in self.transfers],
+        }
+
+    def prometheus(self, prefix="fileflow_"):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append("{}{}{} {}".format(prefix, name, format_labels(labels), value))
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            total = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                total += count
+                lines.append("{}{}_bucket{} {}".format(prefix, name, format_labels(labels + (("le", bound),)), total))
+            lines.append("{}{}_sum{} {}".format(prefix, name, format_labels(labels), histogram.sum))
+            lines.append("{}{}_count{} {}".format(prefix, name, format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels) + "}"
+
+
+class NullPhase:
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+class NullTransfer:
+    def phase(self, name):
+        return NULL_PHASE
+
+    def describe(self, **info):
+        pass
+
+
+class NullMetrics:
+    # what is used when metrics are off
+    enabled = False
+
+    def transfer(self, kind):
+        return NULL_TRANSFER
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def log_event(self, event, **fields):
+        pass
+
+    def time_fetch(self, ensure_local):
+        return ensure_local
+
+    def time_write(self, receive):
+        return receive
+
+
+NULL_PHASE = NullPhase()
+NULL_TRANSFER = NullTransfer()
+NO_METRICS = NullMetrics()
+
+
+async def serve_metrics(metrics, host="127.0.0.1", port=9464):
+    # GET /metrics is Prometheus text, GET /metrics.json the snapshot. returns the asyncio server
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # headers
+            parts = request.decode("latin1").split()
+            path = parts[1] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, kind, body = "200 OK", "text/plain; version=0.0.4", metrics.prometheus()
+            elif path == "/metrics.json":
+                status, kind, body = "200 OK", "application/json", json.dumps(metrics.snapshot())
+            else:
+                status, kind, body = "404 Not Found", "text/plain", "not found\n"
+            body = body.encode("utf8")
+            writer.write("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status, kind, len(body)).encode("latin1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
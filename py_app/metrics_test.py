@@ -0,0 +1,72 @@
+# tests for the transfer metrics in metrics.py
+import asyncio
+import io
+import json
+
+from py_app.metrics import Metrics, NO_METRICS, serve_metrics
+
+
+class FakeEntry:
+    def key(self):
+        return b"a\0"
+
+    def content_len(self):
+        return 2048
+
+
+def test_phases_counters_and_log():
+    log = io.StringIO()
+    metrics = Metrics(log)
+    transfer = metrics.transfer("receive")
+    with transfer.phase("sync"):
+        pass
+    with transfer.phase("receive") as phase:
+        phase.bytes = 4096
+    transfer.describe(doc_id="doc")
+
+    async def receive(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer=None):
+        return "path"
+
+    assert asyncio.run(metrics.time_write(receive)(None, None, FakeEntry(), ".", "export", 1024, None)) == "path"
+
+    events = [json.loads(line) for line in log.getvalue().splitlines()]
+    assert [event.get("phase") for event in events if event["event"] == "phase"] == ["sync", "receive"]
+    snapshot = metrics.snapshot()
+    assert snapshot["transfers"][0]["info"] == {"doc_id": "doc"}
+    assert {"name": "written_bytes_total", "labels": {}, "value": 2048} in snapshot["counters"]
+    text = metrics.prometheus()
+    assert 'fileflow_phase_seconds_count{kind="receive",phase="sync"} 1' in text
+    assert 'fileflow_entry_bytes_bucket{le="4096"} 1' in text
+    assert 'fileflow_entry_bytes_bucket{le="+Inf"} 1' in text
+    assert "fileflow_throughput_bytes_per_second_count" in text
+
+
+def test_disabled_metrics_wrap_nothing():
+    async def hook(entry):
+        pass
+
+    assert NO_METRICS.time_fetch(hook) is hook
+    transfer = NO_METRICS.transfer("send")
+    with transfer.phase("share") as phase:
+        phase.bytes = 10
+    assert phase.bytes == 0
+
+
+def test_http_endpoint():
+    metrics = Metrics()
+    metrics.count("received_bytes_total", 5)
+
+    async def get(path):
+        server = await serve_metrics(metrics, port=0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode())
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response.decode()
+
+    assert asyncio.run(get("/metrics")).endswith("fileflow_received_bytes_total 5\n")
+    assert json.loads(asyncio.run(get("/metrics.json")).split("\r\n\r\n", 1)[1])["counters"][0]["value"] == 5
+    assert asyncio.run(get("/nope")).startswith("HTTP/1.1 404")
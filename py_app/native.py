@@ -0,0 +1,57 @@
+"""
+In process sendme transfers through the sendme_module extension (src/lib.rs).
+
+This replaces running the sendme cli per transfer (see sendme_proc.py): one
+node stays up between transfers, progress comes back as callbacks and
+receive_bytes hands back readers instead of files, read a chunk at a time
+(iter_chunks) so a file never has to fit in memory. The extension has to be
+built into the current environment first, from the repo root:
+
+    maturin develop --release
+
+.github/workflows/native.yml builds it and runs native_test.py against it.
+"""
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+try:
+    import sendme_module
+except ImportError:
+    sendme_module = None
+
+
+def available():
+    return sendme_module is not None
+
+
+async def open_node(data_dir=None, on_event=None):
+    # data_dir keeps the node id and partially received blobs between runs
+    if sendme_module is None:
+        raise RuntimeError("sendme_module is not built, run `maturin develop --release` in the repo root")
+    return await sendme_module.Node.spawn(data_dir, on_event)
+
+
+async def send(node, path, on_progress=None):
+    # returns (ticket, size), the data is served until node.shutdown()
+    return await node.send(path, on_progress)
+
+
+async def receive(node, ticket, out_dir, on_progress=None):
+    # returns [(name, path)] for every file written into out_dir
+    return await node.receive(ticket, out_dir, on_progress)
+
+
+async def receive_bytes(node, ticket, on_progress=None):
+    # returns [(name, size, reader)], see iter_chunks for reading them
+    return await node.receive_bytes(ticket, on_progress)
+
+
+async def iter_chunks(reader, chunk_size=DEFAULT_CHUNK_SIZE):
+    # the blob behind a reader as buffers of at most chunk_size bytes, memoryview(buffer) doesn't copy
+    offset = 0
+    while offset < reader.size:
+        buffer = await reader.read_at(offset, chunk_size)
+        if not len(buffer):
+            raise IOError("blob ended after {} of {} bytes".format(offset, reader.size))
+        offset += len(buffer)
+        yield buffer
@@ -0,0 +1,46 @@
+# tests for the in process transfers in native.py, the ones that need sendme_module are skipped unless it is built
+import tempfile
+import asyncio
+import os
+
+import pytest
+
+from py_app import native
+
+
+def test_open_node_without_the_extension(monkeypatch):
+    monkeypatch.setattr(native, "sendme_module", None)
+    assert not native.available()
+    with pytest.raises(RuntimeError, match="maturin develop"):
+        asyncio.run(native.open_node())
+
+
+def test_send_and_receive_in_chunks():
+    pytest.importorskip("sendme_module")
+    dir = tempfile.TemporaryDirectory()
+    path = os.path.join(dir.name, "data.bin")
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    with open(path, "wb") as f:
+        f.write(data)
+
+    async def transfer():
+        sender = await native.open_node(os.path.join(dir.name, "sender"))
+        receiver = await native.open_node(os.path.join(dir.name, "receiver"))
+        try:
+            ticket, size = await asyncio.wait_for(native.send(sender, path), 60)
+            assert size == len(data)
+            written = await asyncio.wait_for(native.receive(receiver, ticket, os.path.join(dir.name, "out")), 60)
+            assert [name for name, _ in written] == ["data.bin"]
+            with open(written[0][1], "rb") as f:
+                assert f.read() == data
+            # the same blobs again, without writing them anywhere
+            [(name, size, reader)] = await asyncio.wait_for(native.receive_bytes(receiver, ticket), 60)
+            assert (name, size) == ("data.bin", len(data))
+            chunks = [bytes(memoryview(chunk)) async for chunk in native.iter_chunks(reader, 1024 * 1024)]
+            assert [len(chunk) for chunk in chunks] == [1024 * 1024] * 3 + [17]
+            assert b"".join(chunks) == data
+        finally:
+            await sender.shutdown()
+            await receiver.shutdown()
+
+    asyncio.run(transfer())
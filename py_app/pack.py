@@ -0,0 +1,214 @@
+import iroh
+import io
+import json
+import tarfile
+import uuid
+
+from py_app.receive import target_path, DEFAULT_CHUNK_SIZE
+from py_app.send import file_key
+from py_app.listing import iter_entries
+from py_app.writer import use_writer
+
+"""
+Packing small files together.
+
+A tree of 100k tiny files as 100k entries spends most of its time on per
+entry work: one hash, one sync message and one blob request each. With a
+pack threshold, files smaller than it are written into plain tar archives
+of about pack_size bytes instead, and only two entries are added per pack:
+
+    .fileflow/pack/<id>     the tar, one blob
+    .fileflow/index/<id>    json {"pack": <blob hash>, "files": [[key, offset, size], ...]}
+
+offset is where the file's bytes start inside the tar, so the receiver can
+stream every file straight out of the pack blob with read_at_to_bytes,
+without unpacking the tar itself. Bigger files still go as their own entry.
+
+The index is what counts: when a packed file changes or is deleted, it is
+taken out of the index of its pack (and the pack dropped once nothing in it
+is current), the tar itself is never rewritten. Receivers only write what
+the index lists.
+"""
+
+DEFAULT_PACK_THRESHOLD = 64 * 1024  # 64 KiB
+DEFAULT_PACK_SIZE = 16 * 1024 * 1024  # 16 MiB
+RESERVED_PREFIX = b".fileflow/"
+PACK_PREFIX = RESERVED_PREFIX + b"pack/"
+INDEX_PREFIX = RESERVED_PREFIX + b"index/"
+
+
+def is_reserved(key):
+    # keys we use for our own bookkeeping, never written to disk as they are
+    return key.startswith(RESERVED_PREFIX)
+
+
+def build_pack(files):
+    # files: [(path, key)]. returns the tar bytes and [(key, offset, size)]
+    buffer = io.BytesIO()
+    members = []
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for path, key in files:
+            info = tar.gettarinfo(path, arcname=key.rstrip(b"\0").decode("utf8"))
+            with open(path, "rb") as f:
+                tar.addfile(info, f)
+            # the data is the last thing written, padded to a whole block
+            padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            members.append((key, tar.offset - padded, info.size))
+    return buffer.getvalue(), members
+
+
+def encode_index(pack_hash, members):
+    files = [[key.decode("utf8"), offset, size] for key, offset, size in members]
+    return json.dumps({"pack": pack_hash, "files": files}, separators=(",", ":")).encode("utf8")
+
+
+def decode_index(data):
+    index = json.loads(data)
+    return index["pack"], [(key.encode("utf8"), offset, size) for key, offset, size in index["files"]]
+
+
+class Packer:
+    # sender side. collects small files, writes them out as packs and keeps
+    # the packed table in state.db up to date with which pack holds which file
+    def __init__(self, doc, author, db, doc_id, root, pack_size=DEFAULT_PACK_SIZE):
+        self.doc = doc
+        self.author = author
+        self.db = db
+        self.doc_id = doc_id
+        self.root = root
+        self.pack_size = pack_size
+        self.pending = []  # (path, stat)
+        self.dirty = set()  # packs that lost a file since their index was written
+
+    def add(self, path, stat):
+        self.pending.append((path, stat))
+
+    def drop(self, path):
+        # path is no longer in its pack (changed or deleted). false if it wasn't packed
+        row = self.db.execute("SELECT pack, hash FROM packed WHERE doc_id = ? AND path = ?", (self.doc_id, path)).fetchone()
+        if row is None:
+            return False
+        self.db.execute("DELETE FROM packed WHERE doc_id = ? AND path = ?", (self.doc_id, path))
+        self.dirty.add(row)
+        return True
+
+    async def flush(self):
+        # write out everything added. returns [(path, key, stat, pack id)]
+        written = []
+        batch, size = [], 0
+        for path, stat in self.pending:
+            if batch and size + stat.st_size > self.pack_size:
+                written += await self.write_pack(batch)
+                batch, size = [], 0
+            batch.append((path, stat))
+            size += stat.st_size
+        if batch:
+            written += await self.write_pack(batch)
+        self.pending = []
+        await self.rewrite_dirty()
+        return written
+
+    async def write_pack(self, batch):
+        files = [(path, file_key(path, self.root)) for path, stat in batch]
+        data, members = build_pack(files)
+        pack_id = uuid.uuid4().hex
+        pack_hash = (await self.doc.set_bytes(self.author, PACK_PREFIX + pack_id.encode(), data)).to_hex()
+        await self.doc.set_bytes(self.author, INDEX_PREFIX + pack_id.encode(), encode_index(pack_hash, members))
+        for (path, key), (_, offset, size) in zip(files, members):
+            self.db.execute(
+                "INSERT OR REPLACE INTO packed (doc_id, path, pack, hash, key, offset, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.doc_id, path, pack_id, pack_hash, key, offset, size),
+            )
+        return [(path, key, stat, pack_id) for (path, key), (_, stat) in zip(files, batch)]
+
+    async def rewrite_dirty(self):
+        # write a new index for every pack that lost files, or drop the pack if none are left
+        for pack_id, pack_hash in sorted(self.dirty):
+            members = self.db.execute("SELECT key, offset, size FROM packed WHERE doc_id = ? AND pack = ? ORDER BY offset",
+                                      (self.doc_id, pack_id)).fetchall()
+            if members:
+                await self.doc.set_bytes(self.author, INDEX_PREFIX + pack_id.encode(), encode_index(pack_hash, members))
+            else:
+                await self.doc.delete(self.author, INDEX_PREFIX + pack_id.encode())
+                await self.doc.delete(self.author, PACK_PREFIX + pack_id.encode())
+        self.dirty = set()
+
+
+class MemberHash:
+    def __init__(self, hex):
+        self.hex = hex
+
+    def to_hex(self):
+        return self.hex
+
+
+class PackMember:
+    # looks enough like a doc entry for store.is_received / mark_received
+    def __init__(self, pack_hash, key, offset, size):
+        self.pack_hash = pack_hash  # hash of the pack blob, the same file in a new pack gets a new one
+        self._key = key
+        self.offset = offset
+        self.size = size
+
+    def key(self):
+        return self._key
+
+    def content_len(self):
+        return self.size
+
+    def content_hash(self):
+        # a file can sit in different packs over time, so the pack and offset are its identity
+        return MemberHash("{}:{}".format(self.pack_hash, self.offset))
+
+
+async def pack_entry(doc, index_entry):
+    # the .fileflow/pack/ entry of an index, None if it isn't here (yet)
+    key = PACK_PREFIX + index_entry.key()[len(INDEX_PREFIX):]
+    async for entry in iter_entries(doc, key):
+        if entry.key() == key:
+            return entry
+    return None
+
+
+async def unpack(node, index_entry, out_dir=".", chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None, skip=None, on_received=None,
+                 writer=None):
+    # write every file listed in a pack index, streamed from the pack blob a chunk at a time.
+    # returns (paths written, bytes written)
+    pack_hash, members = decode_index(await node.blobs().read_to_bytes(index_entry.content_hash()))
+    hash = iroh.Hash.from_string(pack_hash)
+    paths, total = [], 0
+    async with use_writer(writer) as writer:
+        for key, offset, size in members:
+            member = PackMember(pack_hash, key, offset, size)
+            if skip is not None and skip(member):
+                continue
+            path = target_path(key, out_dir)
+            written = 0
+            async with writer.open(path, size) as f:
+                while written < size:
+                    want = min(chunk_size, size - written)
+                    chunk = await node.blobs().read_at_to_bytes(hash, offset + written, iroh.ReadAtLen.exact(want))
+                    if not chunk:
+                        raise IOError("pack {} ended inside {!r}".format(pack_hash, key))
+                    await f.write(chunk)
+                    written += len(chunk)
+                    if on_progress:
+                        on_progress(key, written, size)
+            if size == 0 and on_progress:
+                on_progress(key, 0, 0)
+            if on_received is not None:
+                on_received(member, path)
+            paths.append(path)
+            total += size
+    return paths, total
+
+
+async def unpack_all(node, doc, out_dir=".", chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None, skip=None, on_received=None,
+                     writer=None):
+    # unpack every pack in the doc. returns (paths written, bytes written)
+    paths, total = [], 0
+    async for entry in iter_entries(doc, INDEX_PREFIX):
+        written, size = await unpack(node, entry, out_dir, chunk_size, on_progress, skip, on_received, writer)
+        paths += written
+        total += size
+    return paths, total
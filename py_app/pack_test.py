@@ -0,0 +1,129 @@
+# tests for small file packing in pack.py
+import tempfile
+import asyncio
+import tarfile
+import io
+import os
+
+from py_app import pack
+from py_app.pack import build_pack, encode_index, decode_index, Packer, unpack, PACK_PREFIX, INDEX_PREFIX
+from py_app.send import file_key
+from py_app.store import NodeStore
+
+
+class FakeHash:
+    def __init__(self, hex):
+        self.hex = hex
+
+    def to_hex(self):
+        return self.hex
+
+
+class FakeDoc:
+    def __init__(self):
+        self.entries = {}
+
+    async def set_bytes(self, author, key, value):
+        self.entries[key] = bytes(value)
+        return FakeHash("hash{}".format(len(self.entries)))
+
+    async def delete(self, author, key):
+        self.entries.pop(key, None)
+
+
+class FakeBlobs:
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    async def read_to_bytes(self, hash):
+        return self.blobs[hash]
+
+    async def read_at_to_bytes(self, hash, offset, length):
+        return self.blobs[hash][offset:offset + length]
+
+
+class FakeNode:
+    def __init__(self, blobs):
+        self._blobs = FakeBlobs(blobs)
+
+    def blobs(self):
+        return self._blobs
+
+
+class FakeEntry:
+    def __init__(self, hash):
+        self.hash = hash
+
+    def content_hash(self):
+        return self.hash
+
+
+def make_tree(root, files):
+    paths = []
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def test_pack_offsets_point_at_the_file_data():
+    root = tempfile.TemporaryDirectory()
+    files = {"a": b"a" * 10, os.path.join("sub", "b"): b"b" * 1000, "empty": b"", "c": os.urandom(513)}
+    paths = make_tree(root.name, files)
+    data, members = build_pack([(path, file_key(path, root.name)) for path in paths])
+    for (key, offset, size), value in zip(members, files.values()):
+        assert data[offset:offset + size] == value
+    # and it is still a tar anyone can unpack
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert sorted(tar.getnames()) == sorted(key.rstrip(b"\0").decode() for key, _, _ in members)
+    assert decode_index(encode_index("h", members)) == ("h", members)
+
+
+def test_packer_and_unpack(monkeypatch):
+    data_dir = tempfile.TemporaryDirectory()
+    root = tempfile.TemporaryDirectory()
+    out = tempfile.TemporaryDirectory()
+    files = {"a": b"aaa", os.path.join("sub", "b"): b"bb", "c": b"c" * 100}
+    paths = make_tree(root.name, files)
+    store = NodeStore(data_dir.name)
+    doc = FakeDoc()
+    packer = Packer(doc, "author", store.db, "doc", root.name, pack_size=50)
+    for path in paths:
+        packer.add(path, os.stat(path))
+    written = asyncio.run(packer.flush())
+    assert [path for path, _, _, _ in written] == paths
+    # pack_size 50 puts "c" in a second pack
+    packs = [key for key in doc.entries if key.startswith(PACK_PREFIX)]
+    indexes = [key for key in doc.entries if key.startswith(INDEX_PREFIX)]
+    assert len(packs) == 2 and len(indexes) == 2
+    #
+    # unpack every index from the blobs, the way a receiver would
+    monkeypatch.setattr(pack.iroh, "Hash", type("Hash", (), {"from_string": staticmethod(lambda hex: hex)}), raising=False)
+    monkeypatch.setattr(pack.iroh, "ReadAtLen", type("ReadAtLen", (), {"exact": staticmethod(lambda n: n)}), raising=False)
+    blobs = {}
+    for key in packs:
+        index_key = INDEX_PREFIX + key[len(PACK_PREFIX):]
+        pack_hash, _ = decode_index(doc.entries[index_key])
+        blobs[pack_hash] = doc.entries[key]
+        blobs[index_key] = doc.entries[index_key]
+    node = FakeNode(blobs)
+    received = []
+    for key in indexes:
+        asyncio.run(unpack(node, FakeEntry(key), out.name, chunk_size=7, on_received=lambda member, path: received.append(path)))
+    for name, value in files.items():
+        parts = name.split(os.sep)
+        with open(os.path.join(out.name, "copy_of_" + parts[0], *parts[1:]), "rb") as f:
+            assert f.read() == value
+    assert len(received) == 3
+    #
+    # dropping the only file of a pack removes the pack, otherwise the index is rewritten
+    packer.drop(paths[2])
+    packer.drop(paths[0])
+    asyncio.run(packer.rewrite_dirty())
+    assert len([key for key in doc.entries if key.startswith(PACK_PREFIX)]) == 1
+    (index_key,) = [key for key in doc.entries if key.startswith(INDEX_PREFIX)]
+    assert [key for key, _, _ in decode_index(doc.entries[index_key])[1]] == [file_key(paths[1], root.name)]
+    store.close()
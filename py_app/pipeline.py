@@ -0,0 +1,185 @@
+import asyncio
+import contextlib
+import time
+
+from py_app.receive import receive_entry, DEFAULT_CHUNK_SIZE
+from py_app.listing import iter_pages
+from py_app.pack import is_reserved, unpack_all
+from py_app.codec import CodecMap
+from py_app.metrics import NO_METRICS, NULL_TRANSFER
+
+"""
+Receiving many entries at once.
+
+A fixed number of workers pull entries off a queue and stream them to disk
+with receive_entry. Two limits keep this bounded:
+    - max_entries: how many entries are being received at the same time
+    - max_bytes: how many bytes of content those entries add up to. An entry
+      bigger than the whole budget is still let through, but only on its own.
+A failing entry is recorded and skipped, it doesn't stop the others.
+
+entries can be a plain list or an async iterator of pages (see listing.py),
+in which case workers start on the first page while the rest are listed.
+"""
+
+DEFAULT_MAX_ENTRIES = 8
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # 256 MiB
+ORDERS = ("none", "largest-first", "smallest-first")
+
+
+class ByteBudget:
+    # like a semaphore, but counting bytes instead of slots
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + size <= self.limit)
+            self.in_flight += size
+
+    async def release(self, size):
+        async with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+class ReceiveResult:
+    def __init__(self):
+        self.received = []  # paths written
+        self.failed = []  # (key, exception)
+        self.skipped = 0
+        self.bytes = 0
+        self.unpacked = []  # paths written from packs, by receive_doc
+        self.unpacked_bytes = 0
+
+
+def print_total(received, total):
+    percent = 100 * received // total if total else 100
+    print("\rreceived {}/{} bytes ({}%)".format(received, total, percent), end="", flush=True)
+
+
+class TotalProgress:
+    # on_progress callback that shows one line for all entries instead of one per entry.
+    # show(received, total) is called at most every interval seconds, and when an entry is done
+    def __init__(self, interval=0.2, show=print_total):
+        self.interval = interval
+        self.show = show
+        self.done = {}
+        self.received = 0
+        self.total = 0
+        self.last_print = 0.0
+
+    def update(self, key, written, total):
+        if key not in self.done:
+            # entries keep turning up while later pages are listed, so the total grows as we go
+            self.total += total
+        self.received += written - self.done.get(key, 0)
+        self.done[key] = written
+        now = time.monotonic()
+        if now - self.last_print >= self.interval or written >= total:
+            self.last_print = now
+            self.show(self.received, self.total)
+
+
+def order_entries(entries, order="none"):
+    if order == "largest-first":
+        return sorted(entries, key=lambda entry: entry.content_len(), reverse=True)
+    elif order == "smallest-first":
+        return sorted(entries, key=lambda entry: entry.content_len())
+    elif order == "none":
+        return list(entries)
+    raise ValueError("unknown order {!r}".format(order))
+
+
+async def as_pages(entries):
+    if hasattr(entries, "__aiter__"):
+        async for page in entries:
+            yield page
+    else:
+        yield entries
+
+
+async def receive_all(node, doc, entries, out_dir=".", mode="export", chunk_size=DEFAULT_CHUNK_SIZE,
+                      max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, order="none", on_progress=None,
+                      skip=None, on_received=None, ensure_local=None, receive=None, admit=None, writer=None):
+    # skip(entry) leaves out what the caller has, ensure_local(entry) is awaited before an entry is written,
+    # on_received(entry, path) after. receive replaces receive_entry, admit(entry) gives a context manager held
+    # while the entry is fetched and written
+    if max_entries <= 0:
+        raise ValueError("max_entries must be positive")
+    if receive is None:
+        receive = receive_entry
+    result = ReceiveResult()
+    budget = ByteBudget(max_bytes)
+    # bounded so a huge listing is never held in the queue all at once
+    queue = asyncio.Queue(maxsize=2 * max_entries)
+
+    async def producer():
+        try:
+            async for page in as_pages(entries):
+                # ordering can only be applied inside a page when listing is paged
+                for entry in order_entries(page, order):
+                    await queue.put(entry)
+        finally:
+            for _ in range(max_entries):
+                await queue.put(None)
+
+    async def worker():
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            if skip is not None and skip(entry):
+                result.skipped += 1
+                continue
+            size = entry.content_len()
+            await budget.acquire(size)
+            try:
+                async with admit(entry) if admit is not None else contextlib.nullcontext():
+                    if ensure_local is not None:
+                        await ensure_local(entry)
+                    path = await receive(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer)
+                if on_received is not None:
+                    on_received(entry, path)
+                result.received.append(path)
+                result.bytes += size
+            except Exception as e:
+                result.failed.append((entry.key(), e))
+            finally:
+                await budget.release(size)
+
+    await asyncio.gather(producer(), *(worker() for _ in range(max_entries)))
+    return result
+
+
+async def receive_doc(node, store, doc, out_dir=".", pages=None, mode="export", chunk_size=DEFAULT_CHUNK_SIZE,
+                      max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, order="none", on_progress=None,
+                      codecs=None, receive=None, ensure_local=None, admit=None, metrics=NO_METRICS, transfer=NULL_TRANSFER,
+                      writer=None):
+    # receive doc (or the pages given) into out_dir, then unpack its packs. returns a ReceiveResult.
+    # receive defaults to codecs.receive, pass codecs when it is needed before or after
+    doc_id = doc.id()
+    if codecs is None:
+        codecs = await CodecMap().load(node, doc)
+    if pages is None:
+        pages = iter_pages(doc)
+    with transfer.phase("receive") as phase:
+        result = await receive_all(node, doc, pages, out_dir, mode, chunk_size, max_entries, max_bytes, order, on_progress,
+                                   skip=lambda entry: is_reserved(entry.key()) or store.is_received(doc_id, codecs.as_written(entry), out_dir),
+                                   on_received=lambda entry, path: store.mark_received(doc_id, codecs.as_written(entry), path),
+                                   ensure_local=ensure_local, receive=metrics.time_write(receive or codecs.receive), admit=admit,
+                                   writer=writer)
+        phase.bytes = result.bytes
+    # small files that came in packs
+    with transfer.phase("unpack") as phase:
+        result.unpacked, result.unpacked_bytes = await unpack_all(
+            node, doc, out_dir, chunk_size, on_progress,
+            skip=lambda entry: store.is_received(doc_id, entry, out_dir),
+            on_received=lambda entry, path: store.mark_received(doc_id, entry, path), writer=writer)
+        phase.bytes = result.unpacked_bytes
+    metrics.count("received_entries_total", len(result.received) + len(result.unpacked))
+    metrics.count("received_bytes_total", result.bytes + result.unpacked_bytes)
+    metrics.count("failed_entries_total", len(result.failed))
+    return result
@@ -0,0 +1,128 @@
+# tests for the concurrent receive pipeline in pipeline.py
+import tempfile
+import asyncio
+import os
+
+import py_app.pipeline as pipeline
+from py_app.pipeline import ByteBudget, receive_all, receive_doc, order_entries
+from py_app.receive import target_path
+from py_app.codec import CodecMap
+from py_app.store import NodeStore
+
+
+class FakeHash:
+    def to_hex(self):
+        return "hash"
+
+
+class FakeEntry:
+    def __init__(self, key, size):
+        self._key = key
+        self._size = size
+
+    def key(self):
+        return self._key
+
+    def content_len(self):
+        return self._size
+
+    def content_hash(self):
+        return FakeHash()
+
+
+class FakeDoc:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def id(self):
+        return "doc"
+
+
+def test_order_entries():
+    entries = [FakeEntry(b"a", 5), FakeEntry(b"b", 50), FakeEntry(b"c", 1)]
+    assert [e.key() for e in order_entries(entries, "largest-first")] == [b"b", b"a", b"c"]
+    assert [e.key() for e in order_entries(entries, "smallest-first")] == [b"c", b"a", b"b"]
+    assert [e.key() for e in order_entries(entries, "none")] == [b"a", b"b", b"c"]
+
+
+def test_byte_budget_lets_oversized_through_alone():
+    async def run():
+        budget = ByteBudget(10)
+        await budget.acquire(100)
+        assert budget.in_flight == 100
+        waiter = asyncio.ensure_future(budget.acquire(1))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        await budget.release(100)
+        await waiter
+        assert budget.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_receive_all_limits_and_isolates_errors(monkeypatch):
+    state = {"entries": 0, "bytes": 0, "max_entries": 0, "max_bytes": 0}
+
+    async def fake_receive_entry(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer=None):
+        state["entries"] += 1
+        state["bytes"] += entry.content_len()
+        state["max_entries"] = max(state["max_entries"], state["entries"])
+        state["max_bytes"] = max(state["max_bytes"], state["bytes"])
+        await asyncio.sleep(0.01)
+        state["entries"] -= 1
+        state["bytes"] -= entry.content_len()
+        if entry.key() == b"bad":
+            raise IOError("broken blob")
+        return entry.key().decode()
+
+    monkeypatch.setattr(pipeline, "receive_entry", fake_receive_entry)
+    entries = [FakeEntry("e{}".format(i).encode(), 30) for i in range(20)] + [FakeEntry(b"bad", 30)]
+    result = asyncio.run(receive_all(None, None, entries, max_entries=4, max_bytes=100))
+    assert len(result.received) == 20
+    assert [key for key, _ in result.failed] == [b"bad"]
+    assert result.bytes == 20 * 30
+    assert state["max_entries"] <= 3
+    assert state["max_bytes"] <= 100
+
+
+def test_receive_all_from_pages(monkeypatch):
+    async def fake_receive_entry(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer=None):
+        return entry.key()
+
+    async def pages():
+        for p in range(3):
+            yield [FakeEntry("p{}e{}".format(p, i).encode(), i) for i in range(5)]
+
+    monkeypatch.setattr(pipeline, "receive_entry", fake_receive_entry)
+    result = asyncio.run(receive_all(None, None, pages(), max_entries=2, order="largest-first"))
+    assert len(result.received) == 15
+    # ordering is applied inside each page
+    assert result.received[:5] == [b"p0e4", b"p0e3", b"p0e2", b"p0e1", b"p0e0"]
+
+
+def test_receive_doc_skips_what_is_in_that_folder(monkeypatch):
+    dir = tempfile.TemporaryDirectory()
+    doc = FakeDoc([FakeEntry(b".fileflow/pack/x", 3), FakeEntry(b"a", 1), FakeEntry(b"b", 2)])
+    written = []
+
+    async def fake_receive(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer=None):
+        path = target_path(entry.key(), out_dir)
+        os.makedirs(out_dir, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * entry.content_len())
+        written.append(path)
+        return path
+
+    async def no_packs(node, doc, out_dir, chunk_size, on_progress, skip, on_received, writer):
+        return [], 0
+
+    monkeypatch.setattr(pipeline, "unpack_all", no_packs)
+    store = NodeStore(os.path.join(dir.name, "data"))
+    first, second = os.path.join(dir.name, "first"), os.path.join(dir.name, "second")
+    for out_dir, skipped in ((first, 1), (first, 3), (second, 1)):
+        written.clear()
+        result = asyncio.run(receive_doc(None, store, doc, out_dir, pages=doc.entries, codecs=CodecMap(), receive=fake_receive))
+        # our own bookkeeping entry is never written out
+        assert (result.skipped, result.unpacked) == (skipped, [])
+        assert written == ([] if skipped == 3 else [target_path(b"a", out_dir), target_path(b"b", out_dir)])
+    store.close()
@@ -0,0 +1,7 @@
+"""
+The priority classes a transfer can run under, shared by the scheduler
+(schedule.py) and the daemon's command line client (daemon_client.py),
+which must not import asyncio or iroh.
+"""
+
+PRIORITIES = {"urgent": 64, "interactive": 8, "normal": 2, "bulk": 1}  # class -> weight
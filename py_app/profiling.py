@@ -0,0 +1,126 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+"""
+Profiling a whole send or receive (main.py --profile DIR).
+
+CPU: with yappi installed it is used, it follows coroutines across task
+switches and also sees the threads iroh calls back from. Without it
+cProfile watches the main thread, which is where every asyncio task runs.
+Either way the result is saved in pstats format:
+
+    python -m pstats DIR/cpu.pstats    (or snakeviz, gprof2dot, ...)
+
+Memory: tracemalloc records where python allocates while the session runs.
+Buffers that live for one chunk are gone by the end, so while the session
+runs the traced memory is looked at every sample_interval seconds and a
+snapshot is taken whenever it is higher than ever before. That snapshot
+(allocations-peak.tracemalloc) and one from the end
+(allocations-end.tracemalloc) are saved for tracemalloc.Snapshot.load.
+Memory that iroh allocates in rust is not seen.
+
+summary.txt lists the top CPU sites (by own time and by cumulative time)
+and the lines holding the most memory at the peak and at the end. Work
+done in process pools (compression, verify) happens in other processes and
+is not in the profile.
+"""
+
+DEFAULT_TOP = 25
+DEFAULT_FRAMES = 10  # stack depth tracemalloc keeps per allocation
+DEFAULT_SAMPLE_INTERVAL = 1.0  # seconds
+
+
+class Profiler:
+    def __init__(self, out_dir, top=DEFAULT_TOP, frames=DEFAULT_FRAMES, sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        self.out_dir = out_dir
+        self.top = top
+        self.frames = frames
+        self.sample_interval = sample_interval
+        self.profile = None
+        self.started = None
+        self.sampler = None
+        self.peak = None  # (traced bytes, snapshot) of the highest sample so far
+
+    @property
+    def engine(self):
+        return "yappi" if yappi is not None else "cProfile"
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        tracemalloc.start(self.frames)
+        if yappi is not None:
+            yappi.set_clock_type("cpu")
+            yappi.start(builtins=False, profile_threads=True)
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.started = time.monotonic()
+        self.sampler = asyncio.ensure_future(self.sample())
+
+    async def sample(self):
+        # runs on the event loop while profiling, a snapshot only costs time when memory use grows
+        while True:
+            await asyncio.sleep(self.sample_interval)
+            traced = tracemalloc.get_traced_memory()[0]
+            if self.peak is None or traced > self.peak[0]:
+                self.peak = (traced, tracemalloc.take_snapshot())
+
+    def stop(self):
+        # stop profiling and write everything to out_dir. returns the path of the summary
+        elapsed = time.monotonic() - self.started
+        self.sampler.cancel()
+        cpu_path = os.path.join(self.out_dir, "cpu.pstats")
+        if yappi is not None:
+            yappi.stop()
+            yappi.get_func_stats().save(cpu_path, type="pstat")
+            yappi.clear_stats()
+        else:
+            self.profile.disable()
+            self.profile.dump_stats(cpu_path)
+        end = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # with no sample, or more memory in use now than at any sample, the end is the peak
+        highest = self.peak[1] if self.peak is not None and self.peak[0] > traced else end
+        snapshots = {}
+        for name, snapshot in (("peak", highest), ("end", end)):
+            # the profiler's own bookkeeping is not what we are after
+            snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                               tracemalloc.Filter(False, "<frozen importlib._bootstrap>")))
+            snapshot.dump(os.path.join(self.out_dir, "allocations-{}.tracemalloc".format(name)))
+            snapshots[name] = snapshot
+
+        summary_path = os.path.join(self.out_dir, "summary.txt")
+        with open(summary_path, "w") as f:
+            f.write("{:.1f} seconds profiled with {}, python memory peaked at {} bytes\n".format(elapsed, self.engine, peak))
+            f.write(cpu_summary(cpu_path, self.top))
+            f.write(allocation_summary(snapshots["peak"], "at the highest sample", self.top))
+            f.write(allocation_summary(snapshots["end"], "at the end", self.top))
+        return summary_path
+
+
+def cpu_summary(path, top=DEFAULT_TOP):
+    out = io.StringIO()
+    for order, title in (("tottime", "own time"), ("cumulative", "cumulative time")):
+        out.write("\ntop {} functions by {}\n".format(top, title))
+        stats = pstats.Stats(path, stream=out)
+        stats.strip_dirs().sort_stats(order).print_stats(top)
+    return out.getvalue()
+
+
+def allocation_summary(snapshot, when, top=DEFAULT_TOP):
+    lines = ["", "top {} lines by memory held {}".format(top, when)]
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        lines.append("{:>12} bytes in {:>8} blocks  {}:{}".format(stat.size, stat.count, frame.filename, frame.lineno))
+    return "\n".join(lines) + "\n"
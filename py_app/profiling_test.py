@@ -0,0 +1,36 @@
+# tests for the --profile mode in profiling.py
+import tempfile
+import asyncio
+import os
+import tracemalloc
+
+from py_app.profiling import Profiler
+
+
+def busy_copy(size):
+    # the kind of thing a profile should point at: a whole buffer copied at once
+    data = bytearray(size)
+    return bytes(data)
+
+
+def test_profile_session():
+    dir = tempfile.TemporaryDirectory()
+    out_dir = os.path.join(dir.name, "profile")
+
+    async def session():
+        profiler = Profiler(out_dir, sample_interval=0.01)
+        profiler.start()
+        held = busy_copy(8 * 1024 * 1024)
+        await asyncio.sleep(0.05)
+        del held
+        await asyncio.sleep(0.02)
+        return profiler.stop()
+
+    summary_path = asyncio.run(session())
+    assert not tracemalloc.is_tracing()
+    assert sorted(os.listdir(out_dir)) == ["allocations-end.tracemalloc", "allocations-peak.tracemalloc", "cpu.pstats", "summary.txt"]
+    with open(summary_path) as f:
+        summary = f.read()
+    assert "busy_copy" in summary
+    peak = tracemalloc.Snapshot.load(os.path.join(out_dir, "allocations-peak.tracemalloc"))
+    assert max(stat.size for stat in peak.statistics("lineno")) >= 8 * 1024 * 1024
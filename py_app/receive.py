@@ -0,0 +1,96 @@
+import iroh
+import os
+
+from py_app.writer import use_writer
+
+"""
+Helpers for getting doc entries out of the node and onto disk without
+holding a whole blob in memory.
+
+There are two ways of doing it:
+    - export: iroh writes the blob straight to the target path (doc.export_file)
+    - chunked: we read the blob in fixed size pieces (read_at_to_bytes) and
+      hand them to an ExportWriter (writer.py), which writes them on its own
+      threads and renames the file into place once it is complete
+"""
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+RECEIVE_MODES = ("export", "chunked")
+
+
+def target_path(key, out_dir="."):
+    # keys made with path_to_key end in a null byte, plain keys don't
+    if key.endswith(b"\0"):
+        key = key[:-1]
+    name = key.decode("utf8").replace("\\", "/")
+    #
+    # never let a remote key write outside of out_dir
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if not parts or ".." in parts:
+        raise ValueError("refusing to write entry with key {!r}".format(key))
+    parts[0] = "copy_of_{}".format(parts[0])
+    return os.path.join(out_dir, *parts)
+
+
+def print_progress(key, written, total):
+    name = key.rstrip(b"\0").decode("utf8", "replace")
+    percent = 100 * written // total if total else 100
+    end = "\n" if written >= total else ""
+    print("\r{}: {}/{} bytes ({}%)".format(name, written, total, percent), end=end, flush=True)
+
+
+class ExportCallback:
+    # passed to doc.export_file, forwards the offsets iroh reports to on_progress
+    def __init__(self, entry, on_progress):
+        self.key = entry.key()
+        self.total = entry.content_len()
+        self.on_progress = on_progress
+
+    async def progress(self, progress):
+        kind = progress.type()
+        if kind == iroh.DocExportProgressType.PROGRESS:
+            self.on_progress(self.key, progress.as_progress().offset, self.total)
+        elif kind == iroh.DocExportProgressType.DONE:
+            self.on_progress(self.key, self.total, self.total)
+
+
+async def export_entry(doc, entry, path, on_progress=None):
+    # let iroh write the blob to path itself, nothing passes through python
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    callback = ExportCallback(entry, on_progress) if on_progress else None
+    await doc.export_file(entry, path, callback)
+    return entry.content_len()
+
+
+async def copy_entry_chunked(node, entry, path, chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None, writer=None):
+    # read the blob chunk_size bytes at a time so memory use doesn't depend on the file size
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    key = entry.key()
+    hash = entry.content_hash()
+    total = entry.content_len()
+    written = 0
+    async with use_writer(writer) as writer, writer.open(path, total) as file:
+        while written < total:
+            chunk = await node.blobs().read_at_to_bytes(hash, written, iroh.ReadAtLen.at_most(chunk_size))
+            if not chunk:
+                raise IOError("blob {} ended after {} of {} bytes".format(hash, written, total))
+            await file.write(chunk)
+            written += len(chunk)
+            if on_progress:
+                on_progress(key, written, total)
+    if total == 0 and on_progress:
+        on_progress(key, 0, 0)
+    return written
+
+
+async def receive_entry(node, doc, entry, out_dir=".", mode="export", chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None,
+                        writer=None):
+    path = target_path(entry.key(), out_dir)
+    if mode == "export":
+        await export_entry(doc, entry, path, on_progress)
+    elif mode == "chunked":
+        await copy_entry_chunked(node, entry, path, chunk_size, on_progress, writer)
+    else:
+        raise ValueError("unknown receive mode {!r}".format(mode))
+    return path
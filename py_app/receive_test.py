@@ -0,0 +1,59 @@
+# tests for the streaming receive helpers in receive.py
+from iroh import Iroh, Query, NodeOptions
+import tempfile
+import os
+import asyncio
+import iroh
+import pytest
+
+from py_app.receive import target_path, copy_entry_chunked, export_entry
+
+
+def test_target_path():
+    out = os.path.join("some", "dir")
+    assert target_path(b"flag.png", out) == os.path.join(out, "copy_of_flag.png")
+    # path_to_key style keys end with a null byte
+    assert target_path(b"a/b.txt\0", out) == os.path.join(out, "copy_of_a", "b.txt")
+    #
+    # keys coming from a remote must not escape out_dir
+    for bad in (b"../evil", b"a/../../evil", b"", b"\0"):
+        with pytest.raises(ValueError):
+            target_path(bad, out)
+
+
+async def test_doc_receive_streaming():
+    # setup event loop, to ensure async callbacks work
+    iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+
+    #
+    # create node
+    iroh_dir = tempfile.TemporaryDirectory()
+    out_dir = tempfile.TemporaryDirectory()
+    options = NodeOptions()
+    options.enable_docs = True
+    node = await Iroh.persistent_with_options(iroh_dir.name, options)
+    #
+    # create an entry a few chunks long
+    doc = await node.docs().create()
+    author = await node.authors().create()
+    val = os.urandom(10 * 1024 + 7)
+    key = b'streamed'
+    await doc.set_bytes(author, key, val)
+    entry = await doc.get_one(Query.author_key_exact(author, key))
+    #
+    # chunked copy, recording the progress reports
+    reports = []
+    chunked_path = os.path.join(out_dir.name, "chunked")
+    written = await copy_entry_chunked(node, entry, chunked_path, 1024, lambda k, n, t: reports.append(n))
+    assert written == len(val)
+    assert reports == sorted(reports)
+    assert reports[-1] == len(val)
+    assert len(reports) == 11
+    with open(chunked_path, "rb") as file:
+        assert file.read() == val
+    #
+    # export straight to disk
+    export_path = os.path.join(out_dir.name, "exported")
+    await export_entry(doc, entry, export_path)
+    with open(export_path, "rb") as file:
+        assert file.read() == val
@@ -0,0 +1,93 @@
+import iroh
+from iroh import NodeAddr, BlobDownloadOptions, BlobFormat, SetTagOption
+
+from py_app.listing import iter_entries
+from py_app.pack import RESERVED_PREFIX
+
+"""
+Picking up large downloads where an earlier run stopped.
+
+iroh keeps partially downloaded blobs in the store together with a record of
+which chunks have already been verified. With a persistent data dir (see
+store.py) that survives a restart, and a new download of the same blob only
+asks the remote for the missing ranges.
+
+Here we make sure an entry's blob is complete before it is written out, and
+keep count of how many bytes came from a partial blob left by an earlier run
+and how many had to be fetched over the network. The download reports what
+it read from the remote, the rest of a blob an earlier run left incomplete
+is what was already verified here (list_incomplete's own size says nothing
+about that, it is 0 for a half downloaded blob).
+
+Joined with download=False (sync.py), nothing arrives on its own: the
+caller fetches each entry's blob with complete_blob as it writes it, after
+complete_reserved has fetched our bookkeeping entries (codecs, packs).
+"""
+
+TAG_PREFIX = b"fileflow-resume/"
+
+
+class ResumeStats:
+    def __init__(self, partial=None):
+        # partial: hash hex of the blobs an earlier run left incomplete, from partial_blobs
+        self.partial = partial or set()
+        self.resumed_bytes = 0
+        self.downloaded_bytes = 0
+        self.blobs_resumed = 0
+        self.blobs_downloaded = 0
+
+    def summary(self):
+        return "resumed {} bytes in {} blobs from an earlier run, downloaded {} bytes in {} blobs".format(
+            self.resumed_bytes, self.blobs_resumed, self.downloaded_bytes, self.blobs_downloaded)
+
+
+async def partial_blobs(node):
+    # what is left over from interrupted downloads, as hash hex
+    return {info.hash.to_hex() for info in await node.blobs().list_incomplete()}
+
+
+class DownloadCallback:
+    def __init__(self):
+        self.bytes_read = 0
+        self.error = None
+
+    async def progress(self, progress):
+        kind = progress.type()
+        if kind == iroh.DownloadProgressType.ALL_DONE:
+            self.bytes_read = progress.as_all_done().bytes_read
+        elif kind == iroh.DownloadProgressType.ABORT:
+            self.error = progress.as_abort().error
+
+
+async def complete_blob(node, entry, peers, stats):
+    # make sure the entry's blob is fully in the local store, fetching only the missing ranges
+    hash = entry.content_hash()
+    if await node.blobs().has(hash):
+        return
+    if not peers:
+        raise IOError("blob {} is incomplete and there is no peer to fetch it from".format(hash.to_hex()))
+    partial = hash.to_hex() in stats.partial
+    #
+    # the doc already protects its content from gc, the tag only covers the download itself
+    tag = TAG_PREFIX + hash.to_hex().encode()
+    nodes = [NodeAddr(peer, None, []) for peer in peers]
+    callback = DownloadCallback()
+    try:
+        await node.blobs().download(hash, BlobDownloadOptions(BlobFormat.RAW, nodes, SetTagOption.named(tag)), callback)
+    finally:
+        await node.tags().delete(tag)
+    if callback.error:
+        raise IOError("download of {} failed: {}".format(hash.to_hex(), callback.error))
+    if partial:
+        # what didn't have to come over the network
+        stats.resumed_bytes += max(entry.content_len() - callback.bytes_read, 0)
+        stats.blobs_resumed += 1
+    stats.downloaded_bytes += callback.bytes_read
+    stats.blobs_downloaded += 1
+
+
+async def complete_reserved(node, doc, peers, stats):
+    # our bookkeeping entries (codecs, packs) are needed whole before anything is written
+    async for entry in iter_entries(doc, RESERVED_PREFIX):
+        if entry.content_len() > 0:
+            await complete_blob(node, entry, peers, stats)
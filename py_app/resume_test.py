@@ -0,0 +1,91 @@
+# tests for finishing incomplete blobs in resume.py
+from iroh import Iroh, PublicKey, Query, NodeOptions
+import tempfile
+import os
+import asyncio
+import iroh
+
+import py_app.resume as resume
+from py_app.resume import ResumeStats, partial_blobs, complete_blob
+
+
+async def test_complete_blob():
+    # setup event loop, to ensure async callbacks work
+    iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+
+    #
+    # create a sending and a receiving node
+    options = NodeOptions()
+    options.enable_docs = True
+    send_dir = tempfile.TemporaryDirectory()
+    recv_dir = tempfile.TemporaryDirectory()
+    sender = await Iroh.persistent_with_options(send_dir.name, options)
+    receiver = await Iroh.persistent_with_options(recv_dir.name, options)
+    await receiver.net().add_node_addr(await sender.net().node_addr())
+    peer = PublicKey.from_string(await sender.net().node_id())
+    #
+    # an entry only the sender has
+    doc = await sender.docs().create()
+    author = await sender.authors().create()
+    val = os.urandom(256 * 1024)
+    await doc.set_bytes(author, b"big", val)
+    entry = await doc.get_one(Query.author_key_exact(author, b"big"))
+    #
+    # nothing partial yet, so everything is downloaded
+    stats = ResumeStats(await partial_blobs(receiver))
+    await complete_blob(receiver, entry, [peer], stats)
+    assert stats.blobs_downloaded == 1
+    assert stats.blobs_resumed == 0
+    assert stats.downloaded_bytes >= len(val)
+    assert val == await receiver.blobs().read_to_bytes(entry.content_hash())
+    #
+    # the blob is complete now, asking again is free
+    await complete_blob(receiver, entry, [peer], stats)
+    assert stats.blobs_downloaded == 1
+    assert await partial_blobs(receiver) == set()
+
+
+async def test_interrupted_download_is_resumed(monkeypatch):
+    iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+    options = NodeOptions()
+    options.enable_docs = True
+    send_dir = tempfile.TemporaryDirectory()
+    recv_dir = tempfile.TemporaryDirectory()
+    sender = await Iroh.persistent_with_options(send_dir.name, options)
+    receiver = await Iroh.persistent_with_options(recv_dir.name, options)
+    await receiver.net().add_node_addr(await sender.net().node_addr())
+    peer = PublicKey.from_string(await sender.net().node_id())
+    doc = await sender.docs().create()
+    author = await sender.authors().create()
+    size = 32 * 1024 * 1024
+    val = os.urandom(size)
+    await doc.set_bytes(author, b"big", val)
+    entry = await doc.get_one(Query.author_key_exact(author, b"big"))
+    #
+    # the first run stops a few MiB in
+    class Interrupting(resume.DownloadCallback):
+        async def progress(self, progress):
+            if progress.type() == iroh.DownloadProgressType.PROGRESS and progress.as_progress().offset > 4 * 1024 * 1024:
+                first.cancel()
+            await super().progress(progress)
+
+    monkeypatch.setattr(resume, "DownloadCallback", Interrupting)
+    first = asyncio.ensure_future(complete_blob(receiver, entry, [peer], ResumeStats()))
+    try:
+        await first
+    except asyncio.CancelledError:
+        pass
+    else:
+        assert False, "download was not interrupted"
+    monkeypatch.undo()
+    #
+    # the next one only fetches what is missing
+    partial = await partial_blobs(receiver)
+    assert partial == {entry.content_hash().to_hex()}
+    stats = ResumeStats(partial)
+    await complete_blob(receiver, entry, [peer], stats)
+    assert stats.blobs_resumed == 1
+    assert stats.resumed_bytes > 0
+    assert stats.downloaded_bytes < size
+    assert stats.resumed_bytes + stats.downloaded_bytes >= size
+    assert val == await receiver.blobs().read_to_bytes(entry.content_hash())
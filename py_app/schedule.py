@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from py_app.priorities import PRIORITIES
+
+"""
+Sharing the link between transfers that run at the same time.
+
+Every transfer (a receive in the daemon or the window, a sendme job) is
+registered with the Scheduler under a priority class, and asks it before
+each entry it moves (admit). The scheduler decides who goes next:
+
+    - at most max_active entries move at once. urgent and interactive
+      entries may also use reserved extra slots that normal and bulk ones
+      never get, so a small urgent file doesn't wait for a bulk one to end
+    - waiting entries are let through in weighted fair order: each one gets
+      a virtual finish time of (start + size / weight), the smallest goes
+      first. A transfer with twice the weight gets about twice the bytes,
+      no transfer is ever starved
+    - optional byte rate caps, for everything (rate) and per peer
+      (peer_rate), as token buckets charged with the size of each entry
+      that is let through
+
+Priorities can be changed while a transfer runs (set_priority), which
+moves its waiting entries in the queue.
+
+iroh moves the blobs itself, so we can't pace the bytes within an entry:
+the rate caps are kept on average across entries, a single entry bigger
+than the burst goes at the speed of the link and the next one waits until
+its bytes are paid for.
+"""
+
+RESERVED_FOR = ("urgent", "interactive")
+DEFAULT_MAX_ACTIVE = 8
+DEFAULT_RESERVED = 2
+DEFAULT_BURST = 1.0  # seconds worth of rate a bucket holds
+
+
+class TokenBucket:
+    # tokens are bytes. taking more than there is is allowed, it leaves the bucket in debt
+    def __init__(self, rate, burst=DEFAULT_BURST):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = rate * burst
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        # seconds until something may be taken
+        self.refill(now)
+        return 0.0 if self.tokens > 0 else max(-self.tokens / self.rate, 0.001)
+
+    def take(self, size):
+        self.tokens -= size
+
+
+class ScheduledTransfer:
+    def __init__(self, scheduler, id, name, priority, peer):
+        self.scheduler = scheduler
+        self.id = id
+        self.name = name
+        self.priority = priority
+        self.peer = peer
+        self.finish = 0.0  # virtual finish time of its last entry
+        self.active = 0
+        self.waiting = 0
+        self.bytes = 0  # bytes of the entries let through
+
+    @property
+    def weight(self):
+        return PRIORITIES[self.priority]
+
+    def admit(self, size):
+        return Admission(self.scheduler, self, size)
+
+    def status(self):
+        return {"id": self.id, "name": self.name, "priority": self.priority, "peer": self.peer,
+                "active": self.active, "waiting": self.waiting, "bytes": self.bytes}
+
+
+class Admission:
+    # async context manager around moving one entry
+    def __init__(self, scheduler, transfer, size):
+        self.scheduler = scheduler
+        self.transfer = transfer
+        self.size = size
+        self.reserved = False  # holding a reserved slot
+
+    async def __aenter__(self):
+        await self.scheduler.wait_turn(self)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release(self)
+
+
+class Waiter:
+    def __init__(self, admission, tag, future):
+        self.admission = admission
+        self.tag = tag
+        self.future = future
+
+
+class Scheduler:
+    def __init__(self, max_active=DEFAULT_MAX_ACTIVE, reserved=DEFAULT_RESERVED, rate=None, peer_rate=None,
+                 burst=DEFAULT_BURST):
+        if max_active <= 0:
+            raise ValueError("max_active must be positive")
+        self.max_active = max_active
+        self.reserved = reserved
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.peer_rate = peer_rate
+        self.burst = burst
+        self.peer_buckets = {}
+        self.transfers = {}
+        self.ids = itertools.count(1)
+        self.order = itertools.count()  # ties between equal tags go first come, first served
+        self.queue = []  # (tag, order, Waiter)
+        self.vtime = 0.0  # tag of the last entry let through
+        self.active = 0
+        self.active_reserved = 0
+        self.timer = None
+
+    #
+    # transfers
+    def transfer(self, name, priority="normal", peer=None):
+        if priority not in PRIORITIES:
+            raise ValueError("unknown priority {!r}".format(priority))
+        transfer = ScheduledTransfer(self, next(self.ids), name, priority, peer)
+        self.transfers[transfer.id] = transfer
+        return transfer
+
+    def finish(self, transfer):
+        self.transfers.pop(transfer.id, None)
+
+    def set_priority(self, transfer_id, priority):
+        if priority not in PRIORITIES:
+            raise ValueError("unknown priority {!r}".format(priority))
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            raise ValueError("no transfer {}".format(transfer_id))
+        transfer.priority = priority
+        # its waiting entries are tagged again as if they had just arrived with the new weight,
+        # in the order they were in (the heap's list isn't sorted)
+        transfer.finish = self.vtime
+        queue = [item for item in self.queue if item[2].admission.transfer is not transfer]
+        for tag, order, waiter in sorted(item for item in self.queue if item[2].admission.transfer is transfer):
+            waiter.tag = self.next_tag(transfer, waiter.admission.size)
+            queue.append((waiter.tag, order, waiter))
+        heapq.heapify(queue)
+        self.queue = queue
+        self.dispatch()
+
+    def status(self):
+        return [transfer.status() for transfer in self.transfers.values()]
+
+    #
+    # entries
+    def next_tag(self, transfer, size):
+        # at least 1 byte, so empty entries still take turns
+        transfer.finish = max(self.vtime, transfer.finish) + max(size, 1) / transfer.weight
+        return transfer.finish
+
+    async def wait_turn(self, admission):
+        transfer = admission.transfer
+        future = asyncio.get_running_loop().create_future()
+        waiter = Waiter(admission, self.next_tag(transfer, admission.size), future)
+        heapq.heappush(self.queue, (waiter.tag, next(self.order), waiter))
+        transfer.waiting += 1
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # let through just as we were cancelled, give the slot back
+                self.release(admission)
+            else:
+                self.queue = [item for item in self.queue if item[2] is not waiter]
+                heapq.heapify(self.queue)
+                transfer.waiting -= 1
+            raise
+
+    def release(self, admission):
+        admission.transfer.active -= 1
+        self.active -= 1
+        if admission.reserved:
+            self.active_reserved -= 1
+        self.dispatch()
+
+    def buckets(self, transfer):
+        buckets = [self.bucket] if self.bucket is not None else []
+        if self.peer_rate and transfer.peer is not None:
+            bucket = self.peer_buckets.get(transfer.peer)
+            if bucket is None:
+                bucket = self.peer_buckets[transfer.peer] = TokenBucket(self.peer_rate, self.burst)
+            buckets.append(bucket)
+        return buckets
+
+    def dispatch(self):
+        # let through, in tag order, every waiting entry that has a slot and whose buckets aren't in debt
+        now = time.monotonic()
+        retry = None  # seconds until a bucket has tokens again
+        held = []
+        while self.queue:
+            tag, order, waiter = heapq.heappop(self.queue)
+            admission = waiter.admission
+            transfer = admission.transfer
+            if waiter.future.done():
+                continue
+            normal_slot = self.active - self.active_reserved < self.max_active
+            reserved_slot = transfer.priority in RESERVED_FOR and self.active_reserved < self.reserved
+            if not normal_slot and not reserved_slot:
+                held.append((tag, order, waiter))
+                if self.active_reserved >= self.reserved or transfer.priority in RESERVED_FOR:
+                    # nothing behind this one can get a slot either
+                    break
+                continue
+            buckets = self.buckets(transfer)
+            wait = max([bucket.wait_time(now) for bucket in buckets] or [0.0])
+            if wait > 0:
+                held.append((tag, order, waiter))
+                retry = wait if retry is None else min(retry, wait)
+                continue
+            for bucket in buckets:
+                bucket.take(admission.size)
+            admission.reserved = not normal_slot
+            self.active += 1
+            if admission.reserved:
+                self.active_reserved += 1
+            self.vtime = max(self.vtime, tag)
+            transfer.waiting -= 1
+            transfer.active += 1
+            transfer.bytes += admission.size
+            waiter.future.set_result(None)
+        for item in held:
+            heapq.heappush(self.queue, item)
+        if retry is not None:
+            loop = asyncio.get_running_loop()
+            if self.timer is None or self.timer.when() > loop.time() + retry:
+                if self.timer is not None:
+                    self.timer.cancel()
+                self.timer = loop.call_later(retry, self.wake)
+
+    def wake(self):
+        self.timer = None
+        self.dispatch()
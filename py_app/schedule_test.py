@@ -0,0 +1,109 @@
+# tests for the transfer scheduler in schedule.py
+import asyncio
+import time
+
+from py_app.schedule import Scheduler
+from py_app.pipeline import receive_all
+
+
+class FakeEntry:
+    def __init__(self, key, size):
+        self._key = key
+        self._size = size
+
+    def key(self):
+        return self._key
+
+    def content_len(self):
+        return self._size
+
+
+async def hold(scheduled, size, name, order, release):
+    async with scheduled.admit(size):
+        order.append(name)
+        await release.wait()
+
+
+def test_weighted_fair_order_and_reprioritize():
+    async def run():
+        scheduler = Scheduler(max_active=1, reserved=0)
+        bulk = scheduler.transfer("backup", "bulk")
+        normal = scheduler.transfer("photos", "normal")
+        order, release = [], asyncio.Event()
+        first = asyncio.ensure_future(hold(bulk, 1000, "bulk-0", order, release))
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(hold(bulk, 1000, "bulk-{}".format(n), order, release)) for n in range(1, 4)]
+        tasks += [asyncio.ensure_future(hold(normal, 1000, "normal-{}".format(n), order, release)) for n in range(2)]
+        await asyncio.sleep(0)
+        assert order == ["bulk-0"] and bulk.status()["waiting"] == 3
+        # the photos count double the backup, and then become urgent
+        scheduler.set_priority(normal.id, "urgent")
+        release.set()
+        await asyncio.gather(first, *tasks)
+        return order
+
+    assert asyncio.run(run()) == ["bulk-0", "normal-0", "normal-1", "bulk-1", "bulk-2", "bulk-3"]
+
+
+def test_reprioritized_entries_keep_their_order():
+    async def run():
+        scheduler = Scheduler(max_active=1, reserved=0)
+        blocker = scheduler.transfer("blocker", "urgent")
+        bulk = scheduler.transfer("backup", "bulk")
+        normal = scheduler.transfer("photos", "normal")
+        order, release = [], asyncio.Event()
+        first = asyncio.ensure_future(hold(blocker, 1, "blocker", order, release))
+        await asyncio.sleep(0)
+        tasks = []
+        for n in range(6):
+            tasks.append(asyncio.ensure_future(hold(bulk, 1000, "bulk-{}".format(n), order, release)))
+            tasks.append(asyncio.ensure_future(hold(normal, 3000, "normal-{}".format(n), order, release)))
+            await asyncio.sleep(0)
+        scheduler.set_priority(bulk.id, "urgent")
+        release.set()
+        await asyncio.gather(first, *tasks)
+        return order
+
+    order = asyncio.run(run())
+    assert [name for name in order if name.startswith("bulk")] == ["bulk-{}".format(n) for n in range(6)]
+    # and they now go ahead of the photos
+    assert order[1:7] == ["bulk-{}".format(n) for n in range(6)]
+
+
+def test_urgent_entries_use_reserved_slots():
+    async def run():
+        scheduler = Scheduler(max_active=1, reserved=1)
+        bulk = scheduler.transfer("backup", "bulk")
+        urgent = scheduler.transfer("note", "urgent")
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.ensure_future(hold(bulk, 10 ** 9, "bulk-{}".format(n), order, release)) for n in range(2)]
+        await asyncio.sleep(0)
+        async with urgent.admit(10):
+            order.append("urgent")
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["bulk-0", "urgent", "bulk-1"]
+
+
+def test_rate_limit_and_receive_all():
+    received = []
+
+    async def receive(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer=None):
+        received.append(entry.key())
+        return entry.key()
+
+    async def run():
+        # 20 KB/s with a 0.1 second burst, 6 KB of entries: about 0.2 seconds once the burst is spent
+        scheduler = Scheduler(rate=20000, burst=0.1)
+        scheduled = scheduler.transfer("doc")
+        entries = [FakeEntry(bytes([n]), 1000) for n in range(6)]
+        start = time.monotonic()
+        result = await receive_all(None, None, entries, receive=receive, admit=lambda entry: scheduled.admit(entry.content_len()))
+        return result, time.monotonic() - start, scheduled.status()
+
+    result, elapsed, status = asyncio.run(run())
+    assert len(result.received) == 6 and not result.failed
+    assert 0.15 <= elapsed < 1.0
+    assert status["bytes"] == 6000 and status["active"] == 0 and status["waiting"] == 0
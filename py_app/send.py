@@ -0,0 +1,77 @@
+import iroh
+from iroh import path_to_key
+import mmap
+import os
+
+"""
+Helpers for getting files into a doc without reading them into python first.
+
+    - import: doc.import_file hands iroh the path and it hashes the file itself.
+      Files at or above the in place threshold are referenced where they are
+      instead of being copied into the blob store.
+    - set-bytes: for payloads that have to go through doc.set_bytes, the file
+      is memory mapped so the only copy made is the one into iroh.
+"""
+
+DEFAULT_IN_PLACE_THRESHOLD = 16 * 1024 * 1024  # 16 MiB
+INGEST_MODES = ("import", "set-bytes")
+
+
+def file_key(path, root=None):
+    # key the file relative to root (default: the folder it is in), same as doc_test does
+    path = os.path.abspath(path)
+    if root is None:
+        root = os.path.dirname(path)
+    return path_to_key(path, None, os.path.abspath(root))
+
+
+class ImportCallback:
+    # passed to doc.import_file, forwards hashing progress to on_progress
+    def __init__(self, key, total, on_progress):
+        self.key = key
+        self.total = total
+        self.on_progress = on_progress
+
+    async def progress(self, progress):
+        kind = progress.type()
+        if kind == iroh.DocImportProgressType.FOUND:
+            self.total = progress.as_found().size
+        elif kind == iroh.DocImportProgressType.PROGRESS:
+            self.on_progress(self.key, progress.as_progress().offset, self.total)
+        elif kind == iroh.DocImportProgressType.INGEST_DONE:
+            self.on_progress(self.key, self.total, self.total)
+
+
+async def import_path(doc, author, path, root=None, in_place_threshold=DEFAULT_IN_PLACE_THRESHOLD, on_progress=None):
+    # large files are referenced in place, small ones are copied into the store
+    # so later edits to them can't corrupt what we are serving
+    key = file_key(path, root)
+    size = os.path.getsize(path)
+    in_place = in_place_threshold is not None and size >= in_place_threshold
+    callback = ImportCallback(key, size, on_progress) if on_progress else None
+    await doc.import_file(author, key, os.path.abspath(path), in_place, callback)
+    return key
+
+
+async def set_bytes_mapped(doc, author, key, path):
+    # memory map the file and hand the mapping to set_bytes, nothing is read into a python buffer
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                return await doc.set_bytes(author, key, view)
+            finally:
+                view.release()
+
+
+async def send_file(doc, author, path, mode="import", root=None, in_place_threshold=DEFAULT_IN_PLACE_THRESHOLD, on_progress=None):
+    if os.path.getsize(path) == 0:
+        # an empty entry is how a doc says "deleted": set_bytes refuses one, import_file leaves no entry at all
+        raise ValueError("{} is empty, a doc can't hold it".format(path))
+    if mode == "import":
+        return await import_path(doc, author, path, root, in_place_threshold, on_progress)
+    elif mode == "set-bytes":
+        key = file_key(path, root)
+        await set_bytes_mapped(doc, author, key, path)
+        return key
+    raise ValueError("unknown ingest mode {!r}".format(mode))
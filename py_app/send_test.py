@@ -0,0 +1,47 @@
+# tests for the send side ingest helpers in send.py
+from iroh import Iroh, Query, NodeOptions
+import tempfile
+import os
+
+import pytest
+import asyncio
+import iroh
+
+from py_app.send import send_file, file_key
+
+
+async def test_send_file_modes():
+    # setup event loop, to ensure async callbacks work
+    iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+
+    #
+    # create files to share
+    dir = tempfile.TemporaryDirectory()
+    files = {}
+    for name, size in (("small", 100), ("large", 64 * 1024), ("empty", 0)):
+        path = os.path.join(dir.name, name)
+        files[path] = os.urandom(size)
+        with open(path, "wb") as f:
+            f.write(files[path])
+    #
+    # create node
+    iroh_dir = tempfile.TemporaryDirectory()
+    options = NodeOptions()
+    options.enable_docs = True
+    node = await Iroh.persistent_with_options(iroh_dir.name, options)
+    doc = await node.docs().create()
+    author = await node.authors().create()
+    #
+    # "large" goes in place, "small" gets copied, then everything again through the mmap path
+    for mode in ("import", "set-bytes"):
+        for path, val in files.items():
+            if not val:
+                # an empty entry would be a deletion
+                with pytest.raises(ValueError):
+                    await send_file(doc, author, path, mode, dir.name)
+                continue
+            key = await send_file(doc, author, path, mode, dir.name, in_place_threshold=1024)
+            assert key == file_key(path, dir.name)
+            entry = await doc.get_one(Query.author_key_exact(author, key))
+            assert len(val) == entry.content_len()
+            assert val == await node.blobs().read_to_bytes(entry.content_hash())
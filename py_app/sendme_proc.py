@@ -0,0 +1,239 @@
+import asyncio
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+
+from py_app.metrics import NO_METRICS
+
+"""
+Running the sendme cli from python.
+
+SendmeManager starts `sendme send` / `sendme receive` jobs without a shell,
+at most max_jobs at a time (the rest wait their turn). stdout and stderr of
+every job are read until the process exits so it can never block on a full
+pipe, and the lines sendme prints are turned into events:
+
+    ticket       sendme send printed the ticket to receive with
+    imported     sendme send finished importing the file or folder
+    collection   sendme receive found out what it is about to download
+    downloading  sendme receive is writing to this folder
+    transferred  sendme receive finished, with size, time and speed
+    output       any other line
+    exit         the process exited, data["returncode"]
+
+`sendme send` keeps serving until it gets ctrl-c, so cancelling a job sends
+SIGINT first (CTRL_BREAK_EVENT on Windows, where every job runs in its own
+process group for that) and only kills the process if it doesn't stop in
+time.
+
+With metrics (see metrics.py) every job is a transfer with a queued phase
+(waiting for a free slot) and a run phase (the process running).
+
+With a scheduler (see schedule.py) jobs wait for it instead of max_jobs,
+in order of their priority, and share it with whatever else uses it.
+sendme moves the bytes itself, so only when a job starts is scheduled.
+"""
+
+DEFAULT_MAX_JOBS = 4
+DEFAULT_STOP_TIMEOUT = 5.0  # seconds
+LINE_END = re.compile(rb"[\r\n]")  # progress bars use \r
+
+LINE_PATTERNS = (
+    ("ticket", re.compile(r"^sendme receive (?P<ticket>\S+)$")),
+    ("imported", re.compile(r"^imported (?P<type>file|directory) (?P<path>.+), (?P<size>[^,]+), hash (?P<hash>\S+)$")),
+    ("collection", re.compile(r"^getting collection (?P<hash>\S+) (?P<files>\d+) files, (?P<size>.+)$")),
+    ("downloading", re.compile(r"^downloading to: (?P<path>.+);$")),
+    ("transferred", re.compile(r"^Transferred (?P<size>.+) in (?P<elapsed>.+), (?P<speed>.+)/s$")),
+)
+
+
+def parse_line(line):
+    # turn one line of sendme output into (kind, data)
+    for kind, pattern in LINE_PATTERNS:
+        match = pattern.match(line)
+        if match:
+            return kind, match.groupdict()
+    return "output", {"line": line}
+
+
+class SendmeEvent:
+    def __init__(self, job, kind, data, stream=None):
+        self.job = job
+        self.kind = kind
+        self.data = data
+        self.stream = stream
+
+    def __repr__(self):
+        return "SendmeEvent(job={}, kind={!r}, data={!r})".format(self.job.id, self.kind, self.data)
+
+
+class SendmeJob:
+    def __init__(self, manager, id, args, cwd, own_cwd, priority="normal"):
+        self.manager = manager
+        self.id = id
+        self.args = args
+        self.scheduled = None
+        self.admission = None
+        if manager.scheduler is not None:
+            self.scheduled = manager.scheduler.transfer("sendme {} {}".format(args[0], id), priority)
+        self.cwd = cwd
+        self.own_cwd = own_cwd  # a temporary folder we made and clean up afterwards
+        self.process = None
+        self.returncode = None
+        self.ticket = asyncio.get_running_loop().create_future()
+        self.started = asyncio.Event()
+        self.task = None
+        self.stopping = False
+
+    async def wait_ticket(self):
+        # the ticket of a send job, raises if the process exits without printing one
+        return await asyncio.shield(self.ticket)
+
+    async def wait(self):
+        await asyncio.shield(self.task)
+        return self.returncode
+
+    def set_priority(self, priority):
+        # only changes anything while the job waits for its turn
+        if self.scheduled is not None:
+            self.manager.scheduler.set_priority(self.scheduled.id, priority)
+
+    async def cancel(self, timeout=DEFAULT_STOP_TIMEOUT):
+        self.stopping = True
+        if self.process is None:
+            # still queued
+            self.task.cancel()
+        elif self.process.returncode is None:
+            self.process.send_signal(signal.CTRL_BREAK_EVENT if sys.platform == "win32" else signal.SIGINT)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.process.wait()), timeout)
+            except asyncio.TimeoutError:
+                self.process.kill()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        return self.returncode
+
+    def emit(self, kind, data, stream=None):
+        if kind == "ticket" and not self.ticket.done():
+            self.ticket.set_result(data["ticket"])
+        self.manager.emit(SendmeEvent(self, kind, data, stream))
+
+    async def drain(self, stream, name):
+        # read everything the process writes, split into lines as it comes
+        buffer = bytearray()
+        while True:
+            chunk = await stream.read(64 * 1024)
+            if not chunk:
+                break
+            # only the new bytes can end a line, a long one isn't searched again every read
+            scanned = len(buffer)
+            buffer += chunk
+            start = 0
+            for match in LINE_END.finditer(buffer, scanned):
+                self.handle_line(bytes(buffer[start:match.start()]), name)
+                start = match.end()
+            del buffer[:start]
+        if buffer:
+            self.handle_line(bytes(buffer), name)
+
+    def handle_line(self, line, name):
+        line = line.decode("utf8", "replace").strip()
+        if line:
+            kind, data = parse_line(line)
+            self.emit(kind, data, name)
+
+    async def run(self):
+        transfer = self.manager.metrics.transfer("sendme " + self.args[0])
+        try:
+            with transfer.phase("queued"):
+                await self.manager.acquire(self)
+            try:
+                if self.stopping:
+                    return
+                with transfer.phase("run"):
+                    self.process = await asyncio.create_subprocess_exec(
+                        *self.manager.command, *self.args,
+                        cwd=self.cwd,
+                        stdin=asyncio.subprocess.DEVNULL,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if sys.platform == "win32" else 0,
+                    )
+                    self.started.set()
+                    await asyncio.gather(self.drain(self.process.stdout, "stdout"), self.drain(self.process.stderr, "stderr"))
+                    self.returncode = await self.process.wait()
+                self.manager.metrics.count("sendme_jobs_total", command=self.args[0], returncode=self.returncode)
+                self.emit("exit", {"returncode": self.returncode})
+            finally:
+                self.manager.release(self)
+        finally:
+            if self.scheduled is not None:
+                self.manager.scheduler.finish(self.scheduled)
+            if not self.ticket.done():
+                self.ticket.set_exception(RuntimeError("sendme job {} ended without a ticket".format(self.id)))
+                # nobody may be waiting on it, don't let asyncio complain
+                self.ticket.exception()
+            if self.own_cwd:
+                shutil.rmtree(self.cwd, ignore_errors=True)
+            self.manager.jobs.pop(self.id, None)
+
+
+class SendmeManager:
+    def __init__(self, max_jobs=DEFAULT_MAX_JOBS, command=("sendme",), on_event=None, metrics=NO_METRICS, scheduler=None):
+        self.command = tuple(command)
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.slots = asyncio.Semaphore(max_jobs)
+        self.on_event = on_event
+        self.jobs = {}
+        self.next_id = 0
+
+    def emit(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    async def acquire(self, job):
+        if job.scheduled is None:
+            await self.slots.acquire()
+        else:
+            job.admission = job.scheduled.admit(0)
+            await self.scheduler.wait_turn(job.admission)
+
+    def release(self, job):
+        if job.scheduled is None:
+            self.slots.release()
+        else:
+            self.scheduler.release(job.admission)
+
+    def start(self, args, cwd=None, priority="normal"):
+        self.next_id += 1
+        own_cwd = cwd is None
+        if own_cwd:
+            cwd = tempfile.mkdtemp(prefix="sendme-job-")
+        job = SendmeJob(self, self.next_id, list(args), cwd, own_cwd, priority)
+        job.task = asyncio.ensure_future(job.run())
+        self.jobs[job.id] = job
+        return job
+
+    def send(self, path, extra_args=(), priority="normal"):
+        # every send gets its own working folder, sendme refuses to share twice from one folder
+        return self.start(["send", os.path.abspath(path), *extra_args], priority=priority)
+
+    def receive(self, ticket, out_dir, extra_args=(), priority="normal"):
+        os.makedirs(out_dir, exist_ok=True)
+        return self.start(["receive", ticket, *extra_args], cwd=out_dir, priority=priority)
+
+    async def shutdown(self, timeout=DEFAULT_STOP_TIMEOUT):
+        await asyncio.gather(*(job.cancel(timeout) for job in list(self.jobs.values())), return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.shutdown()
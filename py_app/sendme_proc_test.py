@@ -0,0 +1,87 @@
+# tests for the sendme process manager in sendme_proc.py, using a stand in for the sendme binary
+import asyncio
+import sys
+import tempfile
+import textwrap
+
+from py_app.sendme_proc import SendmeManager, SendmeJob, parse_line
+
+FAKE_SENDME = textwrap.dedent("""
+    import signal, sys, time
+    if sys.argv[1] == "send":
+        try:
+            print("imported file {}, 12 B, hash abc123".format(sys.argv[2]))
+            print("to get this data, use")
+            print("sendme receive blobticket{}".format(sys.argv[2][-1]), flush=True)
+            # lots of output nobody reads would block on a full pipe
+            sys.stderr.write("x" * 1024 * 1024 + "\\r")
+            sys.stderr.flush()
+            time.sleep(60)
+        except KeyboardInterrupt:
+            print("shutting down")
+            sys.exit(0)
+    else:
+        sys.stderr.write("getting collection abc123 1 files, 12 B\\n")
+        sys.stderr.write("Transferred 12 B in 0s, 12 B/s\\n")
+        print("downloading to: file;")
+""")
+
+
+def test_parse_line():
+    assert parse_line("sendme receive blobabc") == ("ticket", {"ticket": "blobabc"})
+    assert parse_line("imported directory /tmp/a, b, 1.5 MiB, hash f00") == (
+        "imported", {"type": "directory", "path": "/tmp/a, b", "size": "1.5 MiB", "hash": "f00"})
+    assert parse_line("getting collection f00 3 files, 10 B")[0] == "collection"
+    assert parse_line("Transferred 10 B in 1s, 10 B/s")[1]["speed"] == "10 B"
+    assert parse_line("shutting down") == ("output", {"line": "shutting down"})
+
+
+def test_drain_splits_lines_across_reads():
+    lines = []
+
+    class Job:
+        def handle_line(self, line, name):
+            lines.append(line)
+
+    async def run():
+        reader = asyncio.StreamReader()
+
+        async def feed():
+            for piece in (b"abc", b"def\r", b"\nx" * 3, b"yz"):
+                reader.feed_data(piece)
+                await asyncio.sleep(0.01)
+            reader.feed_eof()
+
+        await asyncio.gather(feed(), SendmeJob.drain(Job(), reader, "stdout"))
+
+    asyncio.run(run())
+    assert lines == [b"abcdef", b"", b"x", b"x", b"xyz"]
+
+
+def test_manager_runs_jobs_concurrently_and_shuts_down():
+    dir = tempfile.TemporaryDirectory()
+    script = dir.name + "/fake_sendme.py"
+    with open(script, "w") as f:
+        f.write(FAKE_SENDME)
+
+    async def run():
+        events = []
+        async with SendmeManager(max_jobs=2, command=(sys.executable, script), on_event=events.append) as manager:
+            sends = [manager.send("file{}".format(i)) for i in range(3)]
+            tickets = await asyncio.wait_for(asyncio.gather(*(job.wait_ticket() for job in sends[:2])), 10)
+            assert tickets == ["blobticket0", "blobticket1"]
+            # only two slots, the third send is still queued
+            assert not sends[2].started.is_set()
+            assert await sends[0].cancel() == 0
+            assert await asyncio.wait_for(sends[2].wait_ticket(), 10) == "blobticket2"
+            #
+            receive = manager.receive(tickets[1], dir.name + "/out")
+            await sends[1].cancel()
+            assert await asyncio.wait_for(receive.wait(), 10) == 0
+        kinds = [event.kind for event in events if event.job is receive]
+        # stdout and stderr are read side by side, only exit is sure to come last
+        assert sorted(kinds[:-1]) == ["collection", "downloading", "transferred"]
+        assert kinds[-1] == "exit"
+        assert not manager.jobs
+
+    asyncio.run(run())
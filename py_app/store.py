@@ -0,0 +1,234 @@
+from iroh import Iroh, NodeOptions
+import os
+import sqlite3
+import tempfile
+import time
+
+from py_app.receive import target_path
+
+"""
+Where the node keeps its data between runs.
+
+With a data dir, iroh keeps its own state in <data_dir>/iroh: the node secret
+key, the default author, the docs we created or joined and every blob we have.
+On top of that state.db remembers
+    - which docs we have seen, their ticket and when they were last used
+    - which entries of a doc were already written to disk, so receiving a doc
+      again only writes what changed
+    - which folders we share, in which doc, and the size, mtime and hash of
+      every file in them (see dirsync.py), and which pack a small file went
+      into (see pack.py)
+    - which files on disk hold which content, whatever doc they came from,
+      so the same content is copied locally instead of fetched (see dedup.py)
+
+Without a data dir everything lives in a temporary folder like it used to.
+
+collect_garbage keeps the store under a size cap by dropping the least
+recently used docs. iroh's own gc then removes the blobs nothing else needs.
+"""
+
+DEFAULT_GC_INTERVAL_MILLIS = 60 * 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc_id TEXT PRIMARY KEY,
+    ticket TEXT,
+    role TEXT NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS received (
+    doc_id TEXT NOT NULL,
+    key BLOB NOT NULL,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (doc_id, key)
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    root TEXT PRIMARY KEY,
+    doc_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    doc_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    key BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    seen INTEGER NOT NULL,
+    PRIMARY KEY (doc_id, path)
+);
+CREATE TABLE IF NOT EXISTS packed (
+    doc_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    pack TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    key BLOB NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (doc_id, path)
+);
+CREATE INDEX IF NOT EXISTS packed_by_pack ON packed (doc_id, pack);
+CREATE TABLE IF NOT EXISTS content (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS content_by_hash ON content (hash);
+"""
+
+
+def default_data_dir():
+    return os.path.join(os.path.expanduser("~"), ".fileflow")
+
+
+class NodeStore:
+    def __init__(self, data_dir=None, gc=False):
+        self.tempdir = None
+        if data_dir is None:
+            self.tempdir = tempfile.TemporaryDirectory()
+            data_dir = self.tempdir.name
+        self.data_dir = data_dir
+        self.gc = gc
+        self.node = None
+        os.makedirs(data_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(data_dir, "state.db"))
+        self.db.executescript(SCHEMA)
+
+    @property
+    def persistent(self):
+        return self.tempdir is None
+
+    async def open(self):
+        options = NodeOptions()
+        options.enable_docs = True
+        if self.gc:
+            options.gc_interval_millis = DEFAULT_GC_INTERVAL_MILLIS
+        self.node = await Iroh.persistent_with_options(os.path.join(self.data_dir, "iroh"), options)
+        return self.node
+
+    async def author(self):
+        # the default author is kept by iroh, so it is the same one every run
+        return await self.node.authors().default()
+
+    def close(self):
+        self.db.close()
+
+    async def shutdown(self):
+        # stop the node, then close the database
+        if self.node is not None:
+            await self.node.node().shutdown()
+            self.node = None
+        self.close()
+
+    #
+    # docs
+    def remember_doc(self, doc_id, role, ticket=None):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO docs (doc_id, ticket, role, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(doc_id) DO UPDATE SET ticket = COALESCE(excluded.ticket, ticket), last_used = excluded.last_used",
+                (doc_id, ticket, role, time.time()),
+            )
+
+    def forget_doc(self, doc_id):
+        # everything we remember about a doc, after it was dropped from iroh
+        with self.db:
+            self.db.execute("DELETE FROM received WHERE doc_id = ?", (doc_id,))
+            self.db.execute("DELETE FROM files WHERE doc_id = ?", (doc_id,))
+            self.db.execute("DELETE FROM packed WHERE doc_id = ?", (doc_id,))
+            self.db.execute("DELETE FROM dirs WHERE doc_id = ?", (doc_id,))
+            self.db.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+
+    def known_docs(self):
+        return self.db.execute("SELECT doc_id, role, ticket, bytes, last_used FROM docs ORDER BY last_used DESC").fetchall()
+
+    #
+    # entries already written to disk
+    def is_received(self, doc_id, entry, out_dir=None):
+        # only skip entries whose content hasn't changed and whose file is still there and complete.
+        # with out_dir, also only if it was written there and not into some other folder
+        row = self.db.execute("SELECT hash, size, path FROM received WHERE doc_id = ? AND key = ?", (doc_id, entry.key())).fetchone()
+        if row is None:
+            return False
+        hash, size, path = row
+        if hash != entry.content_hash().to_hex() or size != entry.content_len():
+            return False
+        if out_dir is not None and path != os.path.abspath(target_path(entry.key(), out_dir)):
+            return False
+        try:
+            return os.path.getsize(path) == size
+        except OSError:
+            return False
+
+    def mark_received(self, doc_id, entry, path):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO received (doc_id, key, hash, size, path) VALUES (?, ?, ?, ?, ?)",
+                (doc_id, entry.key(), entry.content_hash().to_hex(), entry.content_len(), os.path.abspath(path)),
+            )
+            self.db.execute(
+                "UPDATE docs SET bytes = (SELECT COALESCE(SUM(size), 0) FROM received WHERE doc_id = ?), last_used = ? WHERE doc_id = ?",
+                (doc_id, time.time(), doc_id),
+            )
+        self.remember_content(entry.content_hash().to_hex(), path)
+
+    #
+    # content on disk, by hash
+    def remember_content(self, hash, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO content (path, hash, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                            (os.path.abspath(path), hash, stat.st_size, stat.st_mtime_ns))
+
+    def find_content(self, hash):
+        # a file that still holds the content with this hash, or None.
+        # files that were changed or removed since are forgotten on the way
+        for path, size, mtime_ns in self.db.execute("SELECT path, size, mtime_ns FROM content WHERE hash = ?", (hash,)).fetchall():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+                return path
+            with self.db:
+                self.db.execute("DELETE FROM content WHERE path = ?", (path,))
+        return None
+
+    def add_doc_bytes(self, doc_id, size):
+        with self.db:
+            self.db.execute("UPDATE docs SET bytes = bytes + ? WHERE doc_id = ?", (size, doc_id))
+
+    #
+    # shared folders
+    def dir_doc(self, root):
+        # the doc a folder was shared in before, or None
+        row = self.db.execute("SELECT doc_id FROM dirs WHERE root = ?", (os.path.abspath(root),)).fetchone()
+        return row[0] if row else None
+
+    def remember_dir(self, root, doc_id):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO dirs (root, doc_id) VALUES (?, ?)", (os.path.abspath(root), doc_id))
+
+    #
+    # garbage collection
+    async def collect_garbage(self, max_bytes, keep=()):
+        # drop least recently used docs until what is left fits in max_bytes.
+        # returns the ids of the docs that were dropped
+        dropped = []
+        total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM docs").fetchone()[0]
+        for doc_id, size in self.db.execute("SELECT doc_id, bytes FROM docs ORDER BY last_used ASC, rowid ASC").fetchall():
+            if total <= max_bytes:
+                break
+            if doc_id in keep:
+                continue
+            await self.node.docs().drop_doc(doc_id)
+            self.forget_doc(doc_id)
+            total -= size
+            dropped.append(doc_id)
+        return dropped
@@ -0,0 +1,105 @@
+# tests for the persistent node store bookkeeping in store.py
+import tempfile
+import asyncio
+import os
+
+from py_app.store import NodeStore
+from py_app.receive import target_path
+
+
+class FakeHash:
+    def __init__(self, hex):
+        self.hex = hex
+
+    def to_hex(self):
+        return self.hex
+
+
+class FakeEntry:
+    def __init__(self, key, hex, size):
+        self._key = key
+        self._hash = FakeHash(hex)
+        self._size = size
+
+    def key(self):
+        return self._key
+
+    def content_hash(self):
+        return self._hash
+
+    def content_len(self):
+        return self._size
+
+
+class FakeDocs:
+    def __init__(self):
+        self.dropped = []
+
+    async def drop_doc(self, doc_id):
+        self.dropped.append(doc_id)
+
+
+class FakeNode:
+    def __init__(self):
+        self._docs = FakeDocs()
+
+    def docs(self):
+        return self._docs
+
+
+def test_received_entries_survive_a_restart():
+    dir = tempfile.TemporaryDirectory()
+    path = os.path.join(dir.name, "file")
+    with open(path, "wb") as f:
+        f.write(b"12345")
+    entry = FakeEntry(b"file", "aa", 5)
+    #
+    store = NodeStore(dir.name)
+    store.remember_doc("doc", "joined", "ticket")
+    assert not store.is_received("doc", entry)
+    store.mark_received("doc", entry, path)
+    store.close()
+    #
+    # a new run with the same data dir knows about the entry
+    store = NodeStore(dir.name)
+    assert store.is_received("doc", entry)
+    assert store.known_docs()[0][:4] == ("doc", "joined", "ticket", 5)
+    # changed content, or a file that was removed, has to be received again
+    assert not store.is_received("doc", FakeEntry(b"file", "bb", 5))
+    os.remove(path)
+    assert not store.is_received("doc", entry)
+    store.close()
+
+
+def test_received_into_another_folder_is_not_skipped():
+    dir = tempfile.TemporaryDirectory()
+    first, second = os.path.join(dir.name, "first"), os.path.join(dir.name, "second")
+    entry = FakeEntry(b"file", "aa", 5)
+    store = NodeStore(os.path.join(dir.name, "data"))
+    store.remember_doc("doc", "joined", "ticket")
+    for out_dir in (first, second):
+        # the second folder is empty, everything in it has to be written
+        assert not store.is_received("doc", entry, out_dir)
+        path = target_path(entry.key(), out_dir)
+        os.makedirs(out_dir)
+        with open(path, "wb") as f:
+            f.write(b"12345")
+        store.mark_received("doc", entry, path)
+        assert store.is_received("doc", entry, out_dir)
+    store.close()
+
+
+def test_collect_garbage_drops_least_recently_used():
+    dir = tempfile.TemporaryDirectory()
+    store = NodeStore(dir.name)
+    store.node = FakeNode()
+    for doc_id in ("old", "middle", "new"):
+        store.remember_doc(doc_id, "joined")
+        store.add_doc_bytes(doc_id, 100)
+    #
+    # "old" is the least recently used, but we are told to keep it
+    dropped = asyncio.run(store.collect_garbage(150, keep={"old"}))
+    assert dropped == ["middle", "new"]
+    assert store.node.docs().dropped == dropped
+    assert [row[0] for row in store.known_docs()] == ["old"]
+    store.close()
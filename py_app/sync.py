@@ -0,0 +1,74 @@
+import iroh
+import asyncio
+
+from py_app.metrics import NULL_TRANSFER
+
+"""
+Joining a doc and waiting for it to be usable.
+
+Instead of sleeping and hoping, we subscribe to the doc's live events while
+joining. The doc counts as ready once a sync with the remote has finished and
+every blob that sync told us about is in the local store.
+
+With download=False only the entries are synced: the doc's download policy
+is set to nothing as soon as it is joined and the doc is ready once the sync
+finished. Blobs are then fetched one by one by the caller (see resume.py),
+e.g. to leave out content that is already on disk (dedup.py). The policy can
+only be set once the doc is joined, so blobs from the very first sync
+message may still be downloaded.
+"""
+
+DEFAULT_SYNC_TIMEOUT = 30.0  # seconds
+
+
+class SyncWatcher:
+    # SubscribeCallback that keeps track of the entries and blobs we are still waiting on
+    def __init__(self, content=True):
+        self.content = content  # wait for blobs too, not just entries
+        self.synced = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.pending = set()
+        self.entries = 0
+        self.pending_content_ready = False
+        self.peers = {}  # node id string -> PublicKey of everyone we synced with
+
+    async def event(self, event):
+        kind = event.type()
+        if kind == iroh.LiveEventType.INSERT_REMOTE:
+            insert = event.as_insert_remote()
+            self.entries += 1
+            self.peers[str(insert._from)] = insert._from
+            if insert.content_status != iroh.ContentStatus.COMPLETE:
+                self.pending.add(insert.entry.content_hash().to_hex())
+        elif kind == iroh.LiveEventType.CONTENT_READY:
+            self.pending.discard(event.as_content_ready().to_hex())
+        elif kind == iroh.LiveEventType.SYNC_FINISHED:
+            peer = event.as_sync_finished().peer
+            self.peers[str(peer)] = peer
+            self.synced.set()
+        elif kind == iroh.LiveEventType.PENDING_CONTENT_READY:
+            # iroh has finished (or given up on) every download queued by the sync
+            self.pending_content_ready = True
+        self.check_ready()
+
+    def check_ready(self):
+        if self.synced.is_set() and (not self.content or not self.pending or self.pending_content_ready):
+            self.ready.set()
+
+
+async def join_and_wait(node, ticket, timeout=DEFAULT_SYNC_TIMEOUT, watcher=None, download=True, transfer=NULL_TRANSFER):
+    # join the doc, returning once the remote's entries and their content are local
+    # or timeout seconds have passed, whichever is first. watcher.ready tells you which.
+    # transfer (see metrics.py) gets a join and a sync phase
+    if watcher is None:
+        watcher = SyncWatcher(content=download)
+    with transfer.phase("join"):
+        doc = await node.docs().join_and_subscribe(iroh.DocTicket(ticket), watcher)
+        if not download:
+            await doc.set_download_policy(iroh.DownloadPolicy.nothing())
+    with transfer.phase("sync"):
+        try:
+            await asyncio.wait_for(watcher.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    return doc, watcher
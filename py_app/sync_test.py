@@ -0,0 +1,38 @@
+# tests for joining a doc and waiting on its live events in sync.py
+from iroh import Iroh, Query, NodeOptions
+import tempfile
+import asyncio
+import iroh
+
+from py_app.sync import join_and_wait
+
+
+async def test_join_and_wait():
+    # setup event loop, to ensure async callbacks work
+    iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+
+    #
+    # create a sending and a receiving node
+    options = NodeOptions()
+    options.enable_docs = True
+    send_dir = tempfile.TemporaryDirectory()
+    recv_dir = tempfile.TemporaryDirectory()
+    sender = await Iroh.persistent_with_options(send_dir.name, options)
+    receiver = await Iroh.persistent_with_options(recv_dir.name, options)
+    #
+    # share a doc with a few entries in it
+    doc = await sender.docs().create()
+    author = await sender.authors().create()
+    values = {"key{}".format(i).encode(): "value {}".format(i).encode() * 1000 for i in range(5)}
+    for key, val in values.items():
+        await doc.set_bytes(author, key, val)
+    ticket = await doc.share(iroh.ShareMode.READ, iroh.AddrInfoOptions.RELAY_AND_ADDRESSES)
+    #
+    # once join_and_wait returns every entry and blob should be readable
+    joined, watcher = await join_and_wait(receiver, str(ticket), timeout=30)
+    assert watcher.ready.is_set()
+    assert not watcher.pending
+    entries = await joined.get_many(Query.all(None))
+    assert len(entries) == len(values)
+    for entry in entries:
+        assert values[entry.key()] == await receiver.blobs().read_to_bytes(entry.content_hash())
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from py_app.daemon_client import DaemonClient, start_daemon
+
+"""
+What the daemon saves: the cost of booting a node per invocation (what
+main.py pays every time) against starting the daemon once and then paying
+one request per send.
+
+    python -m py_app.tests.bench_daemon --requests 200 --out daemon.json
+
+Measured:
+    cold_boot_s        fresh python process, import, open node, read node id
+    daemon_start_s     start_daemon() until the daemon answers status
+    status_rpc_s       one status call on an open connection
+    connect_rpc_s      connect + status call + close
+    client_process_s   `python -m py_app.daemon_client status`, a whole client process
+    send_rpc_s         sending a 1 KiB file through the daemon
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "mean": statistics.mean(samples),
+        "p50": samples[len(samples) // 2],
+        "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        "min": samples[0],
+    }
+
+
+async def cold_boot(data_dir):
+    from py_app.store import NodeStore
+    import iroh
+    iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+    store = NodeStore(data_dir)
+    node = await store.open()
+    await node.net().node_id()
+
+
+def time_cold_boot(data_dir):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "py_app.tests.bench_daemon", "--cold-boot", data_dir], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def time_calls(requests, call):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return summary(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Daemon startup and request latency benchmark')
+    parser.add_argument('--requests', type=int, default=100, help='requests per measurement')
+    parser.add_argument('--cold-boots', type=int, default=5, help='node boots in fresh processes to compare with')
+    parser.add_argument('--out', type=str, default='bench_daemon.json', help='where the JSON results are written')
+    parser.add_argument('--cold-boot', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_boot:
+        asyncio.run(cold_boot(args.cold_boot))
+        return
+
+    work = tempfile.TemporaryDirectory()
+    results = {}
+    results["cold_boot_s"] = summary([time_cold_boot(os.path.join(work.name, "cold")) for _ in range(args.cold_boots)])
+
+    data_dir = os.path.join(work.name, "daemon")
+    socket_path = os.path.join(work.name, "daemon.sock")
+    start = time.perf_counter()
+    start_daemon(data_dir, socket_path)
+    results["daemon_start_s"] = time.perf_counter() - start
+    try:
+        with DaemonClient(socket_path) as client:
+            results["status_rpc_s"] = time_calls(args.requests, lambda: client.call("status"))
+            small = os.path.join(work.name, "small")
+            with open(small, "wb") as f:
+                f.write(os.urandom(1024))
+            results["send_rpc_s"] = time_calls(args.requests, lambda: client.call("send", path=small))
+
+        def connect_and_call():
+            with DaemonClient(socket_path) as client:
+                client.call("status")
+
+        results["connect_rpc_s"] = time_calls(args.requests, connect_and_call)
+        client_command = [sys.executable, "-m", "py_app.daemon_client", "--socket", socket_path, "status"]
+        results["client_process_s"] = time_calls(min(args.requests, 20), lambda: subprocess.run(
+            client_command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL))
+    finally:
+        with DaemonClient(socket_path) as client:
+            client.call("stop")
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "created": time.time(), "results": results}
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    for name, value in results.items():
+        print("{:20} {}".format(name, value if isinstance(value, float) else "p50 {:.4f}s".format(value["p50"])))
+    print("Wrote {}".format(args.out))
+
+
+if __name__ == "__main__":
+    main()
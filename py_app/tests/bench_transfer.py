@@ -0,0 +1,264 @@
+import iroh
+from iroh import Iroh, Query, NodeOptions, PublicKey
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from py_app.send import send_file
+from py_app.sync import SyncWatcher, join_and_wait
+from py_app.pipeline import receive_all
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, cases there have no peak rss or cpu split
+    resource = None
+
+"""
+Loopback benchmark: a sending and a receiving node in one process, talking
+over 127.0.0.1 with discovery and relays off and tickets that only carry
+direct addresses, so nothing leaves the machine. The iroh 0.35 bindings
+have no relay setting yet; with those the nodes still dial their home
+relay, and the report says so. Each case records the connection type the
+receiver had to the sender, "direct" unless a relay was used.
+
+Every combination of file size, entry count, concurrency, ingest path
+(set-bytes / import) and receive path (read_to_bytes / export) is one case.
+Each case runs in its own python process so peak RSS and cpu time belong to
+that case alone. Results go to a JSON file, run it on two commits and
+compare.
+
+    python -m py_app.tests.bench_transfer --sizes 1K 1M 64M 1G --entries 1 100 --out before.json
+"""
+
+DEFAULT_SIZES = ("1K", "1M", "64M", "1G")
+DEFAULT_ENTRIES = (1, 100)
+DEFAULT_CONCURRENCY = (1, 8)
+INGEST_PATHS = ("set-bytes", "import")
+RECEIVE_PATHS = ("read_to_bytes", "export")
+DEFAULT_MAX_CASE_BYTES = 4 * 1024 ** 3
+DEFAULT_CASE_TIMEOUT = 1800  # seconds
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B").rstrip("I")
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+class TimedWatcher(SyncWatcher):
+    # SyncWatcher that also notes when the first blob arrived
+    def __init__(self):
+        super().__init__()
+        self.first_content = None
+
+    async def event(self, event):
+        if self.first_content is None and event.type() == iroh.LiveEventType.CONTENT_READY:
+            self.first_content = time.perf_counter()
+        await super().event(event)
+
+
+def make_files(root, entries, size):
+    # random content so iroh can't dedupe entries against each other
+    paths = []
+    for i in range(entries):
+        path = os.path.join(root, "entry{:06}".format(i))
+        with open(path, "wb") as f:
+            left = size
+            while left > 0:
+                chunk = min(left, 1024 * 1024)
+                f.write(os.urandom(chunk))
+                left -= chunk
+        paths.append(path)
+    return paths
+
+
+def relay_setting():
+    # how bench_options deals with relays, for the report
+    if hasattr(NodeOptions(), "relay_mode"):
+        return "disabled"
+    return "not settable in these bindings"
+
+
+def bench_options():
+    options = NodeOptions()
+    options.enable_docs = True
+    options.node_discovery = iroh.NodeDiscoveryConfig.NONE
+    options.ipv4_addr = "127.0.0.1:0"
+    if hasattr(options, "relay_mode"):
+        options.relay_mode = iroh.RelayMode.DISABLED
+    return options
+
+
+async def connection_type(node, peer):
+    # how node reached peer: direct, relay, mixed or none
+    info = await node.net().remote_info(PublicKey.from_string(peer))
+    if info is None:
+        return "none"
+    return info.conn_type.type().name.lower()
+
+
+async def gather_limited(limit, coros):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+async def run_case(case):
+    # setup event loop, to ensure async callbacks work
+    iroh.iroh_ffi.uniffi_set_event_loop(asyncio.get_running_loop())
+
+    work = tempfile.TemporaryDirectory()
+    src = os.path.join(work.name, "src")
+    out = os.path.join(work.name, "out")
+    os.makedirs(src)
+    paths = make_files(src, case["entries"], case["size"])
+    total = case["entries"] * case["size"]
+
+    sender = await Iroh.persistent_with_options(os.path.join(work.name, "send"), bench_options())
+    receiver = await Iroh.persistent_with_options(os.path.join(work.name, "recv"), bench_options())
+    doc = await sender.docs().create()
+    author = await sender.authors().default()
+    result = dict(case)
+    #
+    # ingest
+    start, cpu = time.perf_counter(), time.process_time()
+    await gather_limited(case["concurrency"], [send_file(doc, author, path, case["ingest"], src) for path in paths])
+    result["ingest_s"] = time.perf_counter() - start
+    result["ingest_cpu_s"] = time.process_time() - cpu
+    ticket = await doc.share(iroh.ShareMode.READ, iroh.AddrInfoOptions.ADDRESSES)
+    #
+    # sync, this is where the blobs cross the wire
+    start, cpu = time.perf_counter(), time.process_time()
+    rdoc, watcher = await join_and_wait(receiver, str(ticket), case["timeout"], TimedWatcher())
+    result["sync_s"] = time.perf_counter() - start
+    result["sync_cpu_s"] = time.process_time() - cpu
+    result["sync_complete"] = watcher.ready.is_set() and not watcher.pending
+    result["ttfb_s"] = (watcher.first_content or time.perf_counter()) - start
+    result["connection"] = await connection_type(receiver, await sender.net().node_id())
+    entries = await rdoc.get_many(Query.all(None))
+    #
+    # getting the data out of the store
+    receive_start, cpu = time.perf_counter(), time.process_time()
+    first = []
+
+    def on_first_byte(*_):
+        if not first:
+            first.append(time.perf_counter())
+
+    if case["receive"] == "read_to_bytes":
+        async def read(entry):
+            data = await receiver.blobs().read_to_bytes(entry.content_hash())
+            on_first_byte()
+            return len(data)
+
+        received = sum(await gather_limited(case["concurrency"], [read(entry) for entry in entries]))
+    else:
+        done = await receive_all(receiver, rdoc, entries, out, "export", max_entries=case["concurrency"], on_progress=on_first_byte)
+        received = done.bytes
+    result["receive_s"] = time.perf_counter() - receive_start
+    result["receive_cpu_s"] = time.process_time() - cpu
+    result["receive_first_byte_s"] = (first[0] if first else time.perf_counter()) - receive_start
+    result["received_bytes"] = received
+    result["ok"] = received == total and len(entries) == case["entries"]
+    #
+    # totals
+    elapsed = result["sync_s"] + result["receive_s"]
+    result["throughput_mib_s"] = total / elapsed / 1024 ** 2 if elapsed else None
+    result["ingest_mib_s"] = total / result["ingest_s"] / 1024 ** 2 if result["ingest_s"] else None
+    result["peak_rss_mib"] = result["cpu_user_s"] = result["cpu_system_s"] = None
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        result["peak_rss_mib"] = usage.ru_maxrss / 1024  # ru_maxrss is in KiB on linux
+        result["cpu_user_s"] = usage.ru_utime
+        result["cpu_system_s"] = usage.ru_stime
+    # a node still running when python exits takes the process down with it
+    await sender.node().shutdown()
+    await receiver.node().shutdown()
+    work.cleanup()
+    return result
+
+
+def build_cases(args):
+    cases = []
+    for size, entries, concurrency, ingest, receive in itertools.product(
+            args.sizes, args.entries, args.concurrency, args.ingest, args.receive):
+        if size * entries > args.max_case_bytes:
+            continue
+        cases.append({"size": size, "entries": entries, "concurrency": concurrency,
+                      "ingest": ingest, "receive": receive, "timeout": args.case_timeout})
+    return cases
+
+
+def run_in_child(case):
+    proc = subprocess.run(
+        [sys.executable, "-m", "py_app.tests.bench_transfer", "--run-case", json.dumps(case)],
+        cwd=ROOT, capture_output=True, text=True, timeout=case["timeout"] + 60,
+    )
+    if proc.returncode != 0:
+        # the last line of the traceback, always a string
+        lines = proc.stderr.strip().splitlines()
+        return dict(case, ok=False, error=lines[-1] if lines else "exit {}".format(proc.returncode))
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback two node transfer benchmark')
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[parse_size(s) for s in DEFAULT_SIZES], help='file sizes, e.g. 1K 64M 2G')
+    parser.add_argument('--entries', nargs='+', type=int, default=list(DEFAULT_ENTRIES), help='number of entries per doc')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=list(DEFAULT_CONCURRENCY), help='entries ingested/received at once')
+    parser.add_argument('--ingest', nargs='+', choices=INGEST_PATHS, default=list(INGEST_PATHS))
+    parser.add_argument('--receive', nargs='+', choices=RECEIVE_PATHS, default=list(RECEIVE_PATHS))
+    parser.add_argument('--max-case-bytes', type=parse_size, default=DEFAULT_MAX_CASE_BYTES, help='skip cases moving more than this')
+    parser.add_argument('--case-timeout', type=int, default=DEFAULT_CASE_TIMEOUT, help='seconds before a case is given up on')
+    parser.add_argument('--out', type=str, default='bench_output.json', help='where the JSON results are written')
+    parser.add_argument('--run-case', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(asyncio.run(run_case(json.loads(args.run_case)))))
+        return
+
+    cases = build_cases(args)
+    results = []
+    for i, case in enumerate(cases, 1):
+        print("[{}/{}] {}".format(i, len(cases), case), flush=True)
+        results.append(run_in_child(case))
+        print("    {}".format({k: results[-1].get(k) for k in ("ok", "throughput_mib_s", "ttfb_s", "peak_rss_mib")}), flush=True)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "network": {"bind": "127.0.0.1", "discovery": "none", "relays": relay_setting(), "ticket": "direct addresses"},
+        "created": time.time(),
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Wrote {} results to {}".format(len(results), args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,30 @@ import sys
 
 from PyQt6.QtCore import QSize, Qt
 from PyQt6.QtGui import QAction, QCursor
-from PyQt6.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QWidget, QVBoxLayout, QLineEdit, QMenu
+from PyQt6.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QWidget, QVBoxLayout, QLineEdit, QMenu, QProgressBar, QFileDialog, QComboBox
+
+from py_app.ui.worker import TransferWorker
+from py_app.ui.transfer_model import TransferModel, TransferView
+from py_app.schedule import PRIORITIES
 
 
 # Subclass QMainWindow to customize your application's main window
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, data_dir=None):
         super().__init__()
 
         self.button_is_checked = True
 
+        # transfers run on the worker's own asyncio loop, we only hear back through signals
+        self.worker = TransferWorker(data_dir)
+        self.worker.progress.connect(self.on_progress)
+        self.transfers = TransferModel(self)
+        self.worker.entry_progress.connect(self.on_entry_progress)
+        self.worker.message.connect(self.on_message)
+        self.worker.shared.connect(self.on_shared)
+        self.worker.finished.connect(self.on_finished)
+        self.worker.failed.connect(self.on_failed)
+
         self.setWindowTitle("File Flow")
 
         layout = QVBoxLayout()
@@ -35,6 +49,37 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.input)
         layout.addWidget(self.button)
 
+        # transfers
+        self.send_button = QPushButton("Send file...")
+        self.send_button.clicked.connect(self.choose_file)
+        self.ticket_input = QLineEdit()
+        self.ticket_input.setPlaceholderText("Paste a ticket to receive")
+        self.receive_button = QPushButton("Receive")
+        self.receive_button.clicked.connect(self.start_receive)
+        # for the next receive, and for the one that is running
+        self.priority_input = QComboBox()
+        self.priority_input.addItems(list(PRIORITIES))
+        self.priority_input.setCurrentText("normal")
+        self.priority_input.currentTextChanged.connect(self.change_priority)
+        self.receiving = None  # transfer id of the running receive
+        self.progress_bar = QProgressBar()
+        self.status_label = QLabel()
+        self.status_label.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
+        self.status_label.setWordWrap(True)
+        self.transfer_filter = QLineEdit()
+        self.transfer_filter.setPlaceholderText("Filter files")
+        self.transfer_view = TransferView(self.transfers)
+        self.transfer_filter.textChanged.connect(self.transfer_view.set_filter)
+
+        layout.addWidget(self.send_button)
+        layout.addWidget(self.ticket_input)
+        layout.addWidget(self.priority_input)
+        layout.addWidget(self.receive_button)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.status_label)
+        layout.addWidget(self.transfer_filter)
+        layout.addWidget(self.transfer_view)
+
 
         window = QWidget()
         window.setLayout(layout)
@@ -44,6 +89,50 @@ class MainWindow(QMainWindow):
         # Set the central widget of the Window.
         self.setCentralWidget(window)
     
+    def choose_file(self):
+        path, _ = QFileDialog.getOpenFileName(self, "File to send")
+        if path:
+            self.worker.send_file(path)
+
+    def start_receive(self):
+        ticket = self.ticket_input.text().strip()
+        if ticket:
+            out_dir = QFileDialog.getExistingDirectory(self, "Save to")
+            if out_dir:
+                self.receiving = self.worker.receive(ticket, out_dir, self.priority_input.currentText())
+
+    def change_priority(self, priority):
+        if self.receiving is not None:
+            self.worker.set_priority(self.receiving, priority)
+
+    def on_progress(self, transfer_id, done, total):
+        # progress bars only hold an int, so show it as a percentage
+        self.progress_bar.setValue(100 * done // total if total else 100)
+
+    def on_entry_progress(self, updates):
+        # a frame's worth of per file progress, the model applies it in one go
+        self.transfers.update_many(((transfer_id, key), done, total) for transfer_id, key, done, total in updates)
+
+    def on_message(self, transfer_id, text):
+        self.status_label.setText(text)
+
+    def on_shared(self, transfer_id, ticket):
+        self.status_label.setText("Ticket: {}".format(ticket))
+
+    def on_finished(self, transfer_id):
+        self.progress_bar.setValue(100)
+        if transfer_id == self.receiving:
+            self.receiving = None
+
+    def on_failed(self, transfer_id, error):
+        if transfer_id == self.receiving:
+            self.receiving = None
+        self.status_label.setText("Transfer failed: {}".format(error))
+
+    def closeEvent(self, e):
+        self.worker.stop()
+        super().closeEvent(e)
+
     def change_label(self, text):
         self.label.setText(f"<h1>{text}<h1>")
 
@@ -101,12 +190,17 @@ class MainWindow(QMainWindow):
 
 
 
-app = QApplication(sys.argv)
+def main(data_dir=None):
+    app = QApplication(sys.argv)
+
+    window = MainWindow(data_dir)
+    #window.setWindowTitle("File Flow")
+    #window.setGeometry(50, 50, 800, 300)
+
+    window.show()
 
-window = MainWindow()
-#window.setWindowTitle("File Flow")
-#window.setGeometry(50, 50, 800, 300)
+    return app.exec()
 
-window.show()
 
-app.exec()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,188 @@
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex, QSortFilterProxyModel, QTimer
+from PyQt6.QtWidgets import QApplication, QHeaderView, QStyle, QStyledItemDelegate, QStyleOptionProgressBar, QTableView
+
+"""
+A transfer list that copes with a doc of 100k entries.
+
+TransferModel keeps one flat list per column instead of a widget or object
+per row, and only builds what the view asks for in data(), i.e. the rows
+that are on screen. Progress updates are collected in a dict and applied
+once a frame with a single dataChanged for the rows that moved, no matter
+how many updates came in. Sorting and filtering go through a
+QSortFilterProxyModel, which only keeps a row mapping, never a copy.
+"""
+
+FRAME_MS = 16
+
+NAME, SIZE, PROGRESS, STATUS = range(4)
+HEADERS = ("Name", "Size", "Progress", "Status")
+
+
+def human_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return "{:.0f} {}".format(size, unit) if unit == "B" else "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
+
+
+def display_name(key):
+    # keys are doc keys, or (transfer id, doc key) when several transfers share a model
+    if isinstance(key, tuple):
+        key = key[-1]
+    if isinstance(key, bytes):
+        return key.rstrip(b"\0").decode("utf8", "replace")
+    return str(key)
+
+
+class TransferModel(QAbstractTableModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.keys = []
+        self.names = []
+        self.sizes = []
+        self.done = []
+        self.status = []
+        self.rows = {}  # key -> row
+        self.pending = {}  # key -> (done, total), applied on the next frame
+        self.timer = QTimer(self)
+        self.timer.setInterval(FRAME_MS)
+        self.timer.timeout.connect(self.flush)
+
+    #
+    # QAbstractTableModel
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.keys)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == NAME:
+                return self.names[row]
+            elif column == SIZE:
+                return human_size(self.sizes[row])
+            elif column == PROGRESS:
+                return "{}%".format(self.percent(row))
+            elif column == STATUS:
+                return self.status[row]
+        elif role == Qt.ItemDataRole.UserRole:
+            # raw values, used for sorting and by the progress delegate
+            if column == NAME:
+                return self.names[row]
+            elif column == SIZE:
+                return self.sizes[row]
+            elif column == PROGRESS:
+                return self.percent(row)
+            elif column == STATUS:
+                return self.status[row]
+        elif role == Qt.ItemDataRole.TextAlignmentRole and column in (SIZE, PROGRESS):
+            return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        return None
+
+    def percent(self, row):
+        size = self.sizes[row]
+        return 100 * self.done[row] // size if size else (100 if self.status[row] == "done" else 0)
+
+    #
+    # feeding it
+    def add_entries(self, entries):
+        # entries: iterable of (key, size). One insert for the whole batch
+        entries = [(key, size) for key, size in entries if key not in self.rows]
+        if not entries:
+            return
+        first = len(self.keys)
+        self.beginInsertRows(QModelIndex(), first, first + len(entries) - 1)
+        for key, size in entries:
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+            self.names.append(display_name(key))
+            self.sizes.append(size)
+            self.done.append(0)
+            self.status.append("queued")
+        self.endInsertRows()
+
+    def update_progress(self, key, done, total):
+        # cheap, can be called any number of times a frame
+        self.pending[key] = (done, total)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def update_many(self, updates):
+        for key, done, total in updates:
+            self.update_progress(key, done, total)
+
+    def set_status(self, key, status):
+        row = self.rows.get(key)
+        if row is not None:
+            self.status[row] = status
+            index = self.index(row, STATUS)
+            self.dataChanged.emit(index, index)
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            self.timer.stop()
+            return
+        new = [(key, total) for key, (done, total) in pending.items() if key not in self.rows]
+        self.add_entries(new)
+        first = last = None
+        for key, (done, total) in pending.items():
+            row = self.rows[key]
+            self.sizes[row] = total
+            self.done[row] = done
+            self.status[row] = "done" if done >= total else "receiving"
+            first = row if first is None else min(first, row)
+            last = row if last is None else max(last, row)
+        # one signal for everything that changed this frame, the view only repaints what is visible
+        self.dataChanged.emit(self.index(first, SIZE), self.index(last, STATUS))
+
+
+class ProgressDelegate(QStyledItemDelegate):
+    # draws the progress column as a bar
+    def paint(self, painter, option, index):
+        percent = index.data(Qt.ItemDataRole.UserRole)
+        bar = QStyleOptionProgressBar()
+        bar.rect = option.rect
+        bar.minimum = 0
+        bar.maximum = 100
+        bar.progress = percent or 0
+        bar.text = "{}%".format(bar.progress)
+        bar.textVisible = True
+        bar.state = option.state
+        QApplication.style().drawControl(QStyle.ControlElement.CE_ProgressBar, bar, painter)
+
+
+class TransferView(QTableView):
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.proxy = QSortFilterProxyModel(self)
+        self.proxy.setSourceModel(model)
+        self.proxy.setSortRole(Qt.ItemDataRole.UserRole)
+        self.proxy.setFilterKeyColumn(NAME)
+        self.proxy.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        # re-sorting on every progress frame would cost more than the frame itself
+        self.proxy.setDynamicSortFilter(False)
+        self.setModel(self.proxy)
+        self.setItemDelegateForColumn(PROGRESS, ProgressDelegate(self))
+        self.setSortingEnabled(True)
+        self.setSelectionBehavior(QTableView.SelectionBehavior.SelectRows)
+        # fixed row heights, so the view never has to measure 100k rows
+        self.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.verticalHeader().setDefaultSectionSize(22)
+        self.verticalHeader().hide()
+        self.horizontalHeader().setSectionResizeMode(NAME, QHeaderView.ResizeMode.Stretch)
+        for column in (SIZE, PROGRESS, STATUS):
+            self.horizontalHeader().setSectionResizeMode(column, QHeaderView.ResizeMode.Fixed)
+
+    def set_filter(self, text):
+        self.proxy.setFilterFixedString(text)
@@ -0,0 +1,59 @@
+# tests for the transfer list model and view in transfer_model.py
+import os
+
+import pytest
+
+pytest.importorskip("PyQt6")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtCore import Qt
+from PyQt6.QtWidgets import QApplication
+
+from py_app.ui.transfer_model import TransferModel, TransferView, NAME, SIZE, STATUS
+
+app = QApplication.instance() or QApplication([])
+
+
+def test_a_batch_is_one_insert():
+    model = TransferModel()
+    inserted = []
+    model.rowsInserted.connect(lambda parent, first, last: inserted.append((first, last)))
+    model.add_entries([(b"a\0", 1), (b"b\0", 2), (b"c\0", 3)])
+    # ones it already has are left out
+    model.add_entries([(b"b\0", 2), (b"d\0", 4)])
+    assert inserted == [(0, 2), (3, 3)]
+    assert model.rowCount() == 4
+    assert model.index(3, NAME).data() == "d"
+
+
+def test_progress_is_one_signal_a_frame():
+    model = TransferModel()
+    model.add_entries([(b"a", 100), (b"b", 100), (b"c", 100)])
+    changed = []
+    model.dataChanged.connect(lambda first, last: changed.append((first.row(), first.column(), last.row(), last.column())))
+    for done in range(1, 101):
+        model.update_progress(b"a", done, 100)
+        model.update_progress(b"c", done // 2, 100)
+    assert changed == []
+    model.flush()
+    assert changed == [(0, SIZE, 2, STATUS)]
+    assert model.index(0, STATUS).data() == "done"
+    assert model.index(2, STATUS).data() == "receiving"
+    assert model.index(1, STATUS).data() == "queued"
+    # nothing pending, nothing sent
+    model.flush()
+    assert len(changed) == 1
+
+
+def test_view_filters_and_sorts_without_copying():
+    model = TransferModel()
+    model.add_entries([(b"notes.txt", 10), (b"photo.jpg", 3000), (b"photo.png", 200)])
+    view = TransferView(model)
+    view.set_filter("PHOTO")
+    assert view.proxy.rowCount() == 2
+    view.sortByColumn(SIZE, Qt.SortOrder.DescendingOrder)
+    assert [view.proxy.index(row, NAME).data() for row in range(2)] == ["photo.jpg", "photo.png"]
+    # the proxy only maps rows, the model's columns are as they were
+    assert view.proxy.sourceModel() is model
+    assert model.names == ["notes.txt", "photo.jpg", "photo.png"]
+    assert view.proxy.mapToSource(view.proxy.index(1, NAME)).row() == 2
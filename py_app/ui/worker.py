@@ -0,0 +1,211 @@
+import asyncio
+import threading
+
+import iroh
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from py_app.store import NodeStore
+from py_app.send import send_file
+from py_app.sync import join_and_wait
+from py_app.pipeline import receive_doc, TotalProgress
+from py_app.resume import ResumeStats, partial_blobs, complete_blob, complete_reserved
+from py_app.schedule import Scheduler
+from py_app.writer import ExportWriter
+
+"""
+Running transfers without freezing the window.
+
+TransferWorker owns an asyncio loop on its own thread, with one iroh node on
+it. The UI hands it work with send_file()/receive() and hears back through
+Qt signals. The signals are emitted on the worker thread, so Qt queues them
+and the slots run on the UI thread, same as any other event.
+
+Progress can arrive thousands of times a second, so it is only kept as the
+latest value per transfer and emitted at most FRAME_RATE times a second.
+
+Receives running at the same time share the link through a Scheduler
+(schedule.py), by the priority they were started with or set_priority (the
+priority box of the window). Docs are joined with download=False and each
+blob is fetched inside its entry's admission, so the scheduler paces the
+network and not only the writes to disk.
+"""
+
+FRAME_RATE = 60
+
+
+class TransferWorker(QObject):
+    # transfer id, bytes done, bytes total
+    progress = pyqtSignal(int, int, int)
+    # [(transfer id, key, bytes done, bytes total)], one list per frame
+    entry_progress = pyqtSignal(list)
+    # transfer id, text
+    message = pyqtSignal(int, str)
+    # transfer id, ticket
+    shared = pyqtSignal(int, str)
+    # transfer id
+    finished = pyqtSignal(int)
+    # transfer id, error
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, data_dir=None, parent=None):
+        super().__init__(parent)
+        self.data_dir = data_dir
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop, name="transfer-worker", daemon=True)
+        self.store = None
+        self.node_ready = None
+        self.next_id = 0
+        self.latest = {}  # transfer id -> (done, total), waiting for the next frame
+        self.latest_entries = {}  # (transfer id, key) -> (done, total), same
+        self.tasks = {}
+        self.scheduler = Scheduler()
+        self.writer = ExportWriter()  # for every receive
+        self.scheduled = {}  # transfer id -> ScheduledTransfer of a running receive
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        # setup event loop, to ensure async callbacks work
+        iroh.iroh_ffi.uniffi_set_event_loop(self.loop)
+        self.node_ready = self.loop.create_task(self.open_node())
+        self.loop.call_soon(self.flush_progress)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    async def open_node(self):
+        self.store = NodeStore(self.data_dir)
+        await self.store.open()
+        return self.store.node
+
+    def flush_progress(self):
+        # runs once a frame on the worker loop
+        latest, self.latest = self.latest, {}
+        for transfer_id, (done, total) in latest.items():
+            self.progress.emit(transfer_id, done, total)
+        entries, self.latest_entries = self.latest_entries, {}
+        if entries:
+            self.entry_progress.emit([(transfer_id, key, done, total) for (transfer_id, key), (done, total) in entries.items()])
+        self.loop.call_later(1 / FRAME_RATE, self.flush_progress)
+
+    def report(self, transfer_id, done, total):
+        self.latest[transfer_id] = (done, total)
+
+    def report_entry(self, transfer_id, key, done, total):
+        self.latest_entries[(transfer_id, key)] = (done, total)
+
+    #
+    # called from the UI thread
+    def submit(self, make_coro):
+        self.next_id += 1
+        transfer_id = self.next_id
+
+        def start():
+            task = self.loop.create_task(self.run_transfer(transfer_id, make_coro))
+            self.tasks[transfer_id] = task
+
+        self.loop.call_soon_threadsafe(start)
+        return transfer_id
+
+    def send_file(self, path):
+        return self.submit(lambda transfer_id: self.share(transfer_id, path))
+
+    def receive(self, ticket, out_dir, priority="normal"):
+        return self.submit(lambda transfer_id: self.fetch(transfer_id, ticket, out_dir, priority))
+
+    def set_priority(self, transfer_id, priority):
+        def set_priority():
+            scheduled = self.scheduled.get(transfer_id)
+            if scheduled is not None:
+                self.scheduler.set_priority(scheduled.id, priority)
+
+        self.loop.call_soon_threadsafe(set_priority)
+
+    def cancel(self, transfer_id):
+        def cancel():
+            task = self.tasks.get(transfer_id)
+            if task is not None:
+                task.cancel()
+
+        self.loop.call_soon_threadsafe(cancel)
+
+    def stop(self, timeout=5):
+        # waits until running transfers have wound down and the node is shut down
+        self.loop.call_soon_threadsafe(lambda: self.loop.create_task(self.shutdown()))
+        self.thread.join(timeout)
+
+    #
+    # running on the worker loop
+    async def shutdown(self):
+        try:
+            # cancelled transfers still get to run their finally blocks and write to the store
+            tasks = list(self.tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                await self.node_ready
+            except Exception:
+                # it never started, nothing to shut down
+                pass
+            else:
+                await self.store.shutdown()
+            await self.writer.close()
+        finally:
+            self.loop.stop()
+
+    async def run_transfer(self, transfer_id, make_coro):
+        try:
+            await make_coro(transfer_id)
+        except asyncio.CancelledError:
+            self.failed.emit(transfer_id, "cancelled")
+        except Exception as e:
+            self.failed.emit(transfer_id, str(e))
+        else:
+            self.finished.emit(transfer_id)
+        finally:
+            self.tasks.pop(transfer_id, None)
+
+    async def share(self, transfer_id, path):
+        node = await self.node_ready
+        doc = await node.docs().create()
+        author = await self.store.author()
+        self.message.emit(transfer_id, "Importing {}".format(path))
+        def on_progress(key, done, total):
+            self.report(transfer_id, done, total)
+            self.report_entry(transfer_id, key, done, total)
+
+        await send_file(doc, author, path, on_progress=on_progress)
+        ticket = await doc.share(iroh.ShareMode.READ, iroh.AddrInfoOptions.RELAY_AND_ADDRESSES)
+        self.store.remember_doc(doc.id(), "sent", str(ticket))
+        self.shared.emit(transfer_id, str(ticket))
+
+    async def fetch(self, transfer_id, ticket, out_dir, priority="normal"):
+        node = await self.node_ready
+        self.message.emit(transfer_id, "Joining doc")
+        # only the entries are synced, each blob is fetched inside its admission so the scheduler paces the fetching too
+        doc, watcher = await join_and_wait(node, ticket, download=False)
+        doc_id = doc.id()
+        self.store.remember_doc(doc_id, "joined", ticket)
+        resume = ResumeStats(await partial_blobs(node))
+        peers = list(watcher.peers.values())
+        await complete_reserved(node, doc, peers, resume)
+        # no point adding up the totals more often than flush_progress sends them to the window
+        progress = TotalProgress(interval=1 / FRAME_RATE, show=lambda done, total: self.report(transfer_id, done, total))
+
+        def on_progress(key, written, total):
+            progress.update(key, written, total)
+            self.report_entry(transfer_id, key, written, total)
+
+        self.message.emit(transfer_id, "Receiving")
+        scheduled = self.scheduled[transfer_id] = self.scheduler.transfer(doc_id, priority, next(iter(watcher.peers), None))
+        try:
+            result = await receive_doc(node, self.store, doc, out_dir, on_progress=on_progress,
+                                       ensure_local=lambda entry: complete_blob(node, entry, peers, resume),
+                                       admit=lambda entry: scheduled.admit(entry.content_len()), writer=self.writer)
+        finally:
+            self.scheduler.finish(scheduled)
+            self.scheduled.pop(transfer_id, None)
+        self.message.emit(transfer_id, "Received {} files, {} failed".format(len(result.received) + len(result.unpacked), len(result.failed)))
@@ -0,0 +1,63 @@
+# tests for handing work to the worker loop in worker.py, without a window or a real node
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("PyQt6")
+
+from py_app.ui.worker import TransferWorker
+
+
+class FakeStore:
+    def __init__(self):
+        self.shut_down = False
+
+    async def shutdown(self):
+        self.shut_down = True
+
+
+class Worker(TransferWorker):
+    async def open_node(self):
+        self.store = FakeStore()
+        return "node"
+
+
+def test_transfers_run_on_the_worker_thread():
+    worker = Worker()
+    ran = threading.Event()
+    seen = {}
+
+    async def transfer(transfer_id):
+        seen["thread"] = threading.current_thread()
+        seen["node"] = await worker.node_ready
+        ran.set()
+
+    worker.submit(transfer)
+    assert ran.wait(5)
+    assert seen == {"thread": worker.thread, "node": "node"}
+    worker.stop()
+    assert not worker.thread.is_alive()
+
+
+def test_stop_lets_transfers_wind_down():
+    worker = Worker()
+    started = threading.Event()
+    cleaned_up = []
+
+    async def transfer(transfer_id):
+        try:
+            started.set()
+            await asyncio.sleep(60)
+        finally:
+            # e.g. the store writes of a receive
+            await asyncio.sleep(0)
+            cleaned_up.append(transfer_id)
+
+    transfer_id = worker.submit(transfer)
+    assert started.wait(5)
+    worker.stop()
+    assert not worker.thread.is_alive()
+    assert cleaned_up == [transfer_id]
+    assert worker.store.shut_down
+    assert worker.loop.is_closed()
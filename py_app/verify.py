@@ -0,0 +1,144 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+
+from py_app.receive import target_path, DEFAULT_CHUNK_SIZE
+from py_app.pipeline import receive_all, as_pages
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+"""
+Checking received files against the doc after they were written.
+
+iroh verifies content while it is transferred, but nothing checks the file
+once it is on disk: a bad disk, a crash halfway through an export or
+somebody editing the output folder all go unnoticed. A blob's hash is the
+plain BLAKE3 hash of its content, so a file can be checked without iroh by
+hashing it and comparing with entry.content_hash(). That needs the blake3
+package.
+
+Files are hashed in a process pool, one file per worker, so many small
+files use every core. Big files are memory mapped and hashed by blake3 on
+several threads, smaller ones are read in READ_SIZE pieces, either way the
+disk is read sequentially. Only the entries that failed are received again
+(repair), from the local blob store if it still has them, from the network
+if it doesn't.
+
+Entries whose file is not their blob (compressed ones, see codec.py, and
+files that came in packs, see pack.py) can't be checked this way and are
+counted as unchecked.
+"""
+
+READ_SIZE = 16 * 1024 * 1024  # 16 MiB
+MMAP_SIZE = 64 * 1024 * 1024  # files this size or bigger are memory mapped and hashed on several threads
+
+
+def hash_file(path, read_size=READ_SIZE):
+    # returns (blake3 hex digest, size). runs in a worker process
+    size = os.path.getsize(path)
+    if size >= MMAP_SIZE:
+        hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        hasher.update_mmap(path)
+        return hasher.hexdigest(), size
+    hasher = blake3.blake3()
+    buffer = bytearray(min(read_size, max(size, 1)))
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest(), size
+
+
+class VerifyResult:
+    def __init__(self):
+        self.checked = 0
+        self.bytes = 0
+        self.bad = []  # (entry, path, reason)
+        self.unchecked = 0
+
+    def summary(self):
+        return "checked {} files ({} bytes), {} bad, {} could not be checked".format(
+            self.checked, self.bytes, len(self.bad), self.unchecked)
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+async def verify_entries(entries, out_dir=".", workers=None, skip=None, read_size=READ_SIZE, on_progress=None):
+    # hash the file of every entry and compare it with the entry. entries is a list or an
+    # async iterator of pages (see listing.py), skip(entry) leaves out entries that can't be checked
+    if blake3 is None:
+        raise ImportError("verifying needs the blake3 package (pip install blake3)")
+    workers = workers or default_workers()
+    if workers <= 0:
+        raise ValueError("workers must be positive")
+    result = VerifyResult()
+    loop = asyncio.get_running_loop()
+    # a few files queued per worker keeps them busy without holding the whole listing in futures
+    slots = asyncio.Semaphore(2 * workers)
+
+    async def check(pool, entry, path):
+        try:
+            digest, size = await loop.run_in_executor(pool, hash_file, path, read_size)
+            result.checked += 1
+            result.bytes += size
+            if on_progress:
+                on_progress(entry.key(), size, size)
+            if size != entry.content_len():
+                result.bad.append((entry, path, "size is {}, expected {}".format(size, entry.content_len())))
+            elif digest != entry.content_hash().to_hex():
+                result.bad.append((entry, path, "content does not match"))
+        except FileNotFoundError:
+            result.bad.append((entry, path, "missing"))
+        except Exception as e:
+            # OSError, or the worker failing (e.g. a broken pool): it couldn't be shown to be good
+            result.bad.append((entry, path, str(e) or type(e).__name__))
+        finally:
+            slots.release()
+
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        tasks = []
+        async for page in as_pages(entries):
+            for entry in page:
+                if skip is not None and skip(entry):
+                    result.unchecked += 1
+                    continue
+                try:
+                    path = target_path(entry.key(), out_dir)
+                except ValueError:
+                    # a key receive refused to write, nothing to check
+                    result.unchecked += 1
+                    continue
+                await slots.acquire()
+                tasks.append(asyncio.ensure_future(check(pool, entry, path)))
+            for task in tasks:
+                if task.done():
+                    # check records errors itself, anything else it let through stops us here
+                    task.result()
+            tasks = [task for task in tasks if not task.done()]
+        await asyncio.gather(*tasks)
+    return result
+
+
+async def repair(node, doc, result, out_dir=".", mode="export", chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+                 ensure_local=None, receive=None, on_received=None, writer=None):
+    # receive the entries verify_entries found bad again and check them once more.
+    # returns (ReceiveResult, VerifyResult of the second check)
+    entries = [entry for entry, path, reason in result.bad]
+    for entry, path, reason in result.bad:
+        # never write through a broken file, it may be a hardlink to a good one
+        if os.path.lexists(path):
+            os.remove(path)
+    received = await receive_all(node, doc, entries, out_dir, mode, chunk_size,
+                                 ensure_local=ensure_local, receive=receive, on_received=on_received, writer=writer)
+    return received, await verify_entries(entries, out_dir, workers)
@@ -0,0 +1,87 @@
+# tests for checking received files in verify.py
+import tempfile
+import asyncio
+import os
+
+import pytest
+
+blake3 = pytest.importorskip("blake3")
+
+from py_app.verify import verify_entries, repair, hash_file
+
+
+class FakeHash:
+    def __init__(self, hex):
+        self.hex = hex
+
+    def to_hex(self):
+        return self.hex
+
+
+class FakeEntry:
+    def __init__(self, key, data):
+        self._key = key
+        self._hash = FakeHash(blake3.blake3(data).hexdigest())
+        self._size = len(data)
+
+    def key(self):
+        return self._key
+
+    def content_hash(self):
+        return self._hash
+
+    def content_len(self):
+        return self._size
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_hash_file_matches_blake3():
+    dir = tempfile.TemporaryDirectory()
+    path = os.path.join(dir.name, "f")
+    data = os.urandom(100000)
+    write(path, data)
+    assert hash_file(path, read_size=4096) == (blake3.blake3(data).hexdigest(), len(data))
+
+
+def test_only_bad_entries_are_received_again():
+    dir = tempfile.TemporaryDirectory()
+    good = FakeEntry(b"a/good\0", b"good content")
+    changed = FakeEntry(b"a/changed\0", b"original content")
+    missing = FakeEntry(b"a/missing\0", b"not there")
+    skipped = FakeEntry(b"a/skipped\0", b"compressed")
+    write(os.path.join(dir.name, "copy_of_a", "good"), b"good content")
+    write(os.path.join(dir.name, "copy_of_a", "changed"), b"0riginal content")
+    entries = [good, changed, missing, skipped]
+    result = asyncio.run(verify_entries(entries, dir.name, workers=2, skip=lambda entry: entry is skipped))
+    assert result.checked == 2 and result.unchecked == 1
+    assert sorted(entry.key() for entry, path, reason in result.bad) == [b"a/changed\0", b"a/missing\0"]
+
+    received = []
+    contents = {changed.key(): b"original content", missing.key(): b"not there"}
+
+    async def receive(node, doc, entry, out_dir, mode, chunk_size, on_progress, writer=None):
+        path = os.path.join(out_dir, "copy_of_a", entry.key()[2:-1].decode())
+        write(path, contents[entry.key()])
+        received.append(entry.key())
+        return path
+
+    repaired, again = asyncio.run(repair(None, None, result, dir.name, workers=2, receive=receive))
+    assert sorted(received) == [b"a/changed\0", b"a/missing\0"]
+    assert again.checked == 2 and not again.bad
+
+
+def test_hashing_errors_count_as_bad():
+    dir = tempfile.TemporaryDirectory()
+    entries = [FakeEntry("a/{}\0".format(n).encode(), b"content") for n in range(5)]
+    for n in range(5):
+        write(os.path.join(dir.name, "copy_of_a", str(n)), b"content")
+    # a read size hash_file can't use makes it raise TypeError in the worker
+    result = asyncio.run(verify_entries(entries, dir.name, workers=1, read_size="bad"))
+    assert result.checked == 0
+    assert len(result.bad) == 5
+    assert all("not supported" in reason for entry, path, reason in result.bad)
@@ -0,0 +1,302 @@
+import iroh
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+
+from py_app.dirsync import DirSharer, DEFAULT_PARALLEL
+from py_app.send import DEFAULT_IN_PLACE_THRESHOLD
+from py_app.receive import target_path
+from py_app.pack import is_reserved, pack_entry, unpack, INDEX_PREFIX, DEFAULT_PACK_SIZE
+from py_app.codec import CodecMap, CODEC_PREFIX
+
+"""
+Live replication of a folder.
+
+Sender: DirWatcher puts an inotify watch on every folder in the tree
+(ctypes, linux only) and collects the paths that events point at. Events
+are not acted on one by one. Once things have been quiet for `debounce`
+seconds, or `max_delay` seconds after the first event of a burst, whichever
+comes first, the collected paths go to DirSharer.sync_paths as one batch.
+A file written 1000 times during a build is imported once, and a file whose
+size and mtime ended up where they started isn't imported at all.
+
+Receiver: DocFollower subscribes to the doc and writes entries to disk as
+their content lands, a pack index is unpacked (once its pack blob is here
+too) and compressed entries are decompressed. iroh treats an empty entry
+as a deletion, so those remove the local copy. Subscribe (follow_subscribe)
+before the first full receive and nothing that arrives in between is
+missed; skip keeps entries that receive already wrote from being written
+twice. When the doc downloads nothing on its own (main.py --dedup) the
+follower is made with content=False and follow_doc's ensure_local fetches
+each entry before it is written.
+"""
+
+DEFAULT_DEBOUNCE = 0.1  # seconds of quiet before a batch is sent
+DEFAULT_MAX_DELAY = 0.5  # seconds after the first event a batch is sent no matter what
+PACK_RETRY_INTERVAL = 1.0  # seconds before a pack index whose pack isn't here yet is looked at again
+PACK_RETRIES = 60
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONTFOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# no IN_MODIFY: a file being written only counts once it is closed
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONTFOLLOW)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len, then len bytes of name
+
+
+class Inotify:
+    # the inotify calls we need, straight from libc
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_add_watch failed: {}".format(os.strerror(errno)), path)
+        return wd
+
+    def rm_watch(self, wd):
+        # errors are fine, the watch may be gone with its folder already
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        # (wd, mask, cookie, name) for everything queued right now
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirWatcher:
+    def __init__(self, root, debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY):
+        self.root = os.path.abspath(root)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.inotify = Inotify()
+        self.folders = {}  # wd -> folder path
+        self.dirty = set()
+        self.overflowed = False
+        self.changed = asyncio.Event()
+        self.loop = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.watch_tree(self.root)
+        self.loop.add_reader(self.inotify.fd, self.on_readable)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.inotify.fd)
+        self.inotify.close()
+
+    def watch_tree(self, folder):
+        stack = [folder]
+        while stack:
+            folder = stack.pop()
+            try:
+                self.folders[self.inotify.add_watch(folder)] = folder
+                with os.scandir(folder) as it:
+                    stack.extend(item.path for item in it if item.is_dir(follow_symlinks=False))
+            except OSError:
+                # gone before we got to it, the event for its removal takes care of it
+                continue
+
+    def on_readable(self):
+        for wd, mask, cookie, name in self.inotify.read_events():
+            self.handle(wd, mask, name)
+        if self.dirty or self.overflowed:
+            self.changed.set()
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # the kernel dropped events, only a full rescan can tell what happened
+            self.overflowed = True
+            return
+        folder = self.folders.get(wd)
+        if folder is None:
+            return
+        if mask & IN_IGNORED:
+            # the watch is gone because its folder is
+            del self.folders[wd]
+            return
+        path = os.path.join(folder, name) if name else folder
+        if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+            # its watches move with it and would report under the old path, drop them.
+            # moved within the tree, the IN_MOVED_TO that follows watches it again where it is now
+            self.unwatch_tree(path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            # a new folder, watch it. files may already be in it, sync_paths walks it
+            self.watch_tree(path)
+        self.dirty.add(path)
+
+    def unwatch_tree(self, folder):
+        inside = folder + os.sep
+        for wd, path in list(self.folders.items()):
+            if path == folder or path.startswith(inside):
+                self.inotify.rm_watch(wd)
+                del self.folders[wd]
+
+    def take(self):
+        dirty, self.dirty = self.dirty, set()
+        overflowed, self.overflowed = self.overflowed, False
+        self.changed.clear()
+        return dirty, overflowed
+
+    async def batches(self):
+        # yields (paths, overflowed) once per burst of events
+        while True:
+            await self.changed.wait()
+            first = self.loop.time()
+            while True:
+                self.changed.clear()
+                timeout = min(self.debounce, first + self.max_delay - self.loop.time())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            yield self.take()
+
+
+async def watch_dir(doc, author, root, index, mode="import", in_place_threshold=DEFAULT_IN_PLACE_THRESHOLD,
+                    parallel=DEFAULT_PARALLEL, debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY, on_batch=None,
+                    pack_threshold=None, pack_size=DEFAULT_PACK_SIZE, compressor=None):
+    # keep doc in step with root until cancelled. on_batch(stats) is called after every batch
+    sharer = DirSharer(doc, author, root, index, mode, in_place_threshold, parallel,
+                       pack_threshold=pack_threshold, pack_size=pack_size, compressor=compressor)
+    watcher = DirWatcher(root, debounce, max_delay)
+    watcher.start()
+    try:
+        # anything that changed between the last sync and the watches going up
+        stats = await sharer.sync_dir()
+        if on_batch is not None:
+            on_batch(stats)
+        async for paths, overflowed in watcher.batches():
+            if overflowed:
+                stats = await sharer.sync_dir()
+            else:
+                stats = await sharer.sync_paths(paths)
+            if on_batch is not None:
+                on_batch(stats)
+    finally:
+        watcher.stop()
+
+
+class DocFollower:
+    # SubscribeCallback that hands every remote entry to the writer once its content is local,
+    # or right away with content=False
+    def __init__(self, content=True):
+        self.content = content
+        self.queue = asyncio.Queue()
+        self.waiting = {}  # hash hex -> entries whose content is still downloading
+
+    async def event(self, event):
+        kind = event.type()
+        if kind == iroh.LiveEventType.INSERT_REMOTE:
+            insert = event.as_insert_remote()
+            entry = insert.entry
+            if not self.content or entry.content_len() == 0 or insert.content_status == iroh.ContentStatus.COMPLETE:
+                self.queue.put_nowait(entry)
+            else:
+                self.waiting.setdefault(entry.content_hash().to_hex(), []).append(entry)
+        elif kind == iroh.LiveEventType.CONTENT_READY:
+            for entry in self.waiting.pop(event.as_content_ready().to_hex(), []):
+                self.queue.put_nowait(entry)
+
+
+async def follow_subscribe(doc, content=True):
+    # a DocFollower that queues what arrives from now on, for follow_doc
+    follower = DocFollower(content)
+    await doc.subscribe(follower)
+    return follower
+
+
+async def follow_doc(node, doc, out_dir=".", mode="export", on_progress=None, on_received=None, on_removed=None, on_failed=None,
+                     codecs=None, follower=None, skip=None, writer=None, ensure_local=None, receive=None):
+    # write entries of doc to out_dir as they arrive, until cancelled. ensure_local and receive as for receive_all
+    if codecs is None:
+        codecs = CodecMap()
+    if receive is None:
+        receive = codecs.receive
+    if follower is None:
+        follower = await follow_subscribe(doc)
+    retries = {}  # index key -> times its pack wasn't here yet
+    while True:
+        entry = await follower.queue.get()
+        try:
+            if is_reserved(entry.key()):
+                if entry.content_len() > 0 and ensure_local is not None:
+                    await ensure_local(entry)
+                # bookkeeping entries: packs are written out through their index (pack.py), codecs remembered (codec.py)
+                if entry.key().startswith(INDEX_PREFIX) and entry.content_len() > 0:
+                    # the index is tiny, the pack it points at may still be on its way
+                    pack = await pack_entry(doc, entry)
+                    if pack is not None and ensure_local is not None:
+                        await ensure_local(pack)
+                    if pack is None or not await node.blobs().has(pack.content_hash()):
+                        retries[entry.key()] = retries.get(entry.key(), 0) + 1
+                        if retries[entry.key()] > PACK_RETRIES:
+                            raise IOError("the pack of {!r} never arrived".format(entry.key()))
+                        asyncio.get_running_loop().call_later(PACK_RETRY_INTERVAL, follower.queue.put_nowait, entry)
+                        continue
+                    retries.pop(entry.key(), None)
+                    await unpack(node, entry, out_dir, on_progress=on_progress, on_received=on_received, writer=writer)
+                elif entry.key().startswith(CODEC_PREFIX):
+                    await codecs.add(node, entry)
+                continue
+            if entry.content_len() == 0:
+                # deletion marker
+                path = target_path(entry.key(), out_dir)
+                if os.path.isfile(path):
+                    os.remove(path)
+                    if on_removed is not None:
+                        on_removed(entry, path)
+                continue
+            if skip is not None and skip(entry):
+                continue
+            if ensure_local is not None:
+                await ensure_local(entry)
+            path = await receive(node, doc, entry, out_dir, mode, on_progress=on_progress, writer=writer)
+        except Exception as e:
+            # one bad entry (iroh errors included) doesn't stop the rest
+            if on_failed is not None:
+                on_failed(entry, e)
+            continue
+        if on_received is not None:
+            on_received(codecs.as_written(entry), path)
@@ -0,0 +1,217 @@
+# tests for the inotify watcher in watch.py
+import tempfile
+import asyncio
+import os
+
+import iroh
+
+from py_app import watch
+from py_app.watch import DirWatcher, follow_doc, follow_subscribe
+
+
+def test_bursts_come_out_as_one_batch():
+    root = tempfile.TemporaryDirectory()
+
+    async def run():
+        watcher = DirWatcher(root.name, debounce=0.05, max_delay=0.5)
+        watcher.start()
+        batches = watcher.batches()
+        try:
+            # a build writing the same file over and over, plus a new folder with a file in it
+            path = os.path.join(root.name, "out.o")
+            for i in range(200):
+                with open(path, "wb") as f:
+                    f.write(b"x" * i)
+            os.makedirs(os.path.join(root.name, "sub"))
+            with open(os.path.join(root.name, "sub", "a"), "wb") as f:
+                f.write(b"a")
+            paths, overflowed = await asyncio.wait_for(batches.__anext__(), 5)
+            assert not overflowed
+            assert path in paths
+            assert os.path.join(root.name, "sub") in paths
+            #
+            # the new folder is watched too, and removing things is seen
+            os.remove(os.path.join(root.name, "sub", "a"))
+            paths, overflowed = await asyncio.wait_for(batches.__anext__(), 5)
+            assert paths == {os.path.join(root.name, "sub", "a")}
+        finally:
+            await batches.aclose()
+            watcher.stop()
+
+    asyncio.run(run())
+
+
+def test_moved_folders_are_watched_where_they_are():
+    root = tempfile.TemporaryDirectory()
+    outside = tempfile.TemporaryDirectory()
+    os.makedirs(os.path.join(root.name, "a", "deep"))
+
+    async def run():
+        watcher = DirWatcher(root.name, debounce=0.05, max_delay=0.5)
+        watcher.start()
+        batches = watcher.batches()
+        try:
+            os.rename(os.path.join(root.name, "a"), os.path.join(root.name, "b"))
+            await asyncio.wait_for(batches.__anext__(), 5)
+            assert sorted(watcher.folders.values()) == [root.name, os.path.join(root.name, "b"), os.path.join(root.name, "b", "deep")]
+            # moved out of the tree, nothing in there is reported any more
+            os.rename(os.path.join(root.name, "b"), os.path.join(outside.name, "b"))
+            await asyncio.wait_for(batches.__anext__(), 5)
+            assert list(watcher.folders.values()) == [root.name]
+            with open(os.path.join(outside.name, "b", "deep", "x"), "wb") as f:
+                f.write(b"x")
+            with open(os.path.join(root.name, "y"), "wb") as f:
+                f.write(b"y")
+            paths, overflowed = await asyncio.wait_for(batches.__anext__(), 5)
+            assert paths == {os.path.join(root.name, "y")}
+        finally:
+            await batches.aclose()
+            watcher.stop()
+
+    asyncio.run(run())
+
+
+class FakeEntry:
+    def __init__(self, key):
+        self._key = key
+
+    def key(self):
+        return self._key
+
+    def content_len(self):
+        return 1
+
+
+class FakeDoc:
+    async def subscribe(self, callback):
+        self.callback = callback
+
+
+class FakeCodecs:
+    async def receive(self, node, doc, entry, out_dir, mode, on_progress=None, writer=None):
+        if entry.key() == b"bad":
+            # what iroh raises is a plain Exception
+            raise Exception("blob not found")
+        return os.path.join(out_dir, entry.key().decode())
+
+    def as_written(self, entry):
+        return entry
+
+
+def test_follow_doc_keeps_going_after_a_bad_entry():
+    received, failed = [], []
+
+    async def run():
+        doc = FakeDoc()
+        # subscribed before the first receive, what arrives meanwhile waits in the queue
+        follower = await follow_subscribe(doc)
+        for key in (b"bad", b"old", b"good"):
+            follower.queue.put_nowait(FakeEntry(key))
+        follow = asyncio.ensure_future(follow_doc(None, doc, "out", codecs=FakeCodecs(), follower=follower,
+                                                  on_received=lambda entry, path: received.append(path),
+                                                  on_failed=lambda entry, error: failed.append(entry.key()),
+                                                  skip=lambda entry: entry.key() == b"old"))
+        while follower.queue.qsize():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        follow.cancel()
+
+    asyncio.run(run())
+    assert failed == [b"bad"]
+    assert received == [os.path.join("out", "good")]
+
+
+class FakeInsert:
+    # a LiveEvent for an entry whose content is not here
+    def __init__(self, entry):
+        self.entry = entry
+        self.content_status = iroh.ContentStatus.MISSING
+
+    def type(self):
+        return iroh.LiveEventType.INSERT_REMOTE
+
+    def as_insert_remote(self):
+        return self
+
+
+def test_follow_without_downloads_fetches_each_entry():
+    # main.py --follow --dedup: nothing downloads on its own, so no CONTENT_READY ever comes
+    fetched, received = [], []
+
+    async def ensure_local(entry):
+        fetched.append(entry.key())
+
+    async def receive(node, doc, entry, out_dir, mode, on_progress=None, writer=None):
+        assert entry.key() in fetched
+        return os.path.join(out_dir, entry.key().decode())
+
+    async def run():
+        doc = FakeDoc()
+        follower = await follow_subscribe(doc, content=False)
+        await doc.callback.event(FakeInsert(FakeEntry(b"new")))
+        follow = asyncio.ensure_future(follow_doc(None, doc, "out", codecs=FakeCodecs(), follower=follower,
+                                                  ensure_local=ensure_local, receive=receive,
+                                                  on_received=lambda entry, path: received.append(path)))
+        while not received:
+            await asyncio.sleep(0.01)
+        follow.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert fetched == [b"new"]
+    assert received == [os.path.join("out", "new")]
+
+
+class FakeBlobs:
+    def __init__(self):
+        self.local = set()
+
+    async def has(self, hash):
+        return hash in self.local
+
+
+class FakeNode:
+    def __init__(self):
+        self._blobs = FakeBlobs()
+
+    def blobs(self):
+        return self._blobs
+
+
+class FakePack(FakeEntry):
+    def content_hash(self):
+        return "pack-hash"
+
+
+def test_follow_unpacks_once_the_pack_is_here(monkeypatch):
+    node = FakeNode()
+    index = FakeEntry(b".fileflow/index/1")
+    unpacked, looked = [], []
+
+    async def pack_entry(doc, index_entry):
+        looked.append(index_entry.key())
+        if len(looked) == 2:
+            # it arrived in between
+            node.blobs().local.add("pack-hash")
+        return FakePack(b".fileflow/pack/1")
+
+    async def unpack(node, entry, out_dir, on_progress=None, on_received=None, writer=None):
+        assert "pack-hash" in node.blobs().local
+        unpacked.append(entry.key())
+
+    monkeypatch.setattr(watch, "pack_entry", pack_entry)
+    monkeypatch.setattr(watch, "unpack", unpack)
+    monkeypatch.setattr(watch, "PACK_RETRY_INTERVAL", 0.01)
+
+    async def run():
+        doc = FakeDoc()
+        follower = await follow_subscribe(doc)
+        follower.queue.put_nowait(index)
+        follow = asyncio.ensure_future(follow_doc(node, doc, "out", codecs=FakeCodecs(), follower=follower))
+        while not unpacked:
+            await asyncio.sleep(0.01)
+        follow.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    # the first look found no pack blob, the index came round again
+    assert looked == [index.key(), index.key()]
+    assert unpacked == [index.key()]
@@ -0,0 +1,231 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import os
+import sys
+import threading
+
+"""
+Writing received files to disk off the event loop.
+
+Chunked receive, decompression and unpacking all get a file's content
+piece by piece. Writing those pieces with f.write on the event loop stalls
+every other transfer whenever the disk is slow, so they go through an
+ExportWriter instead:
+
+    - the file is created under a temporary name (path + TMP_SUFFIX) and
+      preallocated to its final size with posix_fallocate, so the file
+      system can lay it out in one piece
+    - pieces are collected into buffer_size blocks and written with pwrite
+      on a small thread pool, at most max_pending blocks per file at a
+      time, so the next piece is fetched while the last one is written.
+      Where there is no pwrite (windows) a block is written with lseek and
+      write under a lock of its file
+    - once complete (and the size checked) it is renamed to its real name,
+      a half written file is never seen under that name
+
+fsync: "none" leaves it to the OS. "each" syncs every file before it is
+renamed and its folder after, so after a crash a file under its real name
+is always complete. "batch" syncs fsync_batch files at a time (and on
+flush/close), far cheaper for many small files. A crash can then damage
+the files of the last batch, as with "none", but never more than that.
+On windows folders can't be opened to sync them, and don't need to be:
+NTFS journals the rename itself.
+
+Whoever receives owns the writer (main.py, the daemon, the window's worker)
+and hands it down to receive_entry, decompress_entry and unpack. Called
+without one, those make one of their own for that call (use_writer).
+
+    writer = ExportWriter()
+    async with writer.open(path, size) as f:
+        await f.write(chunk)
+    await writer.close()
+"""
+
+TMP_SUFFIX = ".fileflow-tmp"
+DEFAULT_THREADS = 4
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024  # 8 MiB, a multiple of any block size
+DEFAULT_MAX_PENDING = 2  # blocks being written per file
+DEFAULT_FSYNC_BATCH = 64  # files
+FSYNC_MODES = ("none", "batch", "each")
+
+
+def preallocate(fd, size):
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # not every file system can (e.g. zfs), it is only a hint
+            pass
+
+
+def sync_paths(paths):
+    # fsync files written earlier and the folders they were renamed in
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for folder in set(os.path.dirname(path) or "." for path in paths):
+        sync_dir(folder)
+
+
+def sync_dir(folder):
+    if sys.platform == "win32":
+        return
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextlib.asynccontextmanager
+async def use_writer(writer=None):
+    # the writer given, or one of our own that is closed again afterwards
+    if writer is not None:
+        yield writer
+        return
+    writer = ExportWriter(threads=1)
+    try:
+        yield writer
+    finally:
+        await writer.close()
+
+
+class ExportWriter:
+    def __init__(self, threads=DEFAULT_THREADS, buffer_size=DEFAULT_BUFFER_SIZE, fsync="none",
+                 fsync_batch=DEFAULT_FSYNC_BATCH, max_pending=DEFAULT_MAX_PENDING):
+        if fsync not in FSYNC_MODES:
+            raise ValueError("unknown fsync mode {!r}".format(fsync))
+        if buffer_size <= 0 or max_pending <= 0:
+            raise ValueError("buffer_size and max_pending must be positive")
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="export-writer")
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.fsync_batch = fsync_batch
+        self.max_pending = max_pending
+        self.unsynced = []  # renamed but not synced yet, with fsync="batch"
+
+    def open(self, path, size=None):
+        # async context manager, renames the file into place if the block ends without an error
+        return PendingFile(self, path, size)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def committed(self, path):
+        if self.fsync == "batch":
+            self.unsynced.append(path)
+            if len(self.unsynced) >= self.fsync_batch:
+                await self.flush()
+
+    async def flush(self):
+        # sync everything committed so far
+        paths, self.unsynced = self.unsynced, []
+        if paths:
+            await self.run(sync_paths, paths)
+
+    async def close(self):
+        await self.flush()
+        self.pool.shutdown()
+
+
+class PendingFile:
+    def __init__(self, writer, path, size=None):
+        self.writer = writer
+        self.path = path
+        self.tmp = path + TMP_SUFFIX
+        self.size = size  # None if not known up front
+        self.fd = None
+        self.buffer = bytearray()
+        self.offset = 0  # where the buffer goes in the file
+        self.pending = []  # futures of blocks being written
+        self.written = 0
+        self.lock = threading.Lock()  # the file position, without pwrite
+
+    async def __aenter__(self):
+        self.fd = await self.writer.run(self.create)
+        return self
+
+    async def __aexit__(self, kind, error, traceback):
+        if error is None:
+            await self.commit()
+        else:
+            await self.abort()
+
+    def create(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        preallocate(fd, self.size)
+        return fd
+
+    def write_block(self, block, offset):
+        view = memoryview(block)
+        if not hasattr(os, "pwrite"):
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while view:
+                    view = view[os.write(self.fd, view):]
+            return
+        while view:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    async def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.writer.buffer_size:
+            block = self.buffer[:self.writer.buffer_size]
+            del self.buffer[:self.writer.buffer_size]
+            await self.submit(block)
+
+    async def submit(self, block):
+        if len(self.pending) >= self.writer.max_pending:
+            await self.pending.pop(0)
+        loop = asyncio.get_running_loop()
+        self.pending.append(loop.run_in_executor(self.writer.pool, self.write_block, block, self.offset))
+        self.offset += len(block)
+        self.written += len(block)
+
+    async def commit(self):
+        try:
+            if self.buffer:
+                block, self.buffer = self.buffer, bytearray()
+                await self.submit(block)
+            await self.drain()
+            if self.size is not None and self.written != self.size:
+                raise IOError("{} got {} bytes, expected {}".format(self.path, self.written, self.size))
+        except BaseException:
+            await self.abort()
+            raise
+        await self.writer.run(self.finish)
+        await self.writer.committed(self.path)
+
+    def finish(self):
+        try:
+            if self.writer.fsync == "each":
+                os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+        os.replace(self.tmp, self.path)
+        if self.writer.fsync == "each":
+            sync_dir(os.path.dirname(self.path) or ".")
+
+    async def drain(self):
+        await asyncio.gather(*self.pending)
+        self.pending = []
+
+    async def abort(self):
+        # never leaves the temporary file behind
+        try:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        finally:
+            self.pending = []
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            if os.path.exists(self.tmp):
+                os.remove(self.tmp)
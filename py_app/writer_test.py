@@ -0,0 +1,84 @@
+# tests for the write-behind file writer in writer.py
+import tempfile
+import asyncio
+import os
+
+import py_app.writer as writer_module
+from py_app.writer import ExportWriter, TMP_SUFFIX, sync_paths, use_writer
+
+
+def test_write_rename_and_batch_fsync():
+    dir = tempfile.TemporaryDirectory()
+    data = os.urandom(100 * 1024)
+
+    async def write_files():
+        writer = ExportWriter(threads=2, buffer_size=4096, fsync="batch", fsync_batch=2)
+        for name in ("a", "b", "c"):
+            path = os.path.join(dir.name, "sub", name)
+            async with writer.open(path, len(data)) as f:
+                for offset in range(0, len(data), 3000):
+                    await f.write(data[offset:offset + 3000])
+                # not under its name until it is complete
+                assert not os.path.exists(path)
+        # the first two were synced as a batch, the third waits for close
+        assert writer.unsynced == [os.path.join(dir.name, "sub", "c")]
+        await writer.close()
+        assert writer.unsynced == []
+
+    asyncio.run(write_files())
+    assert sorted(os.listdir(os.path.join(dir.name, "sub"))) == ["a", "b", "c"]
+    for name in ("a", "b", "c"):
+        with open(os.path.join(dir.name, "sub", name), "rb") as f:
+            assert f.read() == data
+
+
+def test_failed_file_leaves_nothing():
+    dir = tempfile.TemporaryDirectory()
+    path = os.path.join(dir.name, "short")
+    other = os.path.join(dir.name, "broken")
+
+    async def write_files():
+        writer = ExportWriter(buffer_size=1024)
+        # fewer bytes than announced
+        try:
+            async with writer.open(path, 4096) as f:
+                await f.write(b"x" * 2048)
+        except IOError as e:
+            assert "expected 4096" in str(e)
+        else:
+            assert False, "size mismatch not noticed"
+        # an error while writing
+        try:
+            async with writer.open(other, 4096) as f:
+                await f.write(b"x" * 2048)
+                raise ValueError("blob went away")
+        except ValueError:
+            pass
+        await writer.close()
+
+    asyncio.run(write_files())
+    assert os.listdir(dir.name) == []
+    assert not os.path.exists(path + TMP_SUFFIX)
+
+
+def test_without_pwrite_or_folder_fsync(monkeypatch):
+    # as on windows
+    monkeypatch.delattr(os, "pwrite")
+    monkeypatch.setattr(writer_module.sys, "platform", "win32")
+    dir = tempfile.TemporaryDirectory()
+    path = os.path.join(dir.name, "a")
+    data = os.urandom(10000)
+
+    async def write_file():
+        async with use_writer() as writer:
+            writer.buffer_size = 1000
+            async with writer.open(path, len(data)) as f:
+                for offset in range(0, len(data), 700):
+                    await f.write(data[offset:offset + 700])
+        # a writer of its own for the call, closed once it is done
+        assert writer.pool._shutdown
+
+    asyncio.run(write_file())
+    with open(path, "rb") as f:
+        assert f.read() == data
+    sync_paths([path])
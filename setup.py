@@ -11,7 +11,7 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'irohui=irohui.main:main'
+            'irohui=py_app.cli:main'
         ]
     },
     include_package_data=True,
@@ -0,0 +1,546 @@
+//! Python bindings for sending and receiving files with iroh-blobs in process.
+//!
+//! This does the same thing as `sendme send` / `sendme receive` (see
+//! deletelater.rs), but from inside python: no process per transfer, no
+//! scraping of stdout, and one endpoint that stays up across transfers.
+//!
+//! ```python
+//! import sendme_module
+//!
+//! node = await sendme_module.Node.spawn("/some/data/dir")
+//! ticket, size = await node.send("big_folder", lambda kind, a, b: print(kind, a, b))
+//! for name, size, reader in await other_node.receive_bytes(ticket):
+//!     chunk = await reader.read_at(0, 1024 * 1024)  # a Buffer, supports memoryview()
+//! ```
+//!
+//! Progress callbacks are called as `callback(kind, a, b)` on the event loop
+//! that started the call, never on a tokio thread.
+
+use std::{
+    ffi::c_void,
+    fmt,
+    os::raw::c_int,
+    path::{Component, Path, PathBuf},
+    str::FromStr,
+    sync::{Arc, Mutex},
+};
+
+use anyhow::Context;
+use bytes::Bytes;
+use futures_buffered::BufferedStreamExt;
+use futures_lite::StreamExt;
+use iroh::{protocol::Router, Endpoint, SecretKey};
+use iroh_blobs::{
+    format::collection::Collection,
+    get::{db::DownloadProgress, request::get_hash_seq_and_sizes},
+    net_protocol::Blobs,
+    provider::{self, CustomEventSender},
+    store::{ExportMode, ImportMode, ImportProgress, Map, MapEntry, Store as _},
+    ticket::BlobTicket,
+    util::progress::AsyncChannelProgressSender,
+    BlobFormat, HashAndFormat, TempTag,
+};
+use iroh_io::AsyncSliceReader;
+use n0_future::future::Boxed;
+use pyo3::{exceptions::PyRuntimeError, ffi, prelude::*, AsPyPointer};
+use walkdir::WalkDir;
+
+type Store = iroh_blobs::store::fs::Store;
+
+fn to_py_err(e: impl fmt::Display) -> PyErr {
+    PyRuntimeError::new_err(format!("{:#}", e))
+}
+
+/// A python callable plus the event loop it has to be called on.
+#[derive(Clone)]
+struct PyCallback {
+    callback: Arc<PyObject>,
+    locals: pyo3_asyncio::TaskLocals,
+}
+
+impl fmt::Debug for PyCallback {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        f.write_str("PyCallback")
+    }
+}
+
+impl PyCallback {
+    fn new(py: Python<'_>, callback: PyObject) -> PyResult<Self> {
+        Ok(Self {
+            callback: Arc::new(callback),
+            locals: pyo3_asyncio::tokio::get_current_locals(py)?,
+        })
+    }
+
+    fn call(&self, kind: &str, a: u64, b: u64) {
+        Python::with_gil(|py| {
+            let res = self.locals.event_loop(py).call_method1(
+                "call_soon_threadsafe",
+                (self.callback.clone_ref(py), kind, a, b),
+            );
+            if let Err(e) = res {
+                e.print(py);
+            }
+        });
+    }
+}
+
+impl CustomEventSender for PyCallback {
+    fn send(&self, event: provider::Event) -> Boxed<()> {
+        self.try_send(event);
+        Box::pin(std::future::ready(()))
+    }
+
+    fn try_send(&self, event: provider::Event) {
+        match event {
+            provider::Event::ClientConnected { connection_id } => {
+                self.call("client_connected", connection_id, 0)
+            }
+            provider::Event::TransferProgress {
+                connection_id,
+                end_offset,
+                ..
+            } => self.call("transfer_progress", connection_id, end_offset),
+            provider::Event::TransferCompleted {
+                connection_id,
+                stats,
+                ..
+            } => self.call(
+                "transfer_completed",
+                connection_id,
+                stats.send.write_bytes.size,
+            ),
+            provider::Event::TransferAborted { connection_id, .. } => {
+                self.call("transfer_aborted", connection_id, 0)
+            }
+            _ => {}
+        }
+    }
+}
+
+/// Received blob data, readable from python through the buffer protocol
+/// (`memoryview(buf)`, `bytes(buf)`, `f.write(buf)`) without copying it.
+#[pyclass]
+struct Buffer {
+    data: Bytes,
+}
+
+#[pymethods]
+impl Buffer {
+    fn __len__(&self) -> usize {
+        self.data.len()
+    }
+
+    unsafe fn __getbuffer__(
+        slf: PyRef<'_, Self>,
+        view: *mut ffi::Py_buffer,
+        flags: c_int,
+    ) -> PyResult<()> {
+        // read only view straight onto the Bytes, PyBuffer_FillInfo keeps slf alive
+        let ret = ffi::PyBuffer_FillInfo(
+            view,
+            slf.as_ptr(),
+            slf.data.as_ptr() as *mut c_void,
+            slf.data.len() as ffi::Py_ssize_t,
+            1,
+            flags,
+        );
+        if ret == -1 {
+            return Err(PyErr::fetch(slf.py()));
+        }
+        Ok(())
+    }
+
+    unsafe fn __releasebuffer__(&self, _view: *mut ffi::Py_buffer) {}
+}
+
+/// A received blob, read a piece at a time so it never has to fit in memory whole.
+#[pyclass]
+struct BlobReader {
+    store: Store,
+    hash: iroh_blobs::Hash,
+    #[pyo3(get)]
+    size: u64,
+}
+
+#[pymethods]
+impl BlobReader {
+    /// Up to len bytes starting at offset, as a Buffer. Empty at the end of the blob.
+    fn read_at<'p>(&self, py: Python<'p>, offset: u64, len: usize) -> PyResult<&'p PyAny> {
+        let store = self.store.clone();
+        let hash = self.hash;
+        let size = self.size;
+        pyo3_asyncio::tokio::future_into_py(py, async move {
+            let len = len.min(size.saturating_sub(offset) as usize);
+            if len == 0 {
+                return Ok(Buffer { data: Bytes::new() });
+            }
+            let entry = store
+                .get(&hash)
+                .await
+                .map_err(to_py_err)?
+                .ok_or_else(|| to_py_err("blob missing from the store"))?;
+            let mut reader = entry.data_reader().await.map_err(to_py_err)?;
+            let data = reader.read_at(offset, len).await.map_err(to_py_err)?;
+            Ok(Buffer { data })
+        })
+    }
+}
+
+/// One endpoint and blob store, kept running between transfers.
+#[pyclass]
+struct Node {
+    router: Router,
+    blobs: Blobs<Store>,
+    /// tags of everything we have sent, so the data stays around while we serve it
+    shared: Arc<Mutex<Vec<TempTag>>>,
+    _temp_dir: Option<tempfile::TempDir>,
+}
+
+#[pymethods]
+impl Node {
+    /// Start a node. Without a data dir everything is kept in a temporary folder.
+    /// on_event gets called with what peers are fetching from us.
+    #[staticmethod]
+    #[args(data_dir = "None", on_event = "None")]
+    fn spawn(py: Python<'_>, data_dir: Option<String>, on_event: Option<PyObject>) -> PyResult<&PyAny> {
+        let events = on_event.map(|cb| PyCallback::new(py, cb)).transpose()?;
+        pyo3_asyncio::tokio::future_into_py(py, async move {
+            Node::spawn_inner(data_dir, events).await.map_err(to_py_err)
+        })
+    }
+
+    #[getter]
+    fn node_id(&self) -> String {
+        self.router.endpoint().node_id().to_string()
+    }
+
+    /// Import a file or folder and return (ticket, size). It is served until the node shuts down.
+    #[args(progress = "None")]
+    fn send<'p>(&self, py: Python<'p>, path: String, progress: Option<PyObject>) -> PyResult<&'p PyAny> {
+        let progress = progress.map(|cb| PyCallback::new(py, cb)).transpose()?;
+        let router = self.router.clone();
+        let store = self.blobs.store().clone();
+        let shared = self.shared.clone();
+        pyo3_asyncio::tokio::future_into_py(py, async move {
+            let (tag, size, _collection) = import(PathBuf::from(path), store, progress)
+                .await
+                .map_err(to_py_err)?;
+            let hash = *tag.hash();
+            // wait for the endpoint to figure out its address before making a ticket
+            router.endpoint().home_relay().initialized().await.map_err(to_py_err)?;
+            let addr = router.endpoint().node_addr().await.map_err(to_py_err)?;
+            let ticket = BlobTicket::new(addr, hash, BlobFormat::HashSeq).map_err(to_py_err)?;
+            shared.lock().unwrap().push(tag);
+            Ok((ticket.to_string(), size))
+        })
+    }
+
+    /// Download a ticket and write its files into out_dir. Returns [(name, path)].
+    #[args(progress = "None")]
+    fn receive<'p>(
+        &self,
+        py: Python<'p>,
+        ticket: String,
+        out_dir: String,
+        progress: Option<PyObject>,
+    ) -> PyResult<&'p PyAny> {
+        let progress = progress.map(|cb| PyCallback::new(py, cb)).transpose()?;
+        let endpoint = self.router.endpoint().clone();
+        let store = self.blobs.store().clone();
+        pyo3_asyncio::tokio::future_into_py(py, async move {
+            let collection = download(&endpoint, &store, &ticket, progress)
+                .await
+                .map_err(to_py_err)?;
+            let root = PathBuf::from(out_dir);
+            let mut written = Vec::new();
+            for (name, hash) in collection.iter() {
+                let target = get_export_path(&root, name).map_err(to_py_err)?;
+                store
+                    .export(*hash, target.clone(), ExportMode::Copy, Box::new(|_position| Ok(())))
+                    .await
+                    .map_err(to_py_err)?;
+                written.push((name.clone(), target.to_string_lossy().into_owned()));
+            }
+            Ok(written)
+        })
+    }
+
+    /// Download a ticket and hand the files back as readers over the store, nothing is
+    /// read into memory until asked for. Returns [(name, size, BlobReader)].
+    #[args(progress = "None")]
+    fn receive_bytes<'p>(&self, py: Python<'p>, ticket: String, progress: Option<PyObject>) -> PyResult<&'p PyAny> {
+        let progress = progress.map(|cb| PyCallback::new(py, cb)).transpose()?;
+        let endpoint = self.router.endpoint().clone();
+        let store = self.blobs.store().clone();
+        pyo3_asyncio::tokio::future_into_py(py, async move {
+            let collection = download(&endpoint, &store, &ticket, progress)
+                .await
+                .map_err(to_py_err)?;
+            let mut readers = Vec::new();
+            for (name, hash) in collection.iter() {
+                let size = blob_size(&store, hash).await.map_err(to_py_err)?;
+                let reader = BlobReader { store: store.clone(), hash: *hash, size };
+                readers.push((name.clone(), size, reader));
+            }
+            Ok(readers)
+        })
+    }
+
+    /// Stop serving and close the endpoint.
+    fn shutdown<'p>(&self, py: Python<'p>) -> PyResult<&'p PyAny> {
+        let router = self.router.clone();
+        let shared = self.shared.clone();
+        pyo3_asyncio::tokio::future_into_py(py, async move {
+            shared.lock().unwrap().clear();
+            router.shutdown().await.map_err(to_py_err)?;
+            Ok(())
+        })
+    }
+}
+
+impl Node {
+    async fn spawn_inner(data_dir: Option<String>, events: Option<PyCallback>) -> anyhow::Result<Self> {
+        let (data_dir, temp_dir) = match data_dir {
+            Some(dir) => (PathBuf::from(dir), None),
+            None => {
+                let temp = tempfile::tempdir()?;
+                (temp.path().to_path_buf(), Some(temp))
+            }
+        };
+        tokio::fs::create_dir_all(&data_dir).await?;
+        let secret_key = get_or_create_secret(&data_dir.join("secret")).await?;
+        let endpoint = Endpoint::builder()
+            .alpns(vec![iroh_blobs::protocol::ALPN.to_vec()])
+            .secret_key(secret_key)
+            .discovery_n0()
+            .bind()
+            .await?;
+        let builder = Blobs::persistent(data_dir.join("blobs")).await?;
+        let builder = match events {
+            Some(events) => builder.events(events.into()),
+            None => builder,
+        };
+        let blobs = builder.build(&endpoint);
+        let router = Router::builder(endpoint)
+            .accept(iroh_blobs::ALPN, blobs.clone())
+            .spawn()
+            .await?;
+        Ok(Self {
+            router,
+            blobs,
+            shared: Default::default(),
+            _temp_dir: temp_dir,
+        })
+    }
+}
+
+/// Keep the node id stable for a data dir, same idea as IROH_SECRET for sendme.
+async fn get_or_create_secret(path: &Path) -> anyhow::Result<SecretKey> {
+    match tokio::fs::read_to_string(path).await {
+        Ok(secret) => SecretKey::from_str(secret.trim()).context("invalid secret"),
+        Err(_) => {
+            let key = SecretKey::generate(rand::rngs::OsRng);
+            tokio::fs::write(path, key.to_string()).await?;
+            Ok(key)
+        }
+    }
+}
+
+/// Fetch the collection behind a ticket into the store. Whatever is already in
+/// the store (e.g. from an interrupted earlier download) is not fetched again.
+async fn download(
+    endpoint: &Endpoint,
+    store: &Store,
+    ticket: &str,
+    progress: Option<PyCallback>,
+) -> anyhow::Result<Collection> {
+    let ticket = BlobTicket::from_str(ticket).context("invalid ticket")?;
+    let connection = endpoint
+        .connect(ticket.node_addr().clone(), iroh_blobs::protocol::ALPN)
+        .await?;
+    let hash_and_format = HashAndFormat {
+        hash: ticket.hash(),
+        format: ticket.format(),
+    };
+    let (_hash_seq, sizes) = get_hash_seq_and_sizes(&connection, &hash_and_format.hash, 1024 * 1024 * 32).await?;
+    if let Some(cb) = &progress {
+        // first entry is the collection itself, the rest are the files
+        cb.call("total", sizes.iter().skip(1).sum::<u64>(), sizes.len().saturating_sub(1) as u64);
+    }
+    let (send, recv) = async_channel::bounded(32);
+    let sender = AsyncChannelProgressSender::new(send);
+    let forward = tokio::spawn(forward_download_progress(recv, progress));
+    let get_conn = || async move { Ok(connection) };
+    iroh_blobs::get::db::get_to_db(store, get_conn, &hash_and_format, sender).await?;
+    forward.await?;
+    Collection::load_db(store, &hash_and_format.hash).await
+}
+
+async fn forward_download_progress(
+    recv: async_channel::Receiver<DownloadProgress>,
+    progress: Option<PyCallback>,
+) {
+    while let Ok(event) = recv.recv().await {
+        let Some(cb) = &progress else { continue };
+        match event {
+            DownloadProgress::Connected => cb.call("connected", 0, 0),
+            DownloadProgress::FoundHashSeq { children, .. } => cb.call("found_hash_seq", children, 0),
+            DownloadProgress::Found { id, size, .. } => cb.call("found", id, size),
+            DownloadProgress::Progress { id, offset } => cb.call("progress", id, offset),
+            DownloadProgress::Done { id } => cb.call("done", id, 0),
+            DownloadProgress::AllDone(stats) => {
+                cb.call("all_done", stats.bytes_read, stats.elapsed.as_millis() as u64)
+            }
+            _ => {}
+        }
+    }
+}
+
+async fn blob_size(store: &Store, hash: &iroh_blobs::Hash) -> anyhow::Result<u64> {
+    let entry = store.get(hash).await?.context("blob missing after download")?;
+    Ok(entry.size().value())
+}
+
+async fn forward_import_progress(recv: async_channel::Receiver<ImportProgress>, progress: Option<PyCallback>) {
+    while let Ok(event) = recv.recv().await {
+        let Some(cb) = &progress else { continue };
+        match event {
+            ImportProgress::Size { id, size } => cb.call("import_size", id, size),
+            ImportProgress::OutboardProgress { id, offset } => cb.call("import_progress", id, offset),
+            ImportProgress::OutboardDone { id, .. } => cb.call("import_done", id, 0),
+            _ => {}
+        }
+    }
+}
+
+/// Import from a file or directory into the store, like sendme does.
+///
+/// The returned tag always refers to a collection. If the input is a file, this
+/// is a collection with a single blob, named like the file.
+async fn import(
+    path: PathBuf,
+    db: Store,
+    progress: Option<PyCallback>,
+) -> anyhow::Result<(TempTag, u64, Collection)> {
+    let path = path.canonicalize()?;
+    anyhow::ensure!(path.exists(), "path {} does not exist", path.display());
+    let root = path.parent().context("context get parent")?;
+    // walkdir also works for files, so we don't need to special case them
+    let files = WalkDir::new(path.clone()).into_iter();
+    // flatten the directory structure into a list of (name, path) pairs.
+    // ignore symlinks.
+    let data_sources: Vec<(String, PathBuf)> = files
+        .map(|entry| {
+            let entry = entry?;
+            if !entry.file_type().is_file() {
+                // Skip symlinks. Directories are handled by WalkDir.
+                return Ok(None);
+            }
+            let path = entry.into_path();
+            let relative = path.strip_prefix(root)?;
+            let name = canonicalized_path_to_string(relative, true)?;
+            anyhow::Ok(Some((name, path)))
+        })
+        .filter_map(Result::transpose)
+        .collect::<anyhow::Result<Vec<_>>>()?;
+    let (send, recv) = async_channel::bounded(32);
+    let sender = AsyncChannelProgressSender::new(send);
+    let forward = tokio::spawn(forward_import_progress(recv, progress));
+    // import all the files, using num_cpus workers, return names and temp tags
+    let mut names_and_tags = futures_lite::stream::iter(data_sources)
+        .map(|(name, path)| {
+            let db = db.clone();
+            let sender = sender.clone();
+            async move {
+                let (temp_tag, file_size) = db
+                    .import_file(path, ImportMode::TryReference, BlobFormat::Raw, sender)
+                    .await?;
+                anyhow::Ok((name, temp_tag, file_size))
+            }
+        })
+        .buffered_unordered(num_cpus::get())
+        .collect::<Vec<_>>()
+        .await
+        .into_iter()
+        .collect::<anyhow::Result<Vec<_>>>()?;
+    drop(sender);
+    names_and_tags.sort_by(|(a, _, _), (b, _, _)| a.cmp(b));
+    let size = names_and_tags.iter().map(|(_, _, size)| *size).sum::<u64>();
+    // the collection protects the data once stored, the per file tags can go after that
+    let (collection, tags) = names_and_tags
+        .into_iter()
+        .map(|(name, tag, _)| ((name, *tag.hash()), tag))
+        .unzip::<_, _, Collection, Vec<_>>();
+    let temp_tag = collection.clone().store(&db).await?;
+    drop(tags);
+    forward.await?;
+    Ok((temp_tag, size, collection))
+}
+
+fn validate_path_component(component: &str) -> anyhow::Result<()> {
+    anyhow::ensure!(
+        !component.contains('/'),
+        "path components must not contain the only correct path separator, /"
+    );
+    anyhow::ensure!(
+        component != ".." && component != "." && !component.is_empty(),
+        "invalid path component {:?}",
+        component
+    );
+    Ok(())
+}
+
+/// Same as in deletelater.rs: turn an already canonicalized path into a `/`
+/// separated name, failing on anything that isn't a plain component.
+fn canonicalized_path_to_string(path: impl AsRef<Path>, must_be_relative: bool) -> anyhow::Result<String> {
+    let mut path_str = String::new();
+    let parts = path
+        .as_ref()
+        .components()
+        .filter_map(|c| match c {
+            Component::Normal(x) => {
+                let c = match x.to_str() {
+                    Some(c) => c,
+                    None => return Some(Err(anyhow::anyhow!("invalid character in path"))),
+                };
+
+                if !c.contains('/') && !c.contains('\\') {
+                    Some(Ok(c))
+                } else {
+                    Some(Err(anyhow::anyhow!("invalid path component {:?}", c)))
+                }
+            }
+            Component::RootDir => {
+                if must_be_relative {
+                    Some(Err(anyhow::anyhow!("invalid path component {:?}", c)))
+                } else {
+                    path_str.push('/');
+                    None
+                }
+            }
+            _ => Some(Err(anyhow::anyhow!("invalid path component {:?}", c))),
+        })
+        .collect::<anyhow::Result<Vec<_>>>()?;
+    let parts = parts.join("/");
+    path_str.push_str(&parts);
+    Ok(path_str)
+}
+
+fn get_export_path(root: &Path, name: &str) -> anyhow::Result<PathBuf> {
+    let parts = name.split('/');
+    let mut path = root.to_path_buf();
+    for part in parts {
+        validate_path_component(part)?;
+        path.push(part);
+    }
+    Ok(path)
+}
+
+#[pymodule]
+fn sendme_module(_py: Python<'_>, m: &PyModule) -> PyResult<()> {
+    m.add_class::<Node>()?;
+    m.add_class::<Buffer>()?;
+    m.add_class::<BlobReader>()?;
+    Ok(())
+}